@@ -0,0 +1,205 @@
+
+# Нагрузочный прогон: main.app и заглушка Bot API (fake_tg) в одном процессе, без сети.
+# Тысячи чатов одновременно проходят /start, ходят по локациям и доигрывают бои; каждый чат
+# жмёт кнопки из последнего присланного ему сообщения. Как и у настоящего Telegram, одновременно
+# в вебхуке не больше --connections запросов. Итог — апдейтов в секунду, задержка вебхука (p50/p99)
+# и исходящих вызовов Bot API на апдейт; строка дописывается в BENCH_RESULTS вместе с коммитом.
+# Клиент и заглушка крутятся в том же процессе, так что цифры — для сравнения между коммитами
+# на одной машине, а не абсолютная ёмкость.
+#   python bench.py                                   — 2000 чатов по 30 апдейтов
+#   python bench.py --chats 5000 --steps 50 --reply   — с WEBHOOK_REPLY=1
+#   python bench.py --max-regression 0.15             — код 1, если медленнее прошлого прогона на 15%
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import platform
+import subprocess
+import tempfile
+from typing import List, Optional
+
+import httpx
+
+BENCH_RESULTS = os.getenv("BENCH_RESULTS", "bench_results.jsonl")
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Нагрузочный прогон бота на заглушке Bot API")
+    p.add_argument("--chats", type=int, default=2000, help="одновременных чатов")
+    p.add_argument("--steps", type=int, default=30, help="апдейтов на чат после /start")
+    p.add_argument("--connections", type=int, default=40,
+                   help="параллельных запросов вебхука (как max_connections в setWebhook, у Telegram по умолчанию 40)")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--reply", action="store_true", help="WEBHOOK_REPLY=1: последний вызов — в ответе вебхука")
+    p.add_argument("--limits", action="store_true",
+                   help="оставить лимиты отправки Telegram (TG_GLOBAL_RATE/TG_CHAT_RATE); по умолчанию сняты")
+    p.add_argument("--backend", default="sqlite", choices=("sqlite", "memory"), help="SESSION_BACKEND")
+    p.add_argument("--out", default=BENCH_RESULTS, help="куда дописать результат (JSONL); пусто — не писать")
+    p.add_argument("--max-regression", type=float, default=None,
+                   help="допустимое падение updates/sec относительно прошлого прогона с теми же параметрами")
+    return p.parse_args(argv)
+
+
+def setup_env(args, workdir: str):
+    # main читает настройки при импорте — всё выставляем до него
+    os.environ.setdefault("BOT_TOKEN", "bench")
+    os.environ["TG_API"] = "http://fake-tg"
+    os.environ["WEBHOOK_SECRET"] = "bench"
+    os.environ["WEBHOOK_BASE"] = ""
+    os.environ["PREWARM_CHAT_ID"] = ""
+    os.environ["WEBHOOK_REPLY"] = "1" if args.reply else "0"
+    os.environ["SESSION_BACKEND"] = args.backend
+    if not args.limits:
+        # меряем сам бот, а не то, как быстро он выбирает лимит Telegram
+        os.environ["TG_GLOBAL_RATE"] = "0"
+        os.environ["TG_CHAT_RATE"] = "0"
+    os.environ["SESSION_DB"] = os.path.join(workdir, "sessions.db")
+    os.environ["FILE_ID_CACHE"] = os.path.join(workdir, "file_ids.json")
+
+
+def pick(rng: random.Random, buttons: List[str]) -> str:
+    # в бою в основном бьём, чтобы бои доходили до конца; вне боя — идём дальше, подсказки реже
+    fight = [b for b in buttons if b.startswith("f") or b.startswith("fight:")]
+    if fight:
+        return fight[0] if rng.random() < 0.7 else rng.choice(fight)
+    moves = [b for b in buttons if not (b.startswith("h") or b.startswith("hint:"))]
+    return rng.choice(moves if moves and rng.random() < 0.9 else buttons)
+
+
+def percentile(sorted_vals: List[float], q: float) -> float:
+    if not sorted_vals:
+        return 0.0
+    k = min(len(sorted_vals) - 1, int(round(q / 100 * (len(sorted_vals) - 1))))
+    return sorted_vals[k]
+
+
+def git_commit() -> dict:
+    try:
+        sha = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                             check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"],
+                                    capture_output=True, text=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return {"commit": None, "dirty": None}
+    return {"commit": sha, "dirty": dirty}
+
+
+async def run(args) -> dict:
+    import main
+    import fake_tg
+
+    main._client = httpx.AsyncClient(transport=httpx.ASGITransport(app=fake_tg.app), timeout=60)
+    bot = httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://bot", timeout=60)
+    # от имени Telegram: выполняет вызов, который бот вернул в ответе вебхука
+    telegram = httpx.AsyncClient(transport=httpx.ASGITransport(app=fake_tg.app), timeout=60)
+    await main._start_session_flusher()
+
+    latencies: List[float] = []
+    replies = 0
+    errors = 0
+    update_ids = iter(range(1, 1 << 62))
+    conns = asyncio.Semaphore(args.connections)
+
+    async def send(chat_id: int, body: dict):
+        nonlocal replies, errors
+        body["update_id"] = next(update_ids)
+        async with conns:
+            t0 = time.perf_counter()
+            r = await bot.post("/webhook/bench", content=json.dumps(body))
+            latencies.append(time.perf_counter() - t0)
+        if r.status_code != 200:
+            errors += 1
+            return
+        out = r.json()
+        if "method" in out:
+            # режим WEBHOOK_REPLY: вызов из ответа выполняет сам Telegram, в задержку вебхука не входит
+            replies += 1
+            method = out.pop("method")
+            await telegram.post(f"{main.TG}/{method}", content=json.dumps(out))
+
+    async def chat(chat_id: int):
+        rng = random.Random(args.seed * 1_000_003 + chat_id)
+        await send(chat_id, {"message": {"message_id": 1, "chat": {"id": chat_id}, "text": "/start"}})
+        for step in range(args.steps):
+            buttons = fake_tg.KEYBOARDS.get(chat_id)
+            if not buttons:
+                await send(chat_id, {"message": {"message_id": 1, "chat": {"id": chat_id}, "text": "/start"}})
+                continue
+            await send(chat_id, {"callback_query": {
+                "id": f"{chat_id}:{step}", "data": pick(rng, buttons),
+                "message": {"message_id": fake_tg.KEYBOARD_MSG.get(chat_id, 1), "chat": {"id": chat_id}},
+            }})
+
+    fake_tg.CALLS.clear()
+    fake_tg.KEYBOARDS.clear()
+    fake_tg.KEYBOARD_MSG.clear()
+    fake_tg.MESSAGES.clear()
+    t0 = time.perf_counter()
+    await asyncio.gather(*(chat(c) for c in range(1, args.chats + 1)))
+    elapsed = time.perf_counter() - t0
+
+    await main._stop_session_flusher()
+    await bot.aclose()
+    await telegram.aclose()
+    await main.close_tg_client()
+
+    n = len(latencies)
+    lat = sorted(latencies)
+    methods = {}
+    for c in fake_tg.CALLS:
+        methods[c["method"]] = methods.get(c["method"], 0) + 1
+    return {
+        "updates": n,
+        "errors": errors,
+        "elapsed_sec": round(elapsed, 3),
+        "updates_per_sec": round(n / elapsed, 1) if elapsed else None,
+        "latency_ms": {"p50": round(percentile(lat, 50) * 1000, 2), "p99": round(percentile(lat, 99) * 1000, 2),
+                       "max": round(lat[-1] * 1000, 2) if lat else 0.0},
+        "calls_per_update": round(len(fake_tg.CALLS) / n, 3) if n else None,
+        "calls": methods,
+        "webhook_replies": replies,
+    }
+
+
+def previous(path: str, params: dict) -> Optional[dict]:
+    # последний сохранённый прогон с теми же параметрами
+    try:
+        with open(path, encoding="utf-8") as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+    except OSError:
+        return None
+    same = [r for r in rows if r.get("params") == params]
+    return same[-1] if same else None
+
+
+def main_cli(argv=None) -> int:
+    args = parse_args(argv)
+    params = {"chats": args.chats, "steps": args.steps, "connections": args.connections, "seed": args.seed,
+              "reply": args.reply, "limits": args.limits, "backend": args.backend}
+    with tempfile.TemporaryDirectory() as workdir:
+        setup_env(args, workdir)
+        result = asyncio.run(run(args))
+    record = {"ts": time.strftime("%Y-%m-%dT%H:%M:%S"), **git_commit(), "python": platform.python_version(),
+              "params": params, **result}
+    prev = previous(args.out, params) if args.out else None
+    print(json.dumps(record, ensure_ascii=False, indent=1))
+    if args.out:
+        with open(args.out, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    if prev:
+        change = record["updates_per_sec"] / prev["updates_per_sec"] - 1
+        print(f"vs {prev.get('commit')}: updates/sec {prev['updates_per_sec']} -> {record['updates_per_sec']} "
+              f"({change:+.1%}), p99 {prev['latency_ms']['p99']} -> {record['latency_ms']['p99']} ms")
+        if args.max_regression is not None and change < -args.max_regression:
+            print("regression")
+            return 1
+    return 1 if result["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,137 @@
+
+# Локальная заглушка Bot API для прогонов без настоящего Telegram.
+#   uvicorn fake_tg:app --port 8081
+#   TG_API=http://127.0.0.1:8081 PREWARM_CHAT_ID=1 python main.py prewarm
+#   TG_API=http://127.0.0.1:8081 python main.py poll   (апдейты подкладываются через POST /_push)
+# Отвечает в формате Bot API на методы, которыми пользуется бот, и запоминает вызовы.
+
+import json
+import asyncio
+import hashlib
+import itertools
+from typing import Dict, List
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+app = FastAPI()
+
+CALLS: List[dict] = []
+_msg_ids = itertools.count(1)
+UPDATES: List[dict] = []  # очередь для getUpdates
+KEYBOARDS: Dict[int, List[str]] = {}  # chat_id -> callback_data кнопок последнего сообщения с клавиатурой
+KEYBOARD_MSG: Dict[int, int] = {}      # chat_id -> message_id этого сообщения
+MESSAGES: Dict[int, dict] = {}         # message_id -> {"chat_id", "caption" | "text", "reply_markup"}
+_update_ids = itertools.count(1)
+_new_updates = asyncio.Event()
+
+
+def _photo_result(chat_id, photo: str) -> dict:
+    fid = "fid_" + hashlib.sha1(photo.encode()).hexdigest()[:16]
+    return {
+        "message_id": next(_msg_ids),
+        "chat": {"id": chat_id},
+        "photo": [{"file_id": fid + "_s", "width": 90, "height": 60},
+                  {"file_id": fid, "width": 1280, "height": 853}],
+    }
+
+
+def remember_keyboard(payload: dict, message_id: int):
+    # чтобы нагрузочный прогон мог «нажимать» кнопки, как игрок
+    markup = payload.get("reply_markup")
+    if not markup:
+        return
+    if isinstance(markup, str):
+        markup = json.loads(markup)
+    chat_id = payload.get("chat_id")
+    KEYBOARDS[chat_id] = [b["callback_data"] for row in markup.get("inline_keyboard", [])
+                          for b in row if "callback_data" in b]
+    KEYBOARD_MSG[chat_id] = message_id
+
+
+def _error(code: int, description: str) -> JSONResponse:
+    return JSONResponse({"ok": False, "error_code": code, "description": description}, status_code=code)
+
+
+def _edit_caption(payload: dict):
+    msg = MESSAGES.get(payload.get("message_id"))
+    if msg is None or msg["chat_id"] != payload.get("chat_id"):
+        return _error(400, "Bad Request: message to edit not found")
+    if "caption" not in msg:
+        return _error(400, "Bad Request: there is no caption in the message to edit")
+    new = {"caption": payload.get("caption", ""), "reply_markup": payload.get("reply_markup")}
+    if new == {"caption": msg["caption"], "reply_markup": msg["reply_markup"]}:
+        return _error(400, "Bad Request: message is not modified: specified new message content and reply "
+                           "markup are exactly the same as a current content and reply markup of the message")
+    msg.update(new)
+    remember_keyboard(payload, payload["message_id"])
+    return {"ok": True, "result": {"message_id": payload["message_id"], "chat": {"id": msg["chat_id"]},
+                                   "caption": msg["caption"]}}
+
+
+async def _read_payload(request: Request) -> dict:
+    body = await request.body()
+    ctype = request.headers.get("content-type", "")
+    if ctype.startswith("multipart/"):
+        # файлы не разбираем: для file_id хватает хэша тела
+        return {"photo": "upload:" + hashlib.sha1(body).hexdigest(), "_bytes": len(body)}
+    if not body:
+        return {}
+    return json.loads(body)
+
+
+@app.post("/bot{token}/{method}")
+async def bot_api(token: str, method: str, request: Request):
+    payload = await _read_payload(request)
+    CALLS.append({"method": method, "payload": payload})
+    chat_id = payload.get("chat_id")
+
+    if method == "sendPhoto":
+        res = _photo_result(chat_id, str(payload.get("photo", "")))
+        MESSAGES[res["message_id"]] = {"chat_id": chat_id, "caption": payload.get("caption", ""),
+                                       "reply_markup": payload.get("reply_markup")}
+        remember_keyboard(payload, res["message_id"])
+        return {"ok": True, "result": res}
+    if method == "sendMessage":
+        mid = next(_msg_ids)
+        MESSAGES[mid] = {"chat_id": chat_id, "text": payload.get("text", ""),
+                         "reply_markup": payload.get("reply_markup")}
+        remember_keyboard(payload, mid)
+        return {"ok": True, "result": {"message_id": mid, "chat": {"id": chat_id}, "text": payload.get("text", "")}}
+    if method == "editMessageCaption":
+        return _edit_caption(payload)
+    if method == "getUpdates":
+        return {"ok": True, "result": await _get_updates(payload)}
+    if method in ("answerCallbackQuery", "deleteMessage", "setWebhook", "deleteWebhook"):
+        return {"ok": True, "result": True}
+    return _error(404, "Not Found: method not found")
+
+
+async def _get_updates(payload: dict) -> List[dict]:
+    # offset подтверждает всё, что меньше него; пустую очередь держим до timeout (long polling)
+    offset = payload.get("offset")
+    if offset is not None:
+        UPDATES[:] = [u for u in UPDATES if u["update_id"] >= offset]
+    if not UPDATES and payload.get("timeout"):
+        _new_updates.clear()
+        try:
+            await asyncio.wait_for(_new_updates.wait(), payload["timeout"])
+        except asyncio.TimeoutError:
+            pass
+    return UPDATES[:payload.get("limit", 100)]
+
+
+@app.post("/_push")
+async def push(request: Request) -> Dict[str, int]:
+    # апдейт или список апдейтов; update_id проставляется, если не задан
+    body = json.loads(await request.body())
+    for upd in body if isinstance(body, list) else [body]:
+        upd.setdefault("update_id", next(_update_ids))
+        UPDATES.append(upd)
+    _new_updates.set()
+    return {"queued": len(UPDATES)}
+
+
+@app.get("/_calls")
+async def calls() -> Dict[str, object]:
+    return {"count": len(CALLS), "calls": CALLS[-100:]}
@@ -1,14 +1,31 @@
-
-
 import os
+import io
+import math
 import json
+import hashlib
+import sqlite3
+import struct
+import threading
+import time
 import random
+import signal
+import asyncio
+import bisect
 import unicodedata
 import httpx
-from dataclasses import dataclass, field, asdict
-from typing import Dict, List, Optional
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from copy import copy
+from dataclasses import dataclass, asdict, field
+from typing import Awaitable, Callable, Dict, FrozenSet, List, Optional, Tuple, Union
+
+from fastapi import FastAPI, Request, HTTPException, Response
 
-from fastapi import FastAPI, Request, HTTPException
+try:
+    import orjson
+except ImportError:  # без orjson — обычный json, только медленнее
+    orjson = None
 
 # === ENV ===
 BOT_TOKEN = os.getenv("BOT_TOKEN")
@@ -16,22 +33,388 @@ if not BOT_TOKEN:
     raise RuntimeError("BOT_TOKEN is not set")
 WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "secret123")
 WEBHOOK_BASE = os.getenv("WEBHOOK_BASE", "")  # e.g. https://your-service.onrender.com
-TG = f"https://api.telegram.org/bot{BOT_TOKEN}"
+TG_API = os.getenv("TG_API", "https://api.telegram.org").rstrip("/")  # можно подменить локальной заглушкой
+TG = f"{TG_API}/bot{BOT_TOKEN}"
+# пул соединений к Bot API (один клиент на всё время жизни приложения)
+TG_POOL_SIZE = int(os.getenv("TG_POOL_SIZE", "100"))
+TG_KEEPALIVE = int(os.getenv("TG_KEEPALIVE", "20"))
+TG_KEEPALIVE_EXPIRY = float(os.getenv("TG_KEEPALIVE_EXPIRY", "30"))
+TG_HTTP2 = os.getenv("TG_HTTP2", "0") == "1"
+# последний исходящий вызов апдейта возвращать прямо в ответе на вебхук
+WEBHOOK_REPLY = os.getenv("WEBHOOK_REPLY", "0") == "1"
+# куда сохранять file_id загруженных в Telegram картинок
+FILE_ID_CACHE = os.getenv("FILE_ID_CACHE", "file_ids.json")
+# прогрев картинок: локальное хранилище и служебный чат, куда они загружаются один раз
+IMG_STORE = os.getenv("IMG_STORE", "img_store")
+IMG_MAX_SIDE = int(os.getenv("IMG_MAX_SIDE", "1280"))
+PREWARM_CHAT_ID = os.getenv("PREWARM_CHAT_ID", "")
+# хранилище сессий: sqlite (по умолчанию) | memory; грязные сессии пишутся пачкой раз в SESSION_FLUSH_SEC
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "sqlite")
+SESSION_DB = os.getenv("SESSION_DB", "sessions.db")
+SESSION_FLUSH_SEC = float(os.getenv("SESSION_FLUSH_SEC", "2"))
+# кэш сессий в памяти: не больше SESSION_CACHE_MAX, простаивающие дольше SESSION_IDLE_TTL секунд вытесняются;
+# SESSION_SPILL=1 — вытесненные сессии уходят в хранилище и поднимаются оттуда при следующем апдейте
+SESSION_CACHE_MAX = int(os.getenv("SESSION_CACHE_MAX", "100000"))
+SESSION_IDLE_TTL = float(os.getenv("SESSION_IDLE_TTL", "3600"))
+SESSION_SPILL = os.getenv("SESSION_SPILL", "1") == "1"
+# повторы вебхука: update_id, виденные за последние DEDUP_WINDOW секунд, отбрасываются
+DEDUP_WINDOW = float(os.getenv("DEDUP_WINDOW", "600"))
+DEDUP_MAX = int(os.getenv("DEDUP_MAX", "200000"))
+# long polling (python main.py poll): размер пачки getUpdates, время ожидания и число апдейтов в работе
+POLL_LIMIT = int(os.getenv("POLL_LIMIT", "100"))
+POLL_TIMEOUT = int(os.getenv("POLL_TIMEOUT", "30"))
+POLL_CONCURRENCY = int(os.getenv("POLL_CONCURRENCY", "64"))
+# паки контента (картинки, локации, бои); перечитываются по SIGHUP и POST /admin/reload/{WEBHOOK_SECRET}
+CONTENT_DIR = os.getenv("CONTENT_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "content"))
+# сводка по графу контента (python main.py check); берётся, только если собрана для тех же паков
+GRAPH_ARTIFACT = os.getenv("GRAPH_ARTIFACT", os.path.join(CONTENT_DIR, "_graph.json"))
+# закреплённые номера узлов и предметов (в callback_data и сессиях); файл только дописывается
+CONTENT_IDS = os.getenv("CONTENT_IDS", os.path.join(CONTENT_DIR, "_ids.json"))
+# быстрый ответ вебхуку: апдейт кладётся в очередь на WEBHOOK_QUEUE мест (0 — выключено, обработка
+# прямо в запросе) и разбирается WEBHOOK_WORKERS обработчиками; нажатия кнопок, пролежавшие в очереди
+# дольше CALLBACK_MAX_AGE секунд, выбрасываются
+WEBHOOK_QUEUE = int(os.getenv("WEBHOOK_QUEUE", "0"))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "32"))
+CALLBACK_MAX_AGE = float(os.getenv("CALLBACK_MAX_AGE", "10"))
+# исходящие вызовы: лимиты Telegram на отправку (в секунду всего и на чат, 0 — без ограничения)
+# и повторы при 429 / 5xx / сетевых ошибках с нарастающей паузой со случайным разбросом
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "30"))
+TG_CHAT_RATE = float(os.getenv("TG_CHAT_RATE", "1"))
+TG_CHAT_BURST = int(os.getenv("TG_CHAT_BURST", "3"))
+TG_RETRIES = int(os.getenv("TG_RETRIES", "4"))
+TG_BACKOFF = float(os.getenv("TG_BACKOFF", "0.5"))
+TG_BACKOFF_MAX = float(os.getenv("TG_BACKOFF_MAX", "30"))
+# сколько нажатий хранить в журнале сессии для переигровки; дальше журнал обрывается
+ACTION_LOG_MAX = int(os.getenv("ACTION_LOG_MAX", "5000"))
 
 # === FASTAPI ===
 app = FastAPI()
 
+# === METRICS ===
+# Prometheus-текст без сторонних библиотек (GET /metrics). На горячем пути только perf_counter,
+# bisect по границам и прибавление в dict; всё остальное считается при выдаче.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    __slots__ = ("counts", "sum")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)  # последний — больше всех границ
+        self.sum = 0.0
+
+    def observe(self, v: float):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, v)] += 1
+        self.sum += v
+
+# имя метрики -> значение метки -> гистограмма / счётчик
+HISTOGRAMS: Dict[str, Dict[str, Histogram]] = {"bot_update_seconds": {}, "bot_stage_seconds": {},
+                                               "bot_tg_call_seconds": {}}
+COUNTERS: Dict[str, Dict[Tuple[str, ...], int]] = {"bot_update_errors_total": {}, "bot_tg_errors_total": {},
+                                                   "bot_tg_retries_total": {}, "bot_fallbacks_total": {},
+                                                   "bot_shed_total": {}, "bot_session_pack_errors_total": {},
+                                                   "bot_session_load_errors_total": {}}
+_METRIC_HELP = {
+    "bot_update_seconds": ("kind", "Время обработки апдейта по виду (команда, кнопка, действие в бою)"),
+    "bot_stage_seconds": ("stage", "Части обработки: ожидание замка чата, загрузка сессии, ожидание лимита отправки"),
+    "bot_tg_call_seconds": ("method", "Время вызова Bot API по методу"),
+    "bot_update_errors_total": (("kind",), "Апдейты, упавшие с исключением"),
+    "bot_tg_errors_total": (("method", "code"), "Ошибки вызовов Bot API (code — HTTP-статус или error)"),
+    "bot_tg_retries_total": (("method", "code"), "Повторы вызовов Bot API после 429, 5xx и сетевых ошибок"),
+    "bot_shed_total": (("reason",), "Апдейты, сброшенные под нагрузкой: очередь полна или нажатие устарело"),
+    "bot_session_pack_errors_total": ((), "Сессии, которые не удалось упаковать для записи (пропущены)"),
+    "bot_session_load_errors_total": ((), "Записи сессий, которые не удалось прочитать (запись не трогаем)"),
+    "bot_fallbacks_total": (("kind",), "Запасные пути: file_id -> URL, фото -> текст, правка -> новое фото"),
+}
+
+def observe(name: str, label: str, seconds: float):
+    h = HISTOGRAMS[name].get(label)
+    if h is None:
+        h = HISTOGRAMS[name][label] = Histogram()
+    h.observe(seconds)
+
+def count(name: str, *labels: str):
+    c = COUNTERS[name]
+    c[labels] = c.get(labels, 0) + 1
+
+def _fmt_labels(names, values) -> str:
+    return ",".join(f'{n}="{v}"' for n, v in zip(names, values))
+
+def render_metrics(extra: Dict[str, Tuple[str, str, float]]) -> str:
+    # extra: имя -> (тип, описание, значение) для того, что снимается в момент запроса
+    out = []
+    for name, by_label in HISTOGRAMS.items():
+        label, help_ = _METRIC_HELP[name]
+        out += [f"# HELP {name} {help_}", f"# TYPE {name} histogram"]
+        for value, h in sorted(by_label.items()):
+            acc = 0
+            for le, n in zip(LATENCY_BUCKETS + ("+Inf",), h.counts):
+                acc += n
+                out.append(f'{name}_bucket{{{label}="{value}",le="{le}"}} {acc}')
+            out.append(f'{name}_sum{{{label}="{value}"}} {h.sum:.6f}')
+            out.append(f'{name}_count{{{label}="{value}"}} {acc}')
+    for name, by_labels in COUNTERS.items():
+        labels, help_ = _METRIC_HELP[name]
+        out += [f"# HELP {name} {help_}", f"# TYPE {name} counter"]
+        for values, n in sorted(by_labels.items()):
+            out.append(f"{name}{{{_fmt_labels(labels, values)}}} {n}")
+    for name, (type_, help_, v) in extra.items():
+        out += [f"# HELP {name} {help_}", f"# TYPE {name} {type_}", f"{name} {v}"]
+    return "\n".join(out) + "\n"
+
 # === UTILS ===
+if orjson is not None:
+    jdumps = orjson.dumps
+    jloads = orjson.loads
+else:
+    def jdumps(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    jloads = json.loads
+
 def norm(s: str) -> str:
     s = unicodedata.normalize("NFKC", (s or "")).strip().lower()
     s = s.replace("ё", "е")
     return s
 
-async def tg(method: str, payload: dict):
-    async with httpx.AsyncClient(timeout=20) as cl:
-        r = await cl.post(f"{TG}/{method}", json=payload)
-        r.raise_for_status()
-        return r.json()
+_client: Optional[httpx.AsyncClient] = None
+
+def _new_client() -> httpx.AsyncClient:
+    http2 = TG_HTTP2
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            http2 = False  # без пакета h2 остаёмся на HTTP/1.1
+    limits = httpx.Limits(
+        max_connections=TG_POOL_SIZE,
+        max_keepalive_connections=TG_KEEPALIVE,
+        keepalive_expiry=TG_KEEPALIVE_EXPIRY,
+    )
+    return httpx.AsyncClient(timeout=20, limits=limits, http2=http2)
+
+def tg_client() -> httpx.AsyncClient:
+    # клиент создаётся на старте приложения; лениво — если tg() позвали раньше
+    global _client
+    if _client is None or _client.is_closed:
+        _client = _new_client()
+    return _client
+
+async def close_tg_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+class TelegramError(Exception):
+    # ответ Bot API с ok=false: код, описание и, для 429, сколько ждать
+    def __init__(self, method: str, code: int, description: str, retry_after: Optional[float] = None):
+        super().__init__(f"{method}: {code} {description}")
+        self.method = method
+        self.code = code
+        self.description = description
+        self.retry_after = retry_after
+
+    @property
+    def not_modified(self) -> bool:
+        # правка, которая ничего не меняет — для нас не ошибка
+        return self.code == 400 and "message is not modified" in self.description
+
+def _check_response(method: str, r: httpx.Response):
+    if not r.is_error:
+        return
+    count("bot_tg_errors_total", method, str(r.status_code))
+    try:
+        body = jloads(r.content)
+    except ValueError:
+        body = None
+    if not isinstance(body, dict):
+        body = {}
+    params = body.get("parameters") or {}
+    raise TelegramError(method, body.get("error_code", r.status_code), str(body.get("description", r.reason_phrase)),
+                        params.get("retry_after"))
+
+def retryable(e: Exception) -> bool:
+    # стоит повторить позже: Telegram просит подождать, у него сбой или не дошли по сети
+    if isinstance(e, TelegramError):
+        return e.code == 429 or e.code >= 500
+    return isinstance(e, httpx.TransportError)
+
+# сетевые ошибки, при которых запрос точно не ушёл в Telegram
+_NOT_SENT = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+def retry_safe(method: str, e: Exception) -> bool:
+    # Отправку (send*, edit*…) после обрыва на чтении или таймаута ответа не повторяем:
+    # Telegram мог её уже выполнить, и игрок получил бы то же сообщение дважды.
+    # getUpdates, answerCallbackQuery и прочие повторять можно при любой сетевой ошибке.
+    if not retryable(e):
+        return False
+    if isinstance(e, httpx.TransportError) and not isinstance(e, _NOT_SENT):
+        return not method.startswith(_RATE_LIMITED)
+    return True
+
+class TokenBucket:
+    # rate токенов в секунду, в запасе не больше burst. reserve() забирает токен сразу и возвращает,
+    # сколько ждать до его появления (долг) — ждущие выстраиваются по порядку без отдельной очереди.
+    __slots__ = ("rate", "burst", "tokens", "ts")
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.ts = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.ts) * self.rate)
+        self.ts = now
+
+    def reserve(self) -> float:
+        self._refill()
+        self.tokens -= 1
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def pause(self, seconds: float):
+        # Telegram ответил 429: следующий токен — не раньше чем через seconds
+        self._refill()
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+    def idle(self) -> bool:
+        return self.tokens + (time.monotonic() - self.ts) * self.rate >= self.burst
+
+class OutboundScheduler:
+    # Все отправки (send*/edit*/...) проходят через общий и початовый лимиты; лишнее ждёт своей
+    # очереди, а не сыплется в API. waiting — глубина очереди: вызовы, ждущие токена или повтора.
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: int):
+        self.global_bucket = TokenBucket(global_rate, max(1, int(global_rate))) if global_rate > 0 else None
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._chats: Dict[object, TokenBucket] = {}
+        self._prune_at = 10000
+        self.waiting = 0
+        self.enabled = self.global_bucket is not None or chat_rate > 0
+
+    def _chat(self, chat_id) -> Optional[TokenBucket]:
+        if chat_id is None or self.chat_rate <= 0:
+            return None
+        b = self._chats.get(chat_id)
+        if b is None:
+            if len(self._chats) >= self._prune_at:
+                # полные корзины ничего не помнят — их можно выбросить
+                for k in [k for k, v in self._chats.items() if v.idle()]:
+                    del self._chats[k]
+                self._prune_at = max(10000, 2 * len(self._chats))
+            b = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return b
+
+    async def sleep(self, delay: float):
+        if delay <= 0:
+            return
+        self.waiting += 1
+        try:
+            await asyncio.sleep(delay)
+        finally:
+            self.waiting -= 1
+
+    async def acquire(self, chat_id):
+        b = self._chat(chat_id)
+        delay = b.reserve() if b is not None else 0.0
+        if self.global_bucket is not None:
+            # оба токена резервируем сразу и ждём дольшего из двух
+            delay = max(delay, self.global_bucket.reserve())
+        if delay > 0:
+            observe("bot_stage_seconds", "throttle", delay)
+            await self.sleep(delay)
+
+    def pause(self, chat_id, seconds: float) -> bool:
+        b = self._chat(chat_id) or self.global_bucket
+        if b is None:
+            return False
+        b.pause(seconds)
+        return True
+
+    def stats(self) -> dict:
+        return {"waiting": self.waiting, "chat_buckets": len(self._chats)}
+
+OUTBOX = OutboundScheduler(TG_GLOBAL_RATE, TG_CHAT_RATE, TG_CHAT_BURST)
+# методы, на которые действуют лимиты отправки; answerCallbackQuery, getUpdates и т.п. идут без очереди
+_RATE_LIMITED = ("send", "edit", "copy", "forward")
+
+def _backoff(attempt: int) -> float:
+    return random.uniform(0, min(TG_BACKOFF_MAX, TG_BACKOFF * 2 ** attempt))
+
+async def _tg_call(method: str, chat_id, request: Callable[[], Awaitable[httpx.Response]]):
+    # один вызов Bot API: лимит отправки, запрос, разбор ошибки; 429/5xx/сеть — повтор
+    limited = method.startswith(_RATE_LIMITED)
+    attempt = 0
+    while True:
+        if limited and OUTBOX.enabled:
+            await OUTBOX.acquire(chat_id)
+        t0 = time.perf_counter()
+        try:
+            try:
+                r = await request()
+            except Exception:
+                count("bot_tg_errors_total", method, "error")
+                raise
+            finally:
+                observe("bot_tg_call_seconds", method, time.perf_counter() - t0)
+            _check_response(method, r)
+            return jloads(r.content)
+        except Exception as e:
+            if attempt >= TG_RETRIES or not retry_safe(method, e):
+                raise
+            code = str(e.code) if isinstance(e, TelegramError) else "error"
+            count("bot_tg_retries_total", method, code)
+            attempt += 1
+            if isinstance(e, TelegramError) and e.retry_after:
+                # пауза ложится на лимит чата (или общий), чтобы подождали и остальные отправки туда же
+                if limited and OUTBOX.pause(chat_id, float(e.retry_after)):
+                    continue
+                await OUTBOX.sleep(float(e.retry_after))
+            else:
+                await OUTBOX.sleep(_backoff(attempt - 1))
+
+# Переигровка партий: вызовы Bot API не уходят в сеть, а складываются сюда.
+_sink: ContextVar[Optional[list]] = ContextVar("_sink", default=None)
+
+async def _tg_post(method: str, payload: dict, timeout: Optional[float] = None):
+    sink = _sink.get()
+    if sink is not None:
+        sink.append((method, payload))
+        return {"ok": True, "result": {}}
+    # timeout — для долгих вызовов (getUpdates держит соединение дольше обычных 20 с)
+    extra = {"timeout": timeout} if timeout is not None else {}
+    body = jdumps(payload)
+    return await _tg_call(method, payload.get("chat_id"), lambda: tg_client().post(
+        f"{TG}/{method}", content=body, headers=_JSON_HEADERS, **extra))
+
+# Отложенный вызов текущего апдейта (режим WEBHOOK_REPLY).
+# None — режим выключен; [] — ничего не отложено; [(method, payload)] — отложен один вызов.
+_reply: ContextVar[Optional[list]] = ContextVar("_reply", default=None)
+
+async def _flush_held():
+    held = _reply.get()
+    if not held:
+        return
+    await _tg_post(*held.pop())
+
+async def tg(method: str, payload: dict, timeout: Optional[float] = None):
+    # всё, что было отложено раньше, уходит первым — порядок сообщений сохраняется
+    await _flush_held()
+    return await _tg_post(method, payload, timeout)
+
+async def tg_last(method: str, payload: dict):
+    # Вызов, который может оказаться последним в апдейте: придерживаем его до следующего
+    # вызова или до конца апдейта, чтобы отдать в ответе вебхука. Ошибку такого вызова
+    # мы уже не увидим, поэтому сюда идёт только то, у чего нет запасного пути (текст);
+    # фото по file_id и правки шлются через tg() сразу.
+    held = _reply.get()
+    if held is None:
+        return await tg(method, payload)
+    await _flush_held()
+    held.append((method, payload))
+    return {"ok": True, "result": None}
 
 def kb(rows: List[List[Dict[str, str]]]) -> dict:
     # rows: [[{"text":"...", "data":"..."}], ...]
@@ -42,48 +425,205 @@ def hp_bar(cur: int, mx: int, width: int = 10) -> str:
     filled = int(round(width * (cur / mx if mx else 0)))
     return "█" * filled + "░" * (width - filled)
 
-async def send_text(chat_id: int, text: str, markup: Optional[dict] = None):
+# клавиатура: dict или уже сериализованный JSON (Bot API принимает оба)
+Markup = Union[dict, str]
+
+# Короткие уведомления апдейта («Ты получил…», «…повержен!») не шлём отдельно, а копим и
+# приклеиваем к началу ближайшей подписи или текста; что не поместилось — одним сообщением.
+# None — сборщик не включён (уведомление уходит сразу); список — уведомления, ждущие отправки.
+_notices: ContextVar[Optional[list]] = ContextVar("_notices", default=None)
+CAPTION_MAX = 1024  # лимиты Bot API на подпись к фото и на текст сообщения
+TEXT_MAX = 4096
+
+async def notify(chat_id: int, text: str):
+    pending = _notices.get()
+    if pending is None:
+        await send_text(chat_id, text)
+        return
+    pending.append(text)
+
+async def with_notices(chat_id: int, body: str, limit: int) -> str:
+    pending = _notices.get()
+    if not pending:
+        return body
+    head = "\n\n".join(pending)
+    pending.clear()
+    if len(head) + 2 + len(body) <= limit:
+        return head + "\n\n" + body
+    await tg_last("sendMessage", {"chat_id": chat_id, "text": head, "parse_mode": "Markdown"})
+    return body
+
+async def flush_notices(chat_id: int):
+    # конец апдейта: то, что не прилипло ни к одному сообщению
+    pending = _notices.get()
+    if pending:
+        text = "\n\n".join(pending)
+        pending.clear()
+        await tg_last("sendMessage", {"chat_id": chat_id, "text": text, "parse_mode": "Markdown"})
+
+async def send_text(chat_id: int, text: str, markup: Optional[Markup] = None):
+    text = await with_notices(chat_id, text, TEXT_MAX)
     payload = {"chat_id": chat_id, "text": text, "parse_mode": "Markdown"}
     if markup:
         payload["reply_markup"] = markup
-    await tg("sendMessage", payload)
+    await tg_last("sendMessage", payload)
+
+# === FILE_ID CACHE ===
+# url картинки -> file_id, который Telegram вернул на sendPhoto; повторно картинку не качает
+FILE_IDS: Dict[str, str] = {}
+
+def load_file_ids():
+    try:
+        with open(FILE_ID_CACHE, encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return
+    if isinstance(data, dict):
+        FILE_IDS.update({k: v for k, v in data.items() if isinstance(k, str) and isinstance(v, str)})
+
+_file_ids_lock = asyncio.Lock()
+_file_ids_dirty = False
 
-async def send_photo(chat_id: int, url: str, caption: str, markup: Optional[dict] = None):
-    payload = {"chat_id": chat_id, "photo": url, "caption": caption, "parse_mode": "Markdown"}
+def _write_file_ids(snapshot: Dict[str, str]):
+    tmp = FILE_ID_CACHE + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(snapshot, f, ensure_ascii=False)
+    os.replace(tmp, FILE_ID_CACHE)
+
+async def remember_file_id(url: str, res: Optional[dict]):
+    photos = ((res or {}).get("result") or {}).get("photo") or []
+    if not photos:
+        return
+    fid = photos[-1]["file_id"]  # самый крупный размер
+    if FILE_IDS.get(url) == fid:
+        return
+    FILE_IDS[url] = fid
+    # записи идут по одной (у всех один .tmp); кто дождался замка, пишет самый свежий снимок,
+    # и если его уже записал предыдущий — не пишет ничего
+    global _file_ids_dirty
+    _file_ids_dirty = True
+    async with _file_ids_lock:
+        if not _file_ids_dirty:
+            return
+        _file_ids_dirty = False
+        try:
+            await asyncio.to_thread(_write_file_ids, dict(FILE_IDS))
+        except OSError:
+            pass  # кэш в памяти всё равно работает
+
+def _sent_message_id(res: Optional[dict]) -> Optional[int]:
+    return ((res or {}).get("result") or {}).get("message_id")
+
+async def send_photo(chat_id: int, url: str, caption: str, markup: Optional[Markup] = None) -> Optional[int]:
+    # возвращает message_id отправленного фото (None — ушёл текст или id неизвестен)
+    caption = await with_notices(chat_id, caption, CAPTION_MAX)
+    by_url = {"chat_id": chat_id, "photo": url, "caption": caption, "parse_mode": "Markdown"}
     if markup:
-        payload["reply_markup"] = markup
+        by_url["reply_markup"] = markup
+    fid = FILE_IDS.get(url)
+    if fid:
+        try:
+            return _sent_message_id(await tg("sendPhoto", {**by_url, "photo": fid}))
+        except Exception as e:
+            if retryable(e):
+                raise  # повторы уже исчерпаны — запасной путь упрётся в то же
+            FILE_IDS.pop(url, None)  # file_id перестал работать — шлём по URL и запоминаем новый
+            count("bot_fallbacks_total", "file_id")
     try:
-        await tg("sendPhoto", payload)
-    except Exception:
+        # по URL — всегда отдельным запросом: из ответа берём file_id
+        res = await tg("sendPhoto", by_url)
+        await remember_file_id(url, res)
+        return _sent_message_id(res)
+    except Exception as e:
+        if retryable(e):
+            raise
+        count("bot_fallbacks_total", "photo_text")
         await send_text(chat_id, caption, markup)
-
-# === IMAGES (заменишь свои при желании) ===
-IMG = {
-    "village": "https://images.unsplash.com/photo-1533105079780-92b9be482077",
-    "forest_trail": "https://images.unsplash.com/photo-1500530855697-b586d89ba3ee",
-    "rune_sun": "https://images.unsplash.com/photo-1617191519009-8f6a0c2e6c7f",
-    "leshy": "https://images.unsplash.com/photo-1509043759401-136742328bb3",
-    "herbs": "https://images.unsplash.com/photo-1520256862855-398228c41684",
-    "brew": "https://images.unsplash.com/photo-1556909190-97b8f3f2ab1b",
-    "mist": "https://images.unsplash.com/photo-1504898770365-14faca6f86e1",
-    "onion": "https://images.unsplash.com/photo-1504196606672-aef5c9cefc92",
-    "treasure": "https://images.unsplash.com/photo-1549880338-65ddcdfd017b",
-    "frost": "https://images.unsplash.com/photo-1519681393784-d120267933ba",
-    "forge": "https://images.unsplash.com/photo-1519710164239-da123dc03ef4",
-    "werewolf": "https://images.unsplash.com/photo-1482192505345-5655af888cc4",
-    "scissors": "https://images.unsplash.com/photo-1500021802231-0a1ff452b1d1",
-    "willow": "https://images.unsplash.com/photo-1501785888041-af3ef285b470",
-    "cave": "https://images.unsplash.com/photo-1454179083322-198bb4daae1b",
-    "dark": "https://images.unsplash.com/photo-1454179083322-198bb4daae1b?ix=dark",
-    "wyrm": "https://images.unsplash.com/photo-1469474968028-56623f02e42e",
-    "sphinx": "https://images.unsplash.com/photo-1494738073002-80e2b34f3f49",
-    "altar": "https://images.unsplash.com/photo-1482192505345-5655af888cc4?ix=altar",
-    "finale": "https://images.unsplash.com/photo-1519681393784-d120267933ba?ix=finale",
-    "bad": "https://images.unsplash.com/photo-1518837695005-2083093ee35b"
-}
+        return None
+
+async def edit_photo(chat_id: int, message_id: Optional[int], url: str, caption: str,
+                     markup: Optional[Markup] = None) -> Optional[int]:
+    # Картинка та же (враг в бою) — меняем только подпись и клавиатуру сообщения message_id.
+    # Не вышло (сообщение текстовое, удалено, слишком старое) — отправляем новое фото.
+    # Возвращает id сообщения, в котором теперь подпись, как send_photo.
+    if not message_id:
+        return await send_photo(chat_id, url, caption, markup)
+    caption = await with_notices(chat_id, caption, CAPTION_MAX)
+    payload = {"chat_id": chat_id, "message_id": message_id, "caption": caption, "parse_mode": "Markdown"}
+    if markup:
+        payload["reply_markup"] = markup
+    try:
+        await tg("editMessageCaption", payload)
+        return message_id
+    except Exception as e:
+        if isinstance(e, TelegramError) and e.not_modified:
+            return message_id
+        if retryable(e):
+            raise
+    count("bot_fallbacks_total", "edit")
+    return await send_photo(chat_id, url, caption, markup)
+
+# === ITEMS ===
+# Предметы интернированы: сессия хранит битовую маску id, а не список строк.
+# id должны быть стабильны между перезапусками (маска лежит в хранилище) — новые предметы только в конец.
+# Имя нормализуется (norm) один раз — при регистрации или при первом поиске по этому написанию.
+ITEMS: List[str] = []          # id -> отображаемое имя
+ITEM_IDS: Dict[str, int] = {}  # norm(имя) -> id
+_ITEM_LOOKUP: Dict[str, int] = {}  # имя как написано -> id, только для известных предметов
+
+def find_item(name: str) -> Optional[int]:
+    i = _ITEM_LOOKUP.get(name)
+    if i is None:
+        i = ITEM_IDS.get(norm(name))
+        if i is not None:
+            _ITEM_LOOKUP[name] = i
+    return i
+
+def item_id(name: str) -> int:
+    i = find_item(name)
+    if i is None:
+        i = ITEM_IDS[norm(name)] = _ITEM_LOOKUP[name] = len(ITEMS)
+        ITEMS.append(name)
+    return i
+
+IT_HERBS = item_id("травы")
+IT_POTION = item_id("зелье")
+IT_AMULET = item_id("амулет")
+IT_SILVER = item_id("серебряный клинок")
+IT_TORCH = item_id("факел")
+IT_KEY = item_id("ключ")
+IT_FIRE_SCROLL = item_id("свиток огня")
+IT_MIRROR = item_id("осколок зеркала")
+
+# предмет в have/add_item/drop_item — id из ITEMS или имя
+ItemRef = Union[int, str]
+
+# === SESSION RNG ===
+# У каждой сессии свой поток случайных чисел: splitmix64 по счётчику. Состояние — (seed, rolls),
+# k-е число зависит только от них, так что партию можно переиграть по seed и журналу нажатий.
+_M64 = (1 << 64) - 1
+_GOLDEN64 = 0x9E3779B97F4A7C15
+
+# при переигровке новые сессии (/start, /reset) получают записанный seed, а не случайный
+_replay_seed: ContextVar[Optional[int]] = ContextVar("_replay_seed", default=None)
+
+def fresh_seed() -> int:
+    seed = _replay_seed.get()
+    return random.getrandbits(64) if seed is None else seed
+
+def _mix64(z: int) -> int:
+    z = (z ^ (z >> 30)) * 0xBF58476D1CE4E5B9 & _M64
+    z = (z ^ (z >> 27)) * 0x94D049BB133111EB & _M64
+    return z ^ (z >> 31)
+
+def session_rolls(s: "Session", n: int) -> List[float]:
+    # n равномерных чисел в [0, 1) из потока сессии
+    k = s.rolls
+    s.rolls += n
+    return [(_mix64((s.seed + (k + i + 1) * _GOLDEN64) & _M64) >> 11) * (1.0 / (1 << 53)) for i in range(n)]
 
 # === GAME DATA ===
-@dataclass
+@dataclass(slots=True)
 class Combat:
     enemy: str
     max_hp: int
@@ -99,7 +639,7 @@ class Combat:
     # особенность (модификаторы)
     trait: Optional[str] = None  # 'needs_silver', 'weak_to_igni', 'stuns_with_amulet', 'weak_to_aard'
 
-@dataclass
+@dataclass(slots=True)
 class Session:
     max_hp: int = 50
     hp: int = 50
@@ -107,707 +647,1536 @@ class Session:
     xp: int = 0
     dmg_min: int = 6
     dmg_max: int = 12
+    # боевые статусы
     yrden_turns: int = 0
+    poison_turns: int = 0
     _axii_last_success: bool = False
     _burned_item_last: str = ""
     location: str = "intro"
-    inventory: List[str] = field(default_factory=list)
+    # инвентарь — битовая маска по ITEMS
+    inv: int = 0
     finished: bool = False
     # активный бой
     combat: Optional[Combat] = None
     # единоразовое спасение от летального удара
     fate: int = 1
-
-SESS: Dict[int, Session] = {}
+    # свой генератор случайных чисел (см. SESSION RNG)
+    seed: int = field(default_factory=fresh_seed)
+    rolls: int = 0
+    # кнопки (компактный callback_data) и /start, /reset с момента создания сессии,
+    # через b"\n" — в таком виде журнал и ложится в упакованную запись
+    actions: bytearray = field(default_factory=bytearray)
+    actions_n: int = 0  # сколько записей в actions, чтобы не считать разделители
+    actions_cut: bool = False  # журнал упёрся в ACTION_LOG_MAX — переиграть уже нельзя
+    # сообщение текущего боя, которое правят ходы (0 — неизвестно); в хранилище не пишется:
+    # после перезапуска первый ход просто пришлёт новое фото
+    combat_msg: int = 0
+
+    @property
+    def inventory(self) -> List[str]:
+        return [name for i, name in enumerate(ITEMS) if self.inv >> i & 1]
+
+class SessionCache:
+    # LRU по последнему обращению + вытеснение простаивающих дольше ttl.
+    # Счётчики hits/misses ведёт только get() — им пользуется загрузка сессии на входе апдейта.
+    # busy(uid) — сессию сейчас меняет апдейт: такую не вытесняем, иначе обработчик допишет
+    # изменения в объект, которого уже нет в кэше, и они потеряются.
+    def __init__(self, max_size: int, ttl: float, on_evict: Optional[Callable[[int, Session], None]] = None,
+                 busy: Optional[Callable[[int], bool]] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.busy = busy
+        self._d: "OrderedDict[int, Session]" = OrderedDict()
+        self._seen: Dict[int, float] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, uid: int, default: Optional[Session] = None) -> Optional[Session]:
+        s = self._d.get(uid)
+        if s is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._touch(uid)
+        return s
+
+    def __getitem__(self, uid: int) -> Session:
+        return self._d[uid]
+
+    def __contains__(self, uid: int) -> bool:
+        return uid in self._d
+
+    def __len__(self) -> int:
+        return len(self._d)
+
+    def values(self):
+        return self._d.values()
+
+    def pop(self, uid: int) -> Session:
+        self._seen.pop(uid, None)
+        return self._d.pop(uid)
+
+    def __setitem__(self, uid: int, s: Session):
+        self._d[uid] = s
+        self._touch(uid)
+        over = len(self._d) - self.max_size
+        if over > 0:
+            # самые давние — в начале; занятые пропускаем (кэш ненадолго может стать больше max_size)
+            victims = []
+            for old in self._d:
+                if not (self.busy and self.busy(old)):
+                    victims.append(old)
+                    if len(victims) == over:
+                        break
+            for old in victims:
+                self._evict(old, self._d.pop(old))
+
+    def setdefault(self, uid: int, s: Session) -> Session:
+        cur = self._d.get(uid)
+        if cur is not None:
+            return cur
+        self[uid] = s
+        return s
+
+    def _touch(self, uid: int):
+        self._d.move_to_end(uid)
+        self._seen[uid] = time.monotonic()
+
+    def _evict(self, uid: int, s: Session):
+        self._seen.pop(uid, None)
+        self.evictions += 1
+        if self.on_evict:
+            self.on_evict(uid, s)
+
+    def sweep(self) -> int:
+        # порядок в _d — по последнему обращению, так что простаивающие всегда в начале
+        deadline = time.monotonic() - self.ttl
+        victims = []
+        for uid in self._d:
+            if self._seen.get(uid, 0) > deadline:
+                break
+            if not (self.busy and self.busy(uid)):
+                victims.append(uid)
+        for uid in victims:
+            self._evict(uid, self._d.pop(uid))
+        return len(victims)
+
+    def stats(self) -> dict:
+        return {"size": len(self._d), "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+SESS = SessionCache(SESSION_CACHE_MAX, SESSION_IDLE_TTL)
 
 def sget(uid: int) -> Session:
-    if uid not in SESS:
-        SESS[uid] = Session()
-    return SESS[uid]
-
-def have(s: Session, item: str) -> bool:
-    n = norm(item)
-    return any(norm(x) == n for x in s.inventory)
-
-def add_item(s: Session, item: str):
-    if not have(s, item):
-        s.inventory.append(item)
-
-# === NODES ===
-NODES = {
-    "intro": {
-        "img": IMG["village"],
-        "text": (
-            "🛡 *Коловрат — ведьмак Древней Руси*\n\n"
-            "Тебя призвали в северный уезд: ночью в лесу шепчут огоньки, в деревне пропадают люди, "
-            "на болоте воет Волколак, а в каменных кругах стынет Морозница. Коловоротный амулет старцев "
-            "обещает дорогу к алтарю, где скрыта причина беды. Пройди тропы, избы, курганы, святилища и пещеры, "
-            "сразись с чудовищами, разгадай руны и собери то, что поможет выжить. На алтаре завершится круг — и зло падёт.\n\n"
-            "У тебя 50 жизней. Всё управление — *кнопками*. Подсказки появляются по запросу.\n"
-            "Готов начать путь?"
-        ),
-        "buttons": [
-            [{"text": "В путь", "to": "trail"}, {"text": "Подсказка", "hint": "След держись ближе к деревне, затем уходи на северную тропу."}]
-        ]
-    },
-
-    "trail": {
-        "img": IMG["forest_trail"],
-        "text": "🌲 Тропа у кромки леса. Следы ведут в чащу. Куда идти?",
-        "buttons": [
-            [{"text": "Налево (к рунам)", "to": "rune_sun"}, {"text": "Направо (к болотам)", "to": "willow_lights"}],
-            [{"text": "Подсказка", "hint": "Леший любит тьму — сперва найди то, что её режет."}]
-        ]
-    },
-
-    "rune_sun": {
-        "img": IMG["rune_sun"],
-        "text": "☀️ Камень с руной. Надпись: «То, что режет тьму».",
-        "buttons": [
-            [{"text": "Свет", "to": "leshy_spawn"}, {"text": "Нож", "to": "punish_back_trail"}, {"text": "Ветер", "to": "punish_back_trail"}],
-            [{"text": "Подсказка", "hint": "Ответ — то, что невозможно заточить."}]
-        ]
-    },
-
-    "punish_back_trail": {
-        "img": IMG["bad"],
-        "text": "Ты оступился — нечисть шепчет в темноте. −1 жизнь.",
-        "hp_delta": -1,
-        "buttons": [
-            [{"text": "Вернуться к тропе", "to": "trail"}]
-        ]
-    },
-
-    "leshy_spawn": {
-        "img": IMG["leshy"],
-        "text": "🌿 В чаще выходит Леший. Ветви шевелятся.",
-        "combat": Combat(
-            enemy="Леший",
-            max_hp=60, hp=60, img=IMG["leshy"],
-            dmg_min=1, dmg_max=3,
-            hint="Огонь против древних — сила. Знак *Игни* жжёт кору.",
-            win_to="herb_patch",
-            trait="weak_to_igni"
-        )
-    },
-
-    "herb_patch": {
-        "img": IMG["herbs"],
-        "text": "🌾 Поляна трав. Сорвёшь немного?",
-        "buttons": [
-            [{"text": "Взять травы", "data": "take:травы:brew_hut"}],
-            [{"text": "Идти дальше без трав", "to": "mist_wraith"}],
-            [{"text": "Подсказка", "hint": "Травы пригодятся, чтобы сварить зелье перед туманником."}]
-        ]
-    },
-
-    "brew_hut": {
-        "img": IMG["brew"],
-        "text": "🧪 В старой избе можно сварить зелье.",
-        "buttons": [
-            [{"text": "Сварить зелье", "data": "brew:зелье:mist_wraith"}],
-            [{"text": "Выйти без зелья", "to": "mist_wraith"}]
-        ]
-    },
-
-    "mist_wraith": {
-        "img": IMG["mist"],
-        "text": "💨 В тумане мерцает туманник — бьёт из засады.",
-        "combat": Combat(
-            enemy="Туманник",
-            max_hp=70, hp=70, img=IMG["mist"],
-            dmg_min=1, dmg_max=2,
-            hint="Зелье повышает устойчивость. Огонь работает, но слабее, чем по лешему.",
-            win_to="onion_riddle"
-        )
-    },
-
-    "onion_riddle": {
-        "img": IMG["onion"],
-        "text": "🧩 «Сидит дед, во сто шуб одет».",
-        "buttons": [
-            [{"text": "Лук", "to": "amulet_room"}, {"text": "Капуста", "to": "punish_back_trail"}],
-            [{"text": "Подсказка", "hint": "Его чистят до слёз."}]
-        ]
-    },
-
-    "amulet_room": {
-        "img": IMG["treasure"],
-        "text": "🪬 На пьедестале — коловоротный амулет.",
-        "buttons": [
-            [{"text": "Взять амулет", "data": "take:амулет:frost_circles"}],
-            [{"text": "Оставить и идти дальше", "to": "frost_circles"}]
-        ]
-    },
-
-    "frost_circles": {
-        "img": IMG["frost"],
-        "text": "❄️ Каменные круги — Морозница витает над льдом.",
-        "combat": Combat(
-            enemy="Морозница",
-            max_hp=85, hp=85, img=IMG["frost"],
-            dmg_min=2, dmg_max=3,
-            hint="Амулет помогает отбить холод: используйте его в бою.",
-            win_to="forge"
-        )
-    },
-
-    "forge": {
-        "img": IMG["forge"],
-        "text": "⚒️ В пустой кузне наковальня мерцает. Возьмёшь клинок?",
-        "buttons": [
-            [{"text": "Взять серебряный клинок", "data": "take:серебряный клинок:werewolf"}],
-            [{"text": "Оставить и идти дальше", "to": "werewolf"}]
-        ]
-    },
-
-    "werewolf": {
-        "img": IMG["werewolf"],
-        "text": "🐺 Из кургана выходит Волколак.",
-        "combat": Combat(
-            enemy="Волколак",
-            max_hp=100, hp=100, img=IMG["werewolf"],
-            dmg_min=2, dmg_max=4,
-            hint="Серебряный клинок рвёт плоть чудовища куда сильнее.",
-            win_to="scissors_riddle",
-            trait="needs_silver"
-        )
-    },
-
-    "scissors_riddle": {
-        "img": IMG["scissors"],
-        "text": "✂️ «Два кольца, два конца, посредине гвоздик».",
-        "buttons": [
-            [{"text": "Ножницы", "to": "bog_willows"}, {"text": "Клещи", "to": "punish_back_trail"}, {"text": "Очки", "to": "punish_back_trail"}],
-            [{"text": "Подсказка", "hint": "Ею режут ткань, бумагу."}]
-        ]
-    },
-
-    "willow_lights": {
-        "img": IMG["willow"],
-        "text": "🔵 Болотные огоньки манят прочь от тропы.",
-        "buttons": [
-            [{"text": "Вернуться", "to": "trail"}, {"text": "Идти на огни (опасно)", "to": "punish_back_trail"}],
-            [{"text": "Подсказка", "hint": "Огоньки заводят путников на гибель."}]
-        ]
-    },
-
-    "bog_willows": {
-        "img": IMG["cave"],
-        "text": "🔥 Вход в пещеру. У стены — факел.",
-        "buttons": [
-            [{"text": "Взять факел", "data": "take:факел:dark_tunnel"}],
-            [{"text": "Идти без факела", "to": "dark_tunnel"}]
-        ]
-    },
-
-    "dark_tunnel": {
-        "img": IMG["dark"],
-        "text": "🌑 Ходы уходят во тьму. Чем осветишь путь?",
-        "buttons": [
-            [{"text": "Зажечь факел", "to": "wyrm_lair"}],
-            [{"text": "Идти наощупь (опасно)", "to": "punish_back_trail"}]
-        ]
-    },
-
-    "wyrm_lair": {
-        "img": IMG["wyrm"],
-        "text": "🐉 Под сводом шевелится змей.",
-        "combat": Combat(
-            enemy="Змей",
-            max_hp=90, hp=90, img=IMG["wyrm"],
-            dmg_min=2, dmg_max=3,
-            hint="Знак *Аард* (ветер) сбивает чудовище.",
-            win_to="sphinx_riddle",
-            trait="weak_to_aard"
+    s = SESS[uid] if uid in SESS else None
+    if s is None:
+        s = SESS[uid] = Session()
+    return s
+
+# === SESSION STORE ===
+# SESS — горячий кэш в памяти. Хранилище читается только при промахе кэша, а пишется
+# фоновой задачей пачками (write-behind): в обработке апдейта синхронной записи на диск нет.
+# Упакованный формат: версия, числовые поля, seed и счётчик генератора, маска инвентаря
+# (байт длины и сами байты — предметов может быть больше 64), затем ключ локации (utf-8 с длиной),
+# если идёт бой — hp/max_hp врага, и журнал нажатий (через "\n", с длиной).
+# Остальное о враге берётся из шаблона GRAPH[location].
+# Версии 1 (без генератора и журнала) и 2 (маска — ровно 64 бита) ещё читаются.
+PACK_VERSION = 3
+_PACK_HEAD = struct.Struct("<BhhHIhhBBBBhBQQB")
+_PACK_HEAD_V2 = struct.Struct("<BhhHIhhBBBBQbBQQ")
+_PACK_HEAD_V1 = struct.Struct("<BhhHIhhBBBBQbB")
+_PACK_COMBAT = struct.Struct("<hh")
+_PACK_LOG = struct.Struct("<I")
+_F_FINISHED, _F_AXII, _F_COMBAT, _F_ACTIONS_CUT = 1, 2, 4, 8
+
+def pack_session(s: Session) -> bytes:
+    loc = s.location.encode("utf-8")
+    flags = (_F_FINISHED if s.finished else 0) | (_F_AXII if s._axii_last_success else 0) \
+        | (_F_COMBAT if s.combat else 0) | (_F_ACTIONS_CUT if s.actions_cut else 0)
+    burned = find_item(s._burned_item_last) if s._burned_item_last else None
+    burned = -1 if burned is None else burned
+    inv = s.inv.to_bytes((s.inv.bit_length() + 7) // 8, "little")
+    out = _PACK_HEAD.pack(
+        PACK_VERSION, s.max_hp, s.hp, s.level, s.xp, s.dmg_min, s.dmg_max,
+        s.yrden_turns, s.poison_turns, s.fate, flags, burned, len(loc), s.seed, s.rolls, len(inv),
+    ) + inv + loc
+    if s.combat:
+        out += _PACK_COMBAT.pack(s.combat.hp, s.combat.max_hp)
+    return out + _PACK_LOG.pack(len(s.actions)) + s.actions
+
+def unpack_session(data: bytes) -> Session:
+    ver = data[0] if data else None
+    if ver == PACK_VERSION:
+        (_, max_hp, hp, level, xp, dmg_min, dmg_max, yrden, poison, fate, flags, burned,
+         loc_len, seed, rolls, inv_len) = _PACK_HEAD.unpack_from(data)
+        pos = _PACK_HEAD.size
+        inv = int.from_bytes(data[pos:pos + inv_len], "little")
+        pos += inv_len
+    elif ver == 2:
+        (_, max_hp, hp, level, xp, dmg_min, dmg_max, yrden, poison, fate, flags, inv, burned,
+         loc_len, seed, rolls) = _PACK_HEAD_V2.unpack_from(data)
+        pos = _PACK_HEAD_V2.size
+    elif ver == 1:
+        (_, max_hp, hp, level, xp, dmg_min, dmg_max, yrden, poison, fate, flags, inv, burned,
+         loc_len) = _PACK_HEAD_V1.unpack_from(data)
+        seed, rolls = fresh_seed(), 0
+        flags |= _F_ACTIONS_CUT  # истории до перехода на версию 2 нет
+        pos = _PACK_HEAD_V1.size
+    else:
+        raise ValueError(f"unknown session format {ver}")
+    location = data[pos:pos + loc_len].decode("utf-8")
+    pos += loc_len
+    s = Session(
+        max_hp=max_hp, hp=hp, level=level, xp=xp, dmg_min=dmg_min, dmg_max=dmg_max,
+        yrden_turns=yrden, poison_turns=poison, location=location, inv=inv, fate=fate,
+        finished=bool(flags & _F_FINISHED), _axii_last_success=bool(flags & _F_AXII),
+        _burned_item_last=ITEMS[burned] if 0 <= burned < len(ITEMS) else "",
+        seed=seed, rolls=rolls, actions_cut=bool(flags & _F_ACTIONS_CUT),
+    )
+    node = GRAPH.get(location)
+    tpl = node.combat if node else None
+    if flags & _F_COMBAT:
+        c_hp, c_max = _PACK_COMBAT.unpack_from(data, pos)
+        pos += _PACK_COMBAT.size
+        if tpl is not None:
+            s.combat = Combat(**asdict(tpl))
+            s.combat.hp, s.combat.max_hp = c_hp, c_max
+    if ver >= 2:
+        (log_len,) = _PACK_LOG.unpack_from(data, pos)
+        pos += _PACK_LOG.size
+        s.actions = bytearray(data[pos:pos + log_len])
+        s.actions_n = s.actions.count(b"\n") + 1 if s.actions else 0
+    return s
+
+class MemoryStore:
+    def __init__(self):
+        self._rows: Dict[int, bytes] = {}
+
+    def load(self, uid: int) -> Optional[bytes]:
+        return self._rows.get(uid)
+
+    def save_many(self, rows: List[Tuple[int, bytes]]):
+        self._rows.update(rows)
+
+    def uids(self) -> List[int]:
+        return list(self._rows)
+
+    def close(self):
+        pass
+
+class SQLiteStore:
+    # одно соединение на процесс; вызывается из потоков asyncio.to_thread, поэтому под замком
+    def __init__(self, path: str):
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions (uid INTEGER PRIMARY KEY, data BLOB NOT NULL)"
         )
-    },
-
-    "sphinx_riddle": {
-        "img": IMG["sphinx"],
-        "text": "🧠 «Утром на четырёх, днём на двух, вечером на трёх».",
-        "buttons": [
-            [{"text": "Человек", "to": "altar"}, {"text": "Конь", "to": "punish_back_trail"}, {"text": "Старик", "to": "punish_back_trail"}],
-            [{"text": "Подсказка", "hint": "Речь о жизни от младенца до старости."}]
-        ]
-    },
-
-    "altar": {
-        "img": IMG["altar"],
-        "text": "⛨ У алтаря ты должен произнести слово силы.",
-        "buttons": [
-            [{"text": "Произнести «Коловрат»", "to": "finale"}],
-            [{"text": "Подсказка", "hint": "Круг, вращение, защита — символ рода."}]
-        ]
-    },
-
-    "finale": {
-        "img": IMG["finale"],
-        "text": "🏁 Зло рассеяно. Ты получаешь трофей и славу.\nХочешь снова? Нажми «Начать заново».",
-        "buttons": [
-            [{"text": "Начать заново", "to": "intro"}]
-        ]
-    },
+
+    def load(self, uid: int) -> Optional[bytes]:
+        with self._lock:
+            row = self._db.execute("SELECT data FROM sessions WHERE uid = ?", (uid,)).fetchone()
+        return row[0] if row else None
+
+    def uids(self) -> List[int]:
+        with self._lock:
+            return [r[0] for r in self._db.execute("SELECT uid FROM sessions ORDER BY uid")]
+
+    def save_many(self, rows: List[Tuple[int, bytes]]):
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                self._db.executemany("INSERT OR REPLACE INTO sessions (uid, data) VALUES (?, ?)", rows)
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+SESSION_STORES = {
+    "sqlite": lambda: SQLiteStore(SESSION_DB),
+    "memory": MemoryStore,
 }
 
+_store = None
+
+def session_store():
+    global _store
+    if _store is None:
+        if SESSION_BACKEND not in SESSION_STORES:
+            raise RuntimeError(f"unknown SESSION_BACKEND: {SESSION_BACKEND}")
+        _store = SESSION_STORES[SESSION_BACKEND]()
+    return _store
+
+_dirty: set = set()
+# вытесненные из кэша, но ещё не записанные сессии (uid -> упакованная сессия)
+_spilled: Dict[int, bytes] = {}
+# uid, чья запись в хранилище не читается (неизвестная версия после отката, баг упаковки):
+# игрок получает новую сессию, но она не сохраняется, чтобы не затереть старую запись
+_unreadable: set = set()
+
+def mark_dirty(uid: int):
+    if uid not in _unreadable:
+        _dirty.add(uid)
+
+def _spill(uid: int, s: Session):
+    # несохранённые изменения вытесненной сессии не теряем — их запишет ближайший сброс
+    if uid in _dirty:
+        _dirty.discard(uid)
+        if SESSION_SPILL:
+            data = _pack_or_none(s)
+            if data is not None:
+                _spilled[uid] = data
+
+def _pack_or_none(s: Session) -> Optional[bytes]:
+    # сессия, которую не удалось упаковать, не должна мешать сохранить остальные
+    try:
+        return pack_session(s)
+    except (struct.error, ValueError, OverflowError):
+        count("bot_session_pack_errors_total")
+        return None
+
+SESS.on_evict = _spill
+
+async def sload(uid: int) -> Session:
+    # как sget, но при промахе кэша поднимает сессию из хранилища (чтение — в потоке)
+    s = SESS.get(uid)
+    if s is not None:
+        return s
+    data = _spilled.get(uid) if SESSION_SPILL else None
+    if data is None:
+        data = await asyncio.to_thread(session_store().load, uid)
+    loaded = Session()
+    if data:
+        try:
+            loaded = unpack_session(data)
+        except Exception as e:
+            if uid not in _unreadable:
+                _unreadable.add(uid)
+                count("bot_session_load_errors_total")
+                print(f"session {uid}: unreadable record kept as is ({e!r})")
+    return SESS.setdefault(uid, loaded)
+
+async def flush_sessions() -> int:
+    if not _dirty and not _spilled:
+        return 0
+    uids = list(_dirty)
+    _dirty.clear()
+    spilled = dict(_spilled)
+    # снимок делаем в цикле событий, пишем — в потоке
+    rows = list(spilled.items())
+    for uid in uids:
+        data = _pack_or_none(SESS[uid]) if uid in SESS else None
+        if data is not None:
+            rows.append((uid, data))
+    try:
+        await asyncio.to_thread(session_store().save_many, rows)
+    except Exception:
+        _dirty.update(uid for uid in uids if uid in SESS)
+        raise
+    for uid, data in spilled.items():
+        if _spilled.get(uid) is data:
+            del _spilled[uid]
+    return len(rows)
+
+async def _session_flusher():
+    while True:
+        await asyncio.sleep(SESSION_FLUSH_SEC)
+        SESS.sweep()
+        try:
+            await flush_sessions()
+        except Exception:
+            pass  # попробуем на следующем тике
 
-# === EXPANSION: images & new nodes ===
-IMG.update({
-    "ruins": "https://images.unsplash.com/photo-1483721310020-03333e577078",
-    "idol": "https://images.unsplash.com/photo-1523419409543-1882bd33f2e0",
-    "witch": "https://images.unsplash.com/photo-1526318472351-c75fcf070305",
-    "bog2": "https://images.unsplash.com/photo-1533587851505-d119e13fa0d7",
-    "shadow": "https://images.unsplash.com/photo-1506744038136-46273834b3fb",
-    "ognevic": "https://images.unsplash.com/photo-1519681393784-d120267933ba",
-    "cave": "https://images.unsplash.com/photo-1507502707541-f369a3b18502",
-    "serpent": "https://images.unsplash.com/photo-1515548212256-91d67ea4b222",
-    "ghost": "https://images.unsplash.com/photo-1514511542222-1f2fc2d6a2fa",
-    "ghoul": "https://images.unsplash.com/photo-1500530855697-b586d89ba3ee",
-    "crypt": "https://images.unsplash.com/photo-1482192596544-9eb780fc7f66",
-    "ruins_inner": "https://images.unsplash.com/photo-1549880338-65ddcdfd017b",
-})
-
-NEW_NODES = {
-    "ruins_path": {
-        "img": IMG["ruins"],
-        "text": "🏚 *Старая дорога к руинам.*\n\nДорога уходит в каменистый яр, где когда-то стоял храм. На мшистых плитах — следы от копыт и круги, будто кто-то двигал камни.",
-        "buttons": [
-            [{"text": "К воротам руин", "to": "ruins_gate"}],
-            [{"text": "Вернуться к тропе", "to": "trail"}]
-        ]
-    },
-    "ruins_gate": {
-        "img": IMG["idol"],
-        "text": "🗿 *Каменный идол у ворот.*\n\nЛицо без глаз, рот — щель. Слышен низкий гул: идол оживает.",
-        "combat": Combat(enemy="Каменный идол", max_hp=110, hp=110, img=IMG["idol"], dmg_min=3, dmg_max=8, hint="Камень терпелив, но боится огня. Игни прожигает трещины.", win_to="ruins_inner", trait="stone_skin"),
-        "buttons": [
-            [{"text": "Удар", "data": "fight:hit"}, {"text": "Игни", "data": "fight:igni"}],
-            [{"text": "Аард", "data": "fight:aard"}, {"text": "Квен", "data": "fight:quen"}],
-            [{"text": "Ирден", "data": "fight:yrden"}, {"text": "Аксий", "data": "fight:axii"}],
-            [{"text": "Выпить зелье", "data": "fight:potion"}, {"text": "Показать амулет", "data": "fight:amulet"}],
-            [{"text": "Подсказка", "data": "hint:combat"}],
-        ]
-    },
-    "ruins_inner": {
-        "img": IMG["ruins_inner"],
-        "text": "🏛 *Внутренние залы руин.*\n\nПыльные колонны, шёпот сквозняка, на плитах — руны старцев. В нишах — разбитые сосуды, в углу — следы костра и кости мелких зверей.",
-        "buttons": [
-            [{"text": "🔍 Осмотреть руны", "to": "ruins_riddle"}],
-            [{"text": "Идти к белой ведьме", "to": "white_witch_spawn"}],
-            [{"text": "Вернуться к тропе", "to": "trail"}]
-        ]
-    },
-    "ruins_riddle": {
-        "img": IMG["ruins_inner"],
-        "text": "На плите выгравировано: «Что утром на четырёх, днём на двух, вечером на трёх?»",
-        "buttons": [
-            [{"text": "Человек", "to": "ruins_riddle_right"}],
-            [{"text": "Волк", "to": "ruins_riddle_wrong"}],
-            [{"text": "Идол", "to": "ruins_riddle_wrong"}]
-        ]
-    },
-    "ruins_riddle_right": {
-        "img": IMG["ruins_inner"],
-        "text": "Руны теплеют. В нише щёлкнуло.",
-        "buttons": [
-            [{"text": "Взять ключ", "data": "take:ключ:white_witch_spawn"}]
-        ]
-    },
-    "ruins_riddle_wrong": {
-        "img": IMG["ruins_inner"],
-        "text": "Плита дёрнулась — камень ударил по ноге.",
-        "hp_delta": -10,
-        "buttons": [
-            [{"text": "Отойти к залу", "to": "ruins_inner"}]
-        ]
-    },
-    "white_witch_spawn": {
-        "img": IMG["witch"],
-        "text": "👻 *Ведьма в белом* выходит из тени колонны. Шепчет — и холод поднимается по спине.",
-        "combat": Combat(enemy="Ведьма в белом", max_hp=80, hp=80, img=IMG["witch"], dmg_min=3, dmg_max=7, hint="Страх стягивает грудь. Поможет Аксий или решительный удар.", win_to="bog_path", trait="fear"),
-        "buttons": [
-            [{"text": "Удар", "data": "fight:hit"}, {"text": "Игни", "data": "fight:igni"}],
-            [{"text": "Аард", "data": "fight:aard"}, {"text": "Квен", "data": "fight:quen"}],
-            [{"text": "Ирден", "data": "fight:yrden"}, {"text": "Аксий", "data": "fight:axii"}],
-            [{"text": "Выпить зелье", "data": "fight:potion"}, {"text": "Показать амулет", "data": "fight:amulet"}],
-            [{"text": "Подсказка", "data": "hint:combat"}],
-        ]
-    },
-    "bog_path": {
-        "img": IMG["bog2"],
-        "text": "🌫 *Глубокое болото.*\n\nОгни мерцают между кочками, тростник шепчет. Вязкая тропа уводит всё дальше.",
-        "buttons": [
-            [{"text": "🛶 Помочь старику переправить лодку", "to": "bog_oldman"}],
-            [{"text": "Пройти мимо", "to": "bog_shadow_spawn"}],
-            [{"text": "К шепчущему огню", "to": "ognevic_spawn"}],
-            [{"text": "Назад к развилке", "to": "trail"}]
-        ]
-    },
-    "bog_oldman": {
-        "img": IMG["bog2"],
-        "text": "Старик кивает и благодарит. Но силы уходит на вёсла.",
-        "hp_delta": -10,
-        "buttons": [
-            [{"text": "Получить зелье и идти дальше", "data": "take:зелье:bog_shadow_spawn"}]
-        ]
-    },
-    "bog_shadow_spawn": {
-        "img": IMG["shadow"],
-        "text": "🕯 *Болотная тень* выплывает из тумана, шевелясь, как дым.",
-        "combat": Combat(enemy="Болотная тень", max_hp=70, hp=70, img=IMG["shadow"], dmg_min=2, dmg_max=6, hint="Тень ускользает — попадать сложно. Аард срывает маску.", win_to="cave_entrance", trait="evasive"),
-        "buttons": [
-            [{"text": "Удар", "data": "fight:hit"}, {"text": "Игни", "data": "fight:igni"}],
-            [{"text": "Аард", "data": "fight:aard"}, {"text": "Квен", "data": "fight:quen"}],
-            [{"text": "Ирден", "data": "fight:yrden"}, {"text": "Аксий", "data": "fight:axii"}],
-            [{"text": "Выпить зелье", "data": "fight:potion"}, {"text": "Показать амулет", "data": "fight:amulet"}],
-            [{"text": "Подсказка", "data": "hint:combat"}],
-        ]
-    },
-    "ognevic_spawn": {
-        "img": IMG["ognevic"],
-        "text": "🔥 *Огневик* вспыхивает прямо из трясины, сжигая тростник, жар обжигает лицо.",
-        "combat": Combat(enemy="Огневик", max_hp=85, hp=85, img=IMG["ognevic"], dmg_min=3, dmg_max=9, hint="Огонь не терпит пустоты. Аард срывает языки пламени.", win_to="cave_entrance", trait="burn_items"),
-        "buttons": [
-            [{"text": "Удар", "data": "fight:hit"}, {"text": "Игни", "data": "fight:igni"}],
-            [{"text": "Аард", "data": "fight:aard"}, {"text": "Квен", "data": "fight:quen"}],
-            [{"text": "Ирден", "data": "fight:yrden"}, {"text": "Аксий", "data": "fight:axii"}],
-            [{"text": "Выпить зелье", "data": "fight:potion"}, {"text": "Показать амулет", "data": "fight:amulet"}],
-            [{"text": "Подсказка", "data": "hint:combat"}],
-        ]
-    },
-    "cave_entrance": {
-        "img": IMG["cave"],
-        "text": "🕳 *Вход в пещеру.*\n\nХолодный воздух тянет снизу. Стены изрезаны, будто когтями. Где-то глубже капает вода.",
-        "buttons": [
-            [{"text": "🪨 Осмотреть стену (свиток огня)", "to": "cave_scroll"}],
-            [{"text": "👂 Прислушаться к эху", "to": "cave_echo"}],
-            [{"text": "Спуститься ниже", "to": "serpent_spawn"}],
-            [{"text": "Ответвление к нише", "to": "ghost_spawn"}],
-            [{"text": "Вернуться к болоту", "to": "bog_path"}]
-        ]
-    },
-    "cave_scroll": {
-        "img": IMG["cave"],
-        "text": "В трещине стены спрятан свиток.",
-        "buttons": [
-            [{"text": "Взять свиток огня", "data": "take:свиток огня:cave_entrance"}]
-        ]
-    },
-    "cave_echo": {
-        "img": IMG["cave"],
-        "text": "Эхо шепчет: «Что тяжелее — пуд ваты или пуд железа?»",
-        "buttons": [
-            [{"text": "Одинаково", "to": "echo_right"}],
-            [{"text": "Железо", "to": "echo_wrong"}]
-        ]
-    },
-    "echo_right": {
-        "img": IMG["cave"],
-        "text": "Голос одобряет. ты чувствуешь прилив сил.",
-        "hp_delta": +5,
-        "buttons": [
-            [{"text": "Вернуться к развилке", "to": "cave_entrance"}]
-        ]
-    },
-    "echo_wrong": {
-        "img": IMG["cave"],
-        "text": "Эхо смеётся и гасит факел.",
-        "hp_delta": -5,
-        "buttons": [
-            [{"text": "Вернуться к развилке", "to": "cave_entrance"}]
-        ]
-    },
-    "serpent_spawn": {
-        "img": IMG["serpent"],
-        "text": "🐍 *Змей трёхглавый* извивается, каждая голова шипит по-своему.",
-        "combat": Combat(enemy="Змей трёхглавый", max_hp=120, hp=120, img=IMG["serpent"], dmg_min=3, dmg_max=8, hint="Руби быстро — головы промахиваются, но если попадут — будет больно.", win_to="crypt_hall", trait="double_strike"),
-        "buttons": [
-            [{"text": "Удар", "data": "fight:hit"}, {"text": "Игни", "data": "fight:igni"}],
-            [{"text": "Аард", "data": "fight:aard"}, {"text": "Квен", "data": "fight:quen"}],
-            [{"text": "Ирден", "data": "fight:yrden"}, {"text": "Аксий", "data": "fight:axii"}],
-            [{"text": "Выпить зелье", "data": "fight:potion"}, {"text": "Показать амулет", "data": "fight:amulet"}],
-            [{"text": "Подсказка", "data": "hint:combat"}],
-        ]
-    },
-    "ghost_spawn": {
-        "img": IMG["ghost"],
-        "text": "⚰️ *Призрак воина* выходит из тьмы ниши, шепчет древние клятвы.",
-        "combat": Combat(enemy="Призрак воина", max_hp=75, hp=75, img=IMG["ghost"], dmg_min=2, dmg_max=7, hint="Ему не по душе грубая сила. Заклинания и амулет помогут.", win_to="crypt_hall", trait="reflect"),
-        "buttons": [
-            [{"text": "Удар", "data": "fight:hit"}, {"text": "Игни", "data": "fight:igni"}],
-            [{"text": "Аард", "data": "fight:aard"}, {"text": "Квен", "data": "fight:quen"}],
-            [{"text": "Ирден", "data": "fight:yrden"}, {"text": "Аксий", "data": "fight:axii"}],
-            [{"text": "Выпить зелье", "data": "fight:potion"}, {"text": "Показать амулет", "data": "fight:amulet"}],
-            [{"text": "Подсказка", "data": "hint:combat"}],
-        ]
-    },
-    "crypt_hall": {
-        "img": IMG["crypt"],
-        "text": "🕯 *Зал крипты.*\n\nСвечи стекли в каменные чаши, запах ладана и железа. Плита алтаря закрыта печатью.",
-        "buttons": [
-            [{"text": "⚡ Сломать печать (−15 HP)", "to": "crypt_break"}],
-            [{"text": "🧿 Применить амулет", "to": "crypt_open"}],
-            [{"text": "Вернуться к тропе", "to": "trail"}]
-        ]
-    },
-    "crypt_break": {
-        "img": IMG["crypt"],
-        "text": "Ты срываешь печать силой.",
-        "hp_delta": -15,
-        "buttons": [
-            [{"text": "К финальному алтарю", "to": "trail"}]
-        ]
-    },
-    "crypt_open": {
-        "img": IMG["crypt"],
-        "text": "Амулет теплеет, руны растворяются.",
-        "buttons": [
-            [{"text": "К финальному алтарю", "to": "trail"}]
-        ]
-    },
-    
-    "scorpion_path": {
-        "img": "https://images.unsplash.com/photo-1609587314425-c65f63dc67d3",
-        "text": "🏜 *Пустынная расщелина.*\\n\\nУзкий проход между каменными стенами. В песке поблёскивают хитиновые пластины.",
-        "buttons": [
-            [{"text": "Осмотреть песок", "to": "scorpion_spawn"}],
-            [{"text": "Вернуться к тропе", "to": "trail"}]
-        ]
-    },
-    "scorpion_spawn": {
-        "img": "https://images.unsplash.com/photo-1618005182384-a83a8d0fa4c1",
-        "text": "🦂 *Песчаный скорпион* вырывается из песка, клешни щёлкают, жало блестит.",
-        "combat": Combat(enemy="Песчаный скорпион", max_hp=85, hp=85,
-            img="https://images.unsplash.com/photo-1618005182384-a83a8d0fa4c1",
-            dmg_min=4, dmg_max=9,
-            hint="Ядовитое жало. Используй Квен или Аард, чтобы пережить яд.",
-            win_to="trail", trait="poison"),
-        "buttons": [
-            [{"text": "Удар", "data": "fight:hit"}, {"text": "Игни", "data": "fight:igni"}],
-            [{"text": "Аард", "data": "fight:aard"}, {"text": "Квен", "data": "fight:quen"}],
-            [{"text": "Ирден", "data": "fight:yrden"}, {"text": "Аксий", "data": "fight:axii"}],
-            [{"text": "Выпить зелье", "data": "fight:potion"}, {"text": "Показать амулет", "data": "fight:amulet"}],
-            [{"text": "Подсказка", "data": "hint:combat"}],
-        ]
-    },
-    "ghoul_spawn": {
-        "img": IMG["ghoul"],
-        "text": "🩸 *Вурдалак* крадётся, зубы поблёскивают в темноте.",
-        "combat": Combat(enemy="Вурдалак", max_hp=90, hp=90, img=IMG["ghoul"], dmg_min=3, dmg_max=7, hint="Ранишь — он пьёт кровь. Бей быстро и не подпускай.", win_to="trail", trait="lifesteal"),
-        "buttons": [
-            [{"text": "Удар", "data": "fight:hit"}, {"text": "Игни", "data": "fight:igni"}],
-            [{"text": "Аард", "data": "fight:aard"}, {"text": "Квен", "data": "fight:quen"}],
-            [{"text": "Ирден", "data": "fight:yrden"}, {"text": "Аксий", "data": "fight:axii"}],
-            [{"text": "Выпить зелье", "data": "fight:potion"}, {"text": "Показать амулет", "data": "fight:amulet"}],
-            [{"text": "Подсказка", "data": "hint:combat"}],
-        ]
-    },
-}
+def have(s: Session, item: ItemRef) -> bool:
+    i = item if isinstance(item, int) else find_item(item)
+    return i is not None and bool(s.inv >> i & 1)
 
-try:
-    NODES.update(NEW_NODES)
-    if "trail" in NODES and isinstance(NODES["trail"].get("buttons"), list):
-        NODES["trail"]["buttons"].append([{"text": "Пойти к руинам", "to": "ruins_path"}])
-        NODES["trail"]["buttons"].append([{"text": "Свернуть к болоту", "to": "bog_path"}])
-        NODES["trail"]["buttons"].append([{"text": "В пещеру (ответвление)", "to": "cave_entrance"}])
-    elif "intro" in NODES and isinstance(NODES["intro"].get("buttons"), list):
-        NODES["intro"]["buttons"].append([{"text": "Пойти к руинам", "to": "ruins_path"}])
-        NODES["intro"]["buttons"].append([{"text": "Свернуть к болоту", "to": "bog_path"}])
-        NODES["intro"]["buttons"].append([{"text": "В пещеру (ответвление)", "to": "cave_entrance"}])
-except Exception as e:
-    pass
+def add_item(s: Session, item: ItemRef):
+    s.inv |= 1 << (item if isinstance(item, int) else item_id(item))
 
+def drop_item(s: Session, item: ItemRef):
+    i = item if isinstance(item, int) else find_item(item)
+    if i is not None:
+        s.inv &= ~(1 << i)
 
-# === EXPANSION (Mirror Hall Riddle) ===
-IMG.update({
-    "mirror_hall": "https://images.unsplash.com/photo-1500530855697-b586d89ba3ee?ixlib=rb-4.0.3&auto=format&fit=crop&w=1280&q=80"
-})
-
-NEW_NODES_MIRROR = {
-    "mirror_hall": {
-        "img": IMG["mirror_hall"],
-        "text": "🪞 *Зеркальный зал.*\n\nПлитки пола отражают тебя, словно вода. На стене выгравировано: «Ответь — и путь откроется».",
-        "buttons": [
-            [{"text": "Подойти к надписи", "to": "mirror_riddle"}],
-            [{"text": "Вернуться назад", "to": "trail"}]
-        ]
-    },
-    "mirror_riddle": {
-        "img": IMG["mirror_hall"],
-        "text": "Загадка: *Что можно сломать, не касаясь?*",
-        "buttons": [
-            [{"text": "Тишину", "to": "mirror_right"}],
-            [{"text": "Лёд", "to": "mirror_wrong"}],
-            [{"text": "Клятву", "to": "mirror_wrong"}]
-        ]
-    },
-    "mirror_right": {
-        "img": IMG["mirror_hall"],
-        "text": "Зеркала звенят, и из стены выезжает ниша со светящимся осколком.",
-        "buttons": [
-            [{"text": "Взять осколок зеркала", "data": "take:осколок зеркала:mirror_hall"}]
-        ]
-    },
-    "mirror_wrong": {
-        "img": IMG["mirror_hall"],
-        "text": "Эхо насмехается, зеркала мутнеют — тебе становится не по себе.",
-        "hp_delta": -7,
-        "buttons": [
-            [{"text": "Попробовать снова", "to": "mirror_riddle"}],
-            [{"text": "Отступить", "to": "mirror_hall"}]
-        ]
-    }
+def log_action(s: Session, entry: str):
+    if s.actions_cut:
+        return
+    if s.actions_n >= ACTION_LOG_MAX:
+        s.actions_cut = True
+        return
+    if s.actions:
+        s.actions += b"\n"
+    s.actions += entry.encode("ascii")
+    s.actions_n += 1
+
+def action_entries(s: Session) -> List[str]:
+    return s.actions.decode("ascii").split("\n") if s.actions else []
+
+# === CALLBACK ENCODING ===
+# callback_data — код операции в один символ и аргументы-числа в base36 через точку:
+# "g1a" — перейти в узел 46, "t3.1a" — взять предмет 3 и перейти в узел 46, "f0" — удар.
+# Старый вид ("go:trail", "take:травы:brew_hut") ещё живёт в клавиатурах старых сообщений —
+# он всегда содержит ":", по нему и отличаем, и переводим в новый.
+OP_GO, OP_HINT, OP_TAKE, OP_BREW, OP_FIGHT = "g", "h", "t", "b", "f"
+FIGHT_ACTIONS = ("hit", "igni", "aard", "quen", "yrden", "axii", "potion", "amulet", "status")
+_FIGHT_CODES = {a: i for i, a in enumerate(FIGHT_ACTIONS)}
+
+# номера узлов; как и у предметов, только дописываются в конец
+NODE_KEYS: List[str] = []
+NODE_IDS: Dict[str, int] = {}
+
+def node_id(key: str) -> int:
+    i = NODE_IDS.get(key)
+    if i is None:
+        i = NODE_IDS[key] = len(NODE_KEYS)
+        NODE_KEYS.append(key)
+    return i
+
+_B36_DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+def _b36(n: int) -> str:
+    out = ""
+    while True:
+        n, r = divmod(n, 36)
+        out = _B36_DIGITS[r] + out
+        if not n:
+            return out
+
+def encode_cb(op: str, *args: int) -> str:
+    return op + ".".join(_b36(a) for a in args)
+
+def _decode_legacy(data: str) -> Optional[Tuple[str, List[int]]]:
+    kind, _, rest = data.partition(":")
+    if kind == "go":
+        return OP_GO, [NODE_IDS[rest]]
+    if kind == "hint":
+        return (OP_HINT, []) if rest == "combat" else (OP_HINT, [NODE_IDS[rest]])
+    if kind in ("take", "brew"):
+        item, nxt = rest.split(":", 1)
+        # только уже известные предметы: имя из кнопки не должно пополнять реестр
+        i = find_item(item)
+        if i is None:
+            return None
+        return (OP_TAKE if kind == "take" else OP_BREW), [i, NODE_IDS[nxt]]
+    if kind == "fight":
+        return OP_FIGHT, [_FIGHT_CODES[rest]]
+    return None
+
+# Что может прийти в аргументах каждого кода операции: варианты по числу аргументов
+# и реестр, в пределах которого должен лежать каждый. Всё остальное — «неизвестная кнопка».
+_CB_ARGS: Dict[str, Tuple[Tuple[list, ...], ...]] = {
+    OP_GO: ((NODE_KEYS,),),
+    OP_HINT: ((), (NODE_KEYS,)),  # без аргумента — подсказка боя
+    OP_TAKE: ((ITEMS, NODE_KEYS),),
+    OP_BREW: ((ITEMS, NODE_KEYS),),
+    OP_FIGHT: ((FIGHT_ACTIONS,),),
 }
 
-try:
-    NODES.update(NEW_NODES_MIRROR)
-    # Ссылка из стартовой тропы
-    if "trail" in NODES and isinstance(NODES["trail"].get("buttons"), list):
-        NODES["trail"]["buttons"].append([{"text": "Зеркальный зал", "to": "mirror_hall"}])
-except Exception:
+def _b36_arg(a: str) -> int:
+    # int(a, 36) понял бы и "-1", и " 1", и "1_0" — пропускаем только цифры base36
+    if not a or a.strip(_B36_DIGITS):
+        raise ValueError(a)
+    return int(a, 36)
+
+def decode_cb(data: str) -> Optional[Tuple[str, List[int]]]:
+    try:
+        if ":" in data:
+            parsed = _decode_legacy(data)
+        elif data:
+            rest = data[1:]
+            parsed = data[0], [_b36_arg(a) for a in rest.split(".")] if rest else []
+        else:
+            return None
+    except (KeyError, ValueError):
+        return None
+    if parsed is None:
+        return None
+    op, args = parsed
+    for registries in _CB_ARGS.get(op, ()):
+        if len(registries) == len(args) and all(a < len(r) for a, r in zip(args, registries)):
+            return parsed
+    return None
+
+def compact_cb(data: str) -> str:
+    # старый вид из описания узла -> компактный; на этапе компиляции, не на горячем пути
+    kind, _, rest = data.partition(":")
+    if kind in ("take", "brew"):
+        item, nxt = rest.split(":", 1)
+        return encode_cb(OP_TAKE if kind == "take" else OP_BREW, item_id(item), node_id(nxt))
+    if kind == "fight":
+        return encode_cb(OP_FIGHT, _FIGHT_CODES[rest])
+    if kind == "hint":
+        return encode_cb(OP_HINT) if rest == "combat" else encode_cb(OP_HINT, node_id(rest))
+    if kind == "go":
+        return encode_cb(OP_GO, node_id(rest))
+    return data
+
+# обработчики кнопок: код операции -> async fn(chat_id, session, args)
+CALLBACKS: Dict[str, Callable] = {}
+
+def on_callback(op: str):
+    def register(fn):
+        CALLBACKS[op] = fn
+        return fn
+    return register
+
+# === COMPILED NODES ===
+# Узлы из паков контента компилируются в неизменяемые: клавиатура уже собрана и сериализована,
+# подсказка лежит прямо в узле, исходящие рёбра посчитаны.
+def markup_json(rows: List[List[Dict[str, str]]]) -> str:
+    return json.dumps(kb(rows), ensure_ascii=False, separators=(",", ":"))
+
+@dataclass(frozen=True, slots=True)
+class CompiledNode:
+    key: str
+    img: str
+    text: str
+    hp_delta: int
+    combat: Optional[Combat]
+    reply_markup: Optional[str]
+    hint: Optional[str]
+    edges: FrozenSet[str]
+
+def compile_node(key: str, node: dict) -> CompiledNode:
+    combat = node.get("combat") if isinstance(node.get("combat"), Combat) else None
+    rows, hint, edges = [], None, set()
+    for row in node.get("buttons", []):
+        row_btns = []
+        for b in row:
+            if "to" in b:
+                row_btns.append({"text": b["text"], "data": encode_cb(OP_GO, node_id(b["to"]))})
+                edges.add(b["to"])
+            elif "data" in b:
+                row_btns.append({"text": b["text"], "data": compact_cb(b["data"])})
+                if b["data"].startswith(("take:", "brew:")):
+                    edges.add(b["data"].split(":", 2)[2])
+            elif "hint" in b:
+                row_btns.append({"text": b["text"], "data": encode_cb(OP_HINT, node_id(key))})
+                if hint is None:
+                    hint = b["hint"]
+        rows.append(row_btns)
+    if combat is not None:
+        edges.add(combat.win_to)
+    return CompiledNode(
+        key=key,
+        img=node.get("img", ""),
+        text=node.get("text", ""),
+        hp_delta=node.get("hp_delta", 0),
+        combat=combat,
+        # у боевых узлов своя клавиатура — см. COMBAT_MARKUP
+        reply_markup=markup_json(rows) if rows and combat is None else None,
+        hint=hint,
+        edges=frozenset(edges),
+    )
+
+def compile_nodes(nodes: Dict[str, dict]) -> Dict[str, CompiledNode]:
+    return {key: compile_node(key, node) for key, node in nodes.items()}
+
+# === CONTENT PACKS ===
+# Картинки, локации и бои лежат в JSON-паках CONTENT_DIR и грузятся по порядку имён файлов
+# (00_base.json, 10_ruins.json, …):
+#   {"format": 1, "version": 3, "images": {ключ: url}, "nodes": {ключ: узел}, "append_buttons": {ключ: [ряды]}}
+# Узел — text, img, buttons, hp_delta, combat; img узла и боя — ключ картинки
+# из этого пака или более раннего. Поздний пак может заменить узел целиком или дописать ряды кнопок
+# в чужой узел (append_buttons). Паки проверяются и компилируются целиком, и только потом IMG и GRAPH
+# подменяются разом; ошибка в любом паке — остаётся прежний контент. Номера узлов и предметов
+# только дописываются, так что кнопки старых сообщений и идущие бои переживают перезагрузку.
+CONTENT_FORMAT = 1
+
+class ContentError(ValueError):
     pass
 
+@dataclass(frozen=True, slots=True)
+class ContentPack:
+    name: str  # имя файла
+    sha256: str
+    version: int
+    images: Dict[str, str]
+    nodes: Dict[str, dict]
+    append_buttons: Dict[str, list]
+
+_PACK_FIELDS = {"format", "version", "images", "nodes", "append_buttons"}
+_NODE_FIELDS = {"img", "text", "buttons", "hp_delta", "combat"}
+_COMBAT_FIELDS = {"enemy": str, "max_hp": int, "img": str, "dmg_min": int, "dmg_max": int,
+                  "hint": str, "win_to": str, "trait": str}
+
+def _need(ok: bool, where: str, msg: str):
+    if not ok:
+        raise ContentError(f"{where}: {msg}")
+
+def _of_type(v, t) -> bool:
+    return isinstance(v, t) and not isinstance(v, bool)
+
+def _valid_data(data: str) -> bool:
+    kind, _, rest = data.partition(":")
+    if kind in ("take", "brew"):
+        item, _, nxt = rest.partition(":")
+        return bool(item and nxt)
+    if kind == "fight":
+        return rest in _FIGHT_CODES
+    return kind in ("go", "hint") and bool(rest)
+
+def _check_buttons(rows, where: str):
+    _need(isinstance(rows, list) and all(isinstance(row, list) for row in rows), where,
+          "кнопки — список рядов")
+    for row in rows:
+        for b in row:
+            _need(isinstance(b, dict) and isinstance(b.get("text"), str), where, f"кнопка без text: {b!r}")
+            kinds = [k for k in ("to", "data", "hint") if k in b]
+            _need(len(kinds) == 1 and isinstance(b[kinds[0]], str), where,
+                  f"кнопка «{b['text']}»: нужно ровно одно из to / data / hint")
+            if "data" in b:
+                _need(_valid_data(b["data"]), where, f"кнопка «{b['text']}»: непонятное data {b['data']!r}")
+
+def _check_combat(c, where: str):
+    _need(isinstance(c, dict), where, "combat — объект")
+    for f, t in _COMBAT_FIELDS.items():
+        _need(f in c or f == "trait", where, f"в бою нет {f}")
+        _need(f not in c or _of_type(c[f], t), where, f"combat.{f} — не {t.__name__}")
+    _need(not set(c) - set(_COMBAT_FIELDS), where, f"лишние поля боя: {sorted(set(c) - set(_COMBAT_FIELDS))}")
+    _need(c["max_hp"] > 0 and 0 <= c["dmg_min"] <= c["dmg_max"], where, "max_hp > 0 и 0 <= dmg_min <= dmg_max")
+
+def parse_pack(name: str, raw: bytes, digest: str) -> ContentPack:
+    # проверка одного файла сама по себе; ссылки между паками — в build_content
+    try:
+        doc = json.loads(raw)
+    except ValueError as e:
+        raise ContentError(f"{name}: не JSON: {e}")
+    _need(isinstance(doc, dict), name, "пак — JSON-объект")
+    _need(doc.get("format") == CONTENT_FORMAT, name,
+          f"format {doc.get('format')!r}, поддерживается {CONTENT_FORMAT}")
+    _need(not set(doc) - _PACK_FIELDS, name, f"лишние поля: {sorted(set(doc) - _PACK_FIELDS)}")
+    version = doc.get("version", 0)
+    _need(_of_type(version, int), name, "version — целое")
+    images = doc.get("images", {})
+    _need(isinstance(images, dict) and all(isinstance(v, str) and v for v in images.values()), name,
+          "images — {ключ: url}")
+    nodes = doc.get("nodes", {})
+    _need(isinstance(nodes, dict), name, "nodes — объект")
+    for key, node in nodes.items():
+        where = f"{name}: {key}"
+        _need(isinstance(node, dict), where, "узел — объект")
+        _need(not set(node) - _NODE_FIELDS, where, f"лишние поля: {sorted(set(node) - _NODE_FIELDS)}")
+        _need(isinstance(node.get("text"), str), where, "нет text")
+        _need(isinstance(node.get("img", ""), str), where, "img — ключ картинки")
+        _need(_of_type(node.get("hp_delta", 0), int), where, "hp_delta — целое")
+        _check_buttons(node.get("buttons", []), where)
+        if "combat" in node:
+            _check_combat(node["combat"], where)
+    append = doc.get("append_buttons", {})
+    _need(isinstance(append, dict), name, "append_buttons — {ключ узла: [ряды]}")
+    for key, rows in append.items():
+        _check_buttons(rows, f"{name}: append_buttons.{key}")
+    return ContentPack(name=name, sha256=digest, version=version, images=images, nodes=nodes,
+                       append_buttons=append)
+
+def build_content(packs: List[ContentPack]) -> Tuple[Dict[str, str], Dict[str, dict]]:
+    # паки по порядку: ключи картинок разрешаются в URL, бои становятся Combat, дописываются ряды кнопок
+    images: Dict[str, str] = {}
+    nodes: Dict[str, dict] = {}
+    for p in packs:
+        images.update(p.images)
+        for key, node in p.nodes.items():
+            where = f"{p.name}: {key}"
+            node = dict(node)
+            if node.get("img"):
+                _need(node["img"] in images, where, f"нет картинки {node['img']!r}")
+                node["img"] = images[node["img"]]
+            if "combat" in node:
+                c = dict(node["combat"])
+                _need(c["img"] in images, where, f"нет картинки {c['img']!r}")
+                c["img"] = images[c["img"]]
+                node["combat"] = Combat(hp=c["max_hp"], **c)
+            nodes[key] = node
+        for key, rows in p.append_buttons.items():
+            _need(key in nodes, f"{p.name}: append_buttons", f"нет узла {key!r}")
+            nodes[key] = {**nodes[key], "buttons": nodes[key].get("buttons", []) + rows}
+    for key in ("intro", "finale"):  # на них код ссылается напрямую: /start, поражение
+        _need(key in nodes, "content", f"нет узла {key!r}")
+    return images, nodes
+
+# === CONTENT GRAPH ===
+# Проверка связности до компиляции: у каждой кнопки и у победы в бою должен быть узел назначения,
+# иначе KeyError вылезет у игрока. Заодно сводка по графу — она же артефакт GRAPH_ARTIFACT:
+# что достижимо от intro, сколько шагов из каждого узла до finale и какие предметы у игрока
+# могут быть / точно есть на входе в узел. Артефакт собирает `python main.py check` (для CI:
+# код 1 при ошибках); бот берёт его готовым, если он собран для тех же паков, иначе считает сам.
+GRAPH_FORMAT = 1
+# особенности врагов, которые понимает боевой движок (calc_player_damage / calc_enemy_damage)
+ENGINE_TRAITS = frozenset({"needs_silver", "weak_to_igni", "weak_to_aard", "stuns_with_amulet", "evasive",
+                           "stone_skin", "fear", "double_strike", "burn_items", "poison"})
+# предметы, которые в бою могут потратиться или сгореть
+CONSUMABLES = ("зелье", "травы")
+
+@dataclass(slots=True)
+class GraphReport:
+    content: str              # CONTENT_VERSION паков, по которым собран
+    nodes: List[str]          # дальше узлы — номерами в этом списке
+    edges: List[List[int]]
+    reachable: List[bool]     # от intro
+    to_finale: List[int]      # шагов до finale, -1 — не дойти
+    next_hop: List[int]       # следующий узел на кратчайшем пути к finale
+    items: List[str]
+    may_have: List[int]       # маски по items: предмет может быть на входе в узел
+    always_have: List[int]    # предмет есть на входе в узел при любом пути
+    warnings: List[str]
+
+    def path_to_finale(self, key: str) -> List[str]:
+        i = self.nodes.index(key)
+        if self.to_finale[i] < 0:
+            return []
+        path = [key]
+        while self.to_finale[i] > 0:
+            i = self.next_hop[i]
+            path.append(self.nodes[i])
+        return path
+
+def _node_links(node: dict) -> List[Tuple[str, str, str, str]]:
+    # (что ссылается, куда, вид, предмет); вид: go, take, brew, hint (подсказка — ссылка, не переход)
+    out = []
+    for row in node.get("buttons", []):
+        for b in row:
+            what = f"кнопка «{b['text']}»"
+            if "to" in b:
+                out.append((what, b["to"], "go", ""))
+            elif "data" in b:
+                kind, _, rest = b["data"].partition(":")
+                if kind in ("take", "brew"):
+                    item, nxt = rest.split(":", 1)
+                    out.append((what, nxt, kind, item))
+                elif kind in ("go", "hint") and rest != "combat":
+                    out.append((what, rest, kind, ""))
+    combat = node.get("combat")
+    if combat is not None:
+        out.append(("победа в бою", combat.win_to, "go", ""))
+    return out
+
+def analyze_graph(nodes: Dict[str, dict], content: str) -> Tuple[List[str], GraphReport]:
+    keys = list(nodes)
+    idx = {k: i for i, k in enumerate(keys)}
+    items: List[str] = []
+    bits: Dict[str, int] = {}
+
+    def bit(name: str) -> int:
+        n = norm(name)
+        if n not in bits:
+            bits[n] = 1 << len(items)
+            items.append(name)
+        return bits[n]
+
+    errors, warnings = [], []
+    consumed = 0
+    for name in CONSUMABLES:
+        consumed |= bit(name)
+    # переходы: (куда, что добавляется, что для этого нужно, что при этом тратится)
+    trans: List[List[Tuple[int, int, int, int]]] = [[] for _ in keys]
+    brews: List[Tuple[int, str, int]] = []
+    for key, node in nodes.items():
+        for what, target, kind, item in _node_links(node):
+            if target not in idx:
+                errors.append(f"{key}: {what} ведёт в несуществующий узел {target!r}")
+                continue
+            if kind == "hint":
+                continue
+            add = need = 0
+            if kind == "take":
+                add = bit(item)
+            elif kind == "brew":
+                if norm(item) != norm("зелье"):
+                    warnings.append(f"{key}: {what} — сварить можно только зелье, не {item!r}")
+                else:
+                    add, need = bit(item), bit("травы")
+                    brews.append((idx[key], what, need))
+            trans[idx[key]].append((idx[target], add, need, need))
+    edges = [sorted({t[0] for t in row}) for row in trans]
+    start = idx.get("intro")
+    finale = idx.get("finale")
+
+    reachable = [False] * len(keys)
+    if start is not None:
+        reachable[start] = True
+        queue = deque([start])
+        while queue:
+            i = queue.popleft()
+            for j in edges[i]:
+                if not reachable[j]:
+                    reachable[j] = True
+                    queue.append(j)
+
+    to_finale, next_hop = [-1] * len(keys), [-1] * len(keys)
+    if finale is not None:
+        back: List[List[int]] = [[] for _ in keys]
+        for i, row in enumerate(edges):
+            for j in row:
+                back[j].append(i)
+        to_finale[finale] = 0
+        queue = deque([finale])
+        while queue:
+            j = queue.popleft()
+            for i in back[j]:
+                if to_finale[i] < 0:
+                    to_finale[i], next_hop[i] = to_finale[j] + 1, j
+                    queue.append(i)
+
+    # предметы на входе в узел: «может быть» — объединение по путям, «точно есть» — пересечение;
+    # после боя зелье и травы могли кончиться
+    full = (1 << len(items)) - 1
+    may = [0] * len(keys)
+    always = [full if r else 0 for r in reachable]
+    if start is not None:
+        always[start] = 0  # /start — пустой инвентарь
+        work = deque([start])
+        while work:
+            i = work.popleft()
+            have_all = always[i] & ~consumed if nodes[keys[i]].get("combat") is not None else always[i]
+            for j, add, need, drop in trans[i]:
+                may_out = may[i] | (add if may[i] & need == need else 0)
+                if need == 0:
+                    all_out = have_all | add
+                elif have_all & need == need:
+                    all_out = have_all & ~drop | add
+                else:
+                    all_out = have_all & ~drop  # сварится или нет — зависит от пути
+                if j == start:
+                    all_out = 0
+                if may[j] | may_out != may[j] or always[j] & all_out != always[j]:
+                    may[j] |= may_out
+                    always[j] &= all_out
+                    work.append(j)
+
+    for i, key in enumerate(keys):
+        if not reachable[i]:
+            warnings.append(f"{key}: недостижим из intro")
+        elif to_finale[i] < 0:
+            warnings.append(f"{key}: отсюда не дойти до finale")
+    for i, what, need in brews:
+        if reachable[i] and not may[i] & need:
+            warnings.append(f"{keys[i]}: {what} — трав здесь быть не может, зелье не сварится")
+    for i, key in enumerate(keys):
+        combat = nodes[key].get("combat")
+        if combat is None:
+            continue
+        trait = (combat.trait or "").strip()
+        if trait and trait not in ENGINE_TRAITS:
+            warnings.append(f"{key}: особенность {trait!r} в бою ничего не делает")
+        needs = {"needs_silver": "серебряный клинок", "stuns_with_amulet": "амулет"}.get(trait)
+        if needs and reachable[i] and not may[i] & bit(needs):
+            warnings.append(f"{key}: {trait}, но {needs} к этому бою не добыть")
+    report = GraphReport(content=content, nodes=keys, edges=edges, reachable=reachable, to_finale=to_finale,
+                         next_hop=next_hop, items=items, may_have=may, always_have=always, warnings=warnings)
+    return errors, report
+
+def read_graph_artifact(path: str, content: str) -> Optional[GraphReport]:
+    try:
+        with open(path, encoding="utf-8") as f:
+            doc = json.load(f)
+        if doc.pop("format", None) != GRAPH_FORMAT or doc.get("content") != content:
+            return None  # собран для других паков или другой версией проверки
+        return GraphReport(**doc)
+    except (OSError, ValueError, TypeError):
+        return None
+
+def write_graph_artifact(path: str, report: GraphReport):
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"format": GRAPH_FORMAT, **asdict(report)}, f, ensure_ascii=False, separators=(",", ":"))
+        f.write("\n")
+    os.replace(tmp, path)
+
+# разобранные паки по имени файла: неизменённый (тот же sha256) файл повторно не разбирается
+_PACKS: Dict[str, ContentPack] = {}
+CONTENT_VERSION = ""  # общий хэш загруженных паков
+CONTENT_GRAPH: Optional[GraphReport] = None
+
+def content_version(packs: List[ContentPack]) -> str:
+    return hashlib.sha256("".join(p.sha256 for p in packs).encode()).hexdigest()[:12]
+
+def read_packs(directory: str) -> Tuple[List[ContentPack], int]:
+    # файлы на "_" — не паки (там лежит артефакт графа)
+    names = sorted(n for n in os.listdir(directory) if n.endswith(".json") and not n.startswith("_"))
+    _need(bool(names), directory, "нет ни одного пака (*.json)")
+    packs, parsed = [], 0
+    for name in names:
+        with open(os.path.join(directory, name), "rb") as f:
+            raw = f.read()
+        digest = hashlib.sha256(raw).hexdigest()
+        pack = _PACKS.get(name)
+        if pack is None or pack.sha256 != digest:
+            pack = parse_pack(name, raw, digest)
+            parsed += 1
+        packs.append(pack)
+    return packs, parsed
+
+def check_content(packs: List[ContentPack], artifact: Optional[GraphReport] = None
+                  ) -> Tuple[Dict[str, str], Dict[str, dict], GraphReport]:
+    images, nodes = build_content(packs)
+    report = artifact
+    if report is None or report.nodes != list(nodes):
+        errors, report = analyze_graph(nodes, content_version(packs))
+        if errors:
+            raise ContentError("\n".join(errors))
+    return images, nodes, report
+
+# Номера узлов и предметов стоят в кнопках уже отправленных сообщений и в сохранённых сессиях,
+# поэтому между перезапусками они берутся из CONTENT_IDS, а не из порядка паков: сначала
+# записанные номера, новые — в конец. Файл только дописывается; его стоит держать в репозитории
+# (python main.py check обновляет его вместе с артефактом графа).
+def read_ids(path: str = CONTENT_IDS) -> Dict[str, List[str]]:
+    try:
+        with open(path, encoding="utf-8") as f:
+            doc = json.load(f)
+    except FileNotFoundError:
+        return {"nodes": [], "items": []}
+    except (OSError, ValueError) as e:
+        raise ContentError(f"{path}: {e}")
+    _need(isinstance(doc, dict) and all(isinstance(doc.get(k, []), list) for k in ("nodes", "items")),
+          path, "ожидается {\"nodes\": [...], \"items\": [...]}")
+    return {"nodes": doc.get("nodes", []), "items": doc.get("items", [])}
+
+def apply_ids(ids: Dict[str, List[str]]):
+    for what, names, register in (("items", ids["items"], item_id), ("nodes", ids["nodes"], node_id)):
+        for i, name in enumerate(names):
+            _need(isinstance(name, str) and register(name) == i, CONTENT_IDS,
+                  f"{what}[{i}] = {name!r} уже занят другим номером — реестр только дописывается")
+
+def ids_changed(ids: Dict[str, List[str]]) -> bool:
+    return len(ids["nodes"]) != len(NODE_KEYS) or len(ids["items"]) != len(ITEMS)
+
+def write_ids(path: str = CONTENT_IDS):
+    snapshot = {"nodes": list(NODE_KEYS), "items": list(ITEMS)}
+    tmp = path + ".tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f, ensure_ascii=False, indent=0)
+            f.write("\n")
+        os.replace(tmp, path)
+    except OSError:
+        pass  # только для чтения (например, образ без записи) — номера всё равно в памяти
+
+def install_content(packs: List[ContentPack], artifact: Optional[GraphReport] = None,
+                    ids: Optional[Dict[str, List[str]]] = None) -> dict:
+    global IMG, GRAPH, CONTENT_VERSION, CONTENT_GRAPH, _PACKS
+    images, nodes, report = check_content(packs, artifact)
+    if ids is not None:
+        apply_ids(ids)
+    for key in nodes:
+        node_id(key)  # новые узлы — в конец, номера старых не меняются
+    graph = compile_nodes(nodes)
+    # подмена разом: между присваиваниями нет await, апдейты видят либо старый контент, либо новый
+    IMG, GRAPH, CONTENT_GRAPH = images, graph, report
+    CONTENT_VERSION = report.content
+    _PACKS = {p.name: p for p in packs}
+    return {"version": CONTENT_VERSION, "packs": {p.name: p.version for p in packs},
+            "nodes": len(graph), "images": len(images), "warnings": len(report.warnings)}
+
+def _read_content(directory: str):
+    packs, parsed = read_packs(directory)
+    return packs, parsed, read_graph_artifact(GRAPH_ARTIFACT, content_version(packs)), read_ids()
+
+def load_content(directory: str = CONTENT_DIR) -> dict:
+    packs, parsed, artifact, ids = _read_content(directory)
+    info = install_content(packs, artifact, ids)
+    if ids_changed(ids):
+        write_ids()
+    return {**info, "parsed": parsed, "artifact": artifact is not None}
+
+_reload_lock = asyncio.Lock()
+
+async def reload_content() -> dict:
+    # файлы читаются и разбираются в потоке; сборка и подмена — в цикле событий
+    async with _reload_lock:
+        t0 = time.perf_counter()
+        packs, parsed, artifact, ids = await asyncio.to_thread(_read_content, CONTENT_DIR)
+        info = install_content(packs, artifact, ids)
+        if ids_changed(ids):
+            await asyncio.to_thread(write_ids)
+    if PREWARM_CHAT_ID:
+        _spawn(prewarm_images())  # новые картинки — в кэш file_id, уже загруженные пропускаются
+    return {**info, "parsed": parsed, "artifact": artifact is not None,
+            "ms": round((time.perf_counter() - t0) * 1000, 1)}
+
+IMG: Dict[str, str] = {}
+GRAPH: Dict[str, CompiledNode] = {}
+try:
+    load_content()
+except ContentError as e:
+    raise SystemExit(f"content: {e}")  # ошибка в паках — бот не стартует
+
 # === COMBAT ENGINE ===
-def build_combat_message(s: Session) -> (str, dict, str):
+COMBAT_MARKUP = markup_json([
+    [{"text": "Удар", "data": compact_cb("fight:hit")},
+     {"text": "Игни", "data": compact_cb("fight:igni")}],
+    [{"text": "Аард", "data": compact_cb("fight:aard")},
+     {"text": "Выпить зелье", "data": compact_cb("fight:potion")}],
+    [{"text": "Показать амулет", "data": compact_cb("fight:amulet")},
+     {"text": "Подсказка", "data": compact_cb("hint:combat")}],
+])
+BACK_TO_COMBAT_MARKUP = markup_json([[{"text": "↩ Вернуться в бой", "data": compact_cb("fight:status")}]])
+
+def build_combat_message(s: Session, hp: Optional[int] = None) -> Tuple[str, str, str]:
     c = s.combat
     assert c is not None
+    hp = s.hp if hp is None else hp
     title = f"*{c.enemy}*"
     enemy_hp = f"HP {c.hp}/{c.max_hp}  [{hp_bar(c.hp, c.max_hp)}]"
-    me_hp = f"Твои жизни: {s.hp}/{s.max_hp}  [{hp_bar(s.hp, s.max_hp)}]"
+    me_hp = f"Твои жизни: {hp}/{s.max_hp}  [{hp_bar(hp, s.max_hp)}]"
     effect_hint = "Нажми «Подсказка», если нужно."
-    rows = [
-        [{"text": "Удар", "data": "fight:hit"},
-         {"text": "Игни", "data": "fight:igni"}],
-        [{"text": "Аард", "data": "fight:aard"},
-         {"text": "Выпить зелье", "data": "fight:potion"}],
-        [{"text": "Показать амулет", "data": "fight:amulet"},
-         {"text": "Подсказка", "data": "hint:combat"}],
-    ]
     caption = f"{title}\n{enemy_hp}\n{me_hp}\n\n{effect_hint}"
-    return caption, kb(rows), c.img
-
-def calc_player_damage(action: str, s: Session, c: Combat) -> int:
-    if action in ("potion", "quen", "yrden", "axii"):
+    return caption, COMBAT_MARKUP, c.img
+
+# Правила боя записаны один раз и работают и над числами (живой бот), и над массивами NumPy
+# (simulate.py гоняет миллионы боёв пачками). Поэтому внутри нет if по значениям — только
+# xp.where/xp.maximum/…; xp — SCALAR здесь или numpy-обёртка в симуляторе. Случайность
+# приходит снаружи: ROLLS_PER_TURN равномерных чисел из [0, 1) на ход.
+class SCALAR:
+    @staticmethod
+    def where(cond, a, b):
+        return a if cond else b
+
+    maximum = staticmethod(max)
+    minimum = staticmethod(min)
+    floor = staticmethod(math.floor)
+    round = staticmethod(round)
+
+    @staticmethod
+    def and_(a, b):
+        return bool(a and b)
+
+    @staticmethod
+    def not_(a):
+        return not a
+
+# u[0] — урон игрока, u[1] — уворот, u[2] — урон врага, u[3] — Аксий,
+# u[4..7] — два удара double_strike (попал?, сколько), u[8] — поджог инвентаря
+ROLLS_PER_TURN = 9
+PLAYER_ACTIONS = ("hit", "igni", "aard", "amulet")  # действия, которые наносят урон
+
+def _randint(xp, lo, hi, u):
+    # аналог random.randint(lo, hi) по готовому равномерному u
+    return lo + xp.floor(u * (hi - lo + 1))
+
+def adaptive_enemy_hp(player_hp: int, max_hp: int) -> int:
+    # адаптив: если у героя мало жизней, ослабим врага на 20%
+    return int(max_hp * 0.8) if player_hp <= 3 else max_hp
+
+def calc_player_damage(xp, action: str, trait: str, dmg_min: int, dmg_max: int, has_silver, u):
+    if action not in PLAYER_ACTIONS:
         return 0
+    if action == "amulet":
+        return 12 if trait == "stuns_with_amulet" else 0
     if action == "hit":
-        lo, hi = s.dmg_min, s.dmg_max
+        lo, hi = dmg_min, dmg_max
     elif action == "igni":
-        lo, hi = max(1, s.dmg_min-1), s.dmg_max
-    elif action == "aard":
-        lo, hi = max(1, s.dmg_min-2), max(s.dmg_min, s.dmg_max-1)
-    elif action == "amulet":
-        if c.trait == "stuns_with_amulet":
-            return 12
-        return 0
-    else:
-        lo, hi = 0, 0
-    dmg = random.randint(lo, hi)
-    if c.trait == "needs_silver" and (action == "hit") and have(s, "серебряный клинок"):
-        dmg += 10
-    if c.trait == "weak_to_igni" and action == "igni":
-        dmg += 8
-    if c.trait == "weak_to_aard" and action == "aard":
-        dmg += 8
-    trait = (c.trait or "").strip()
+        lo, hi = max(1, dmg_min-1), dmg_max
+    else:  # aard
+        lo, hi = max(1, dmg_min-2), max(dmg_min, dmg_max-1)
+    dmg = _randint(xp, lo, hi, u[0])
+    if trait == "needs_silver" and action == "hit":
+        dmg = dmg + 10 * has_silver
+    if trait == "weak_to_igni" and action == "igni":
+        dmg = dmg + 8
+    if trait == "weak_to_aard" and action == "aard":
+        dmg = dmg + 8
     if trait == "evasive":
-        if random.random() < 0.25:
-            dmg = 0
+        dmg = xp.where(u[1] < 0.25, 0, dmg)
     if trait == "stone_skin":
-        dmg = max(0, int(dmg * 0.7))
+        dmg = xp.maximum(0, xp.floor(dmg * 0.7))
     if trait == "fear":
-        dmg = int(dmg * 0.75)
-    return max(0, dmg)
-
-def calc_enemy_damage(s: Session, c: Combat, player_action: str, potion_used: bool) -> int:
-    s._axii_last_success = False
-    s._burned_item_last = ""
-    dmg = random.randint(c.dmg_min, c.dmg_max)
-    dmg = int(round(dmg * 1.35))
-    if dmg < 1:
-        dmg = 1
-    if player_action == "quen":
-        dmg = max(0, int(dmg * 0.6) - 2)
-    if getattr(s, 'yrden_turns', 0) > 0:
-        dmg = int(dmg * 0.7)
-    if player_action == "axii":
-        if random.random() < 0.5:
-            s._axii_last_success = True
-            return 0
-    if player_action == "amulet" and c.enemy == "Морозница":
-        dmg = 0
-    trait = (c.trait or "").strip()
+        dmg = xp.floor(dmg * 0.75)
+    return xp.maximum(0, dmg)
+
+def calc_enemy_damage(xp, action: str, trait: str, enemy: str, dmg_min: int, dmg_max: int,
+                      yrden, potion_used, has_amulet, u):
+    # -> (урон, Аксий сработал, огонь пытается сжечь предмет, враг отравил)
+    dmg = xp.round(_randint(xp, dmg_min, dmg_max, u[2]) * 1.35)
+    dmg = xp.maximum(1, dmg)
+    if action == "quen":
+        dmg = xp.maximum(0, xp.floor(dmg * 0.6) - 2)
+    dmg = xp.where(yrden > 0, xp.floor(dmg * 0.7), dmg)
+    axii_ok = xp.and_(action == "axii", u[3] < 0.5)
+    if action == "amulet" and enemy == "Морозница":
+        dmg = dmg * 0
     if trait == "double_strike":
-        total = 0
-        for _ in range(2):
-            if random.random() < 0.7:
-                part = random.randint(max(1, c.dmg_min//2), c.dmg_max)
-                part = int(round(part * 1.35))
-                total += part
-        dmg = max(dmg, total)
-    if trait == "burn_items":
-        if random.random() < 0.25:
-            inv_norm = [norm(x) for x in s.inventory]
-            if "зелье" in inv_norm:
-                s.inventory = [x for x in s.inventory if norm(x) != "зелье"]
-                s._burned_item_last = "зелье"
-            elif "травы" in inv_norm:
-                s.inventory = [x for x in s.inventory if norm(x) != "травы"]
-                s._burned_item_last = "травы"
-    if trait == "poison" and dmg > 0:
-        if not hasattr(s, "poison_turns") or s.poison_turns <= 0:
-            s.poison_turns = 3
-    if potion_used:
-        dmg //= 2
-    if have(s, "амулет") and dmg > 0:
-        dmg = max(0, dmg - 2)
-    return dmg
+        lo = max(1, dmg_min // 2)
+        total = xp.where(u[4] < 0.7, xp.round(_randint(xp, lo, dmg_max, u[5]) * 1.35), 0) \
+            + xp.where(u[6] < 0.7, xp.round(_randint(xp, lo, dmg_max, u[7]) * 1.35), 0)
+        dmg = xp.maximum(dmg, total)
+    burn = xp.and_(trait == "burn_items", xp.and_(u[8] < 0.25, xp.not_(axii_ok)))
+    poisoned = xp.and_(trait == "poison", xp.and_(dmg > 0, xp.not_(axii_ok)))
+    dmg = xp.where(potion_used, dmg // 2, dmg)
+    dmg = xp.where(xp.and_(has_amulet, dmg > 0), xp.maximum(0, dmg - 2), dmg)
+    dmg = xp.where(axii_ok, 0, dmg)
+    return dmg, axii_ok, burn, poisoned
+
+@dataclass(slots=True)
+class CombatState:
+    # всё, от чего зависит ход боя; поля — числа или массивы одинаковой длины
+    hp: object
+    dmg_min: int
+    dmg_max: int
+    enemy: str
+    trait: str
+    e_hp: object
+    e_max: object
+    e_dmg_min: int
+    e_dmg_max: int
+    yrden: object
+    poison: object
+    fate: object
+    silver: object
+    amulet: object
+    potion: object
+    herbs: object
+    mirror: object
+
+@dataclass(slots=True)
+class TurnResult:
+    pdmg: object = 0
+    edmg: object = 0
+    won: object = False
+    lost: object = False
+    potion_used: object = False
+    axii_ok: object = False
+    burned: object = 0  # 0 — ничего, 1 — зелье, 2 — травы
+    mirror_saved: object = False
+    fate_saved: object = False
+    hp_before_poison: object = 0
+    poison_tick: object = False
+
+def combat_turn(xp, st: CombatState, action: str, u) -> TurnResult:
+    # Один ход боя. Меняет st на месте. Если враг пал от удара игрока, его ответ не считается.
+    r = TurnResult()
+    if action == "yrden":
+        st.yrden = st.yrden * 0 + 2
+    r.potion_used = xp.and_(action == "potion", st.potion)
+    r.pdmg = calc_player_damage(xp, action, st.trait, st.dmg_min, st.dmg_max, st.silver, u)
+    st.e_hp = xp.maximum(0, st.e_hp - r.pdmg)
+    r.won = st.e_hp <= 0
+    alive = xp.not_(r.won)
+
+    edmg, axii_ok, burn, poisoned = calc_enemy_damage(
+        xp, action, st.trait, st.enemy, st.e_dmg_min, st.e_dmg_max,
+        st.yrden, r.potion_used, st.amulet, u)
+    r.axii_ok = xp.and_(alive, axii_ok)
+    burn = xp.and_(alive, burn)
+    burn_potion = xp.and_(burn, st.potion)
+    burn_herbs = xp.and_(burn, xp.and_(xp.not_(st.potion), st.herbs))
+    r.burned = xp.where(burn_potion, 1, xp.where(burn_herbs, 2, 0))
+    st.potion = xp.and_(st.potion, xp.not_(burn_potion))
+    st.herbs = xp.and_(st.herbs, xp.not_(burn_herbs))
+    st.poison = xp.where(xp.and_(xp.and_(alive, poisoned), st.poison <= 0), 3, st.poison)
+
+    # смертельный удар: сперва сгорает осколок зеркала, затем спасает судьба (враг при этом лечится)
+    r.mirror_saved = xp.and_(alive, xp.and_(st.hp - edmg <= 0, st.mirror))
+    edmg = xp.where(r.mirror_saved, xp.maximum(0, st.hp - 1), edmg)
+    st.mirror = xp.and_(st.mirror, xp.not_(r.mirror_saved))
+    r.fate_saved = xp.and_(alive, xp.and_(st.hp - edmg <= 0, st.fate > 0))
+    edmg = xp.where(r.fate_saved, xp.maximum(0, st.hp - 1), edmg)
+    st.fate = xp.where(r.fate_saved, st.fate - 1, st.fate)
+    st.e_hp = xp.where(r.fate_saved, xp.minimum(st.e_max, st.e_hp + xp.maximum(1, edmg // 3)), st.e_hp)
+    r.edmg = xp.where(alive, edmg, 0)
+
+    # зелье тратится после того, как сработало
+    st.potion = xp.and_(st.potion, xp.not_(xp.and_(alive, r.potion_used)))
+    if action != "yrden":
+        st.yrden = xp.where(xp.and_(alive, st.yrden > 0), st.yrden - 1, st.yrden)
+    r.hp_before_poison = st.hp
+    r.poison_tick = xp.and_(alive, st.poison > 0)
+    st.hp = xp.where(r.poison_tick, xp.maximum(0, st.hp - 1), st.hp)
+    st.poison = xp.where(r.poison_tick, st.poison - 1, st.poison)
+    r.lost = xp.and_(alive, st.hp <= 0)
+    return r
+
+def combat_state(s: Session) -> CombatState:
+    c = s.combat
+    return CombatState(
+        hp=s.hp, dmg_min=s.dmg_min, dmg_max=s.dmg_max,
+        enemy=c.enemy, trait=(c.trait or "").strip(),
+        e_hp=c.hp, e_max=c.max_hp, e_dmg_min=c.dmg_min, e_dmg_max=c.dmg_max,
+        yrden=s.yrden_turns, poison=s.poison_turns, fate=s.fate,
+        silver=have(s, IT_SILVER), amulet=have(s, IT_AMULET),
+        potion=have(s, IT_POTION), herbs=have(s, IT_HERBS), mirror=have(s, IT_MIRROR),
+    )
+
+def apply_combat_state(s: Session, st: CombatState):
+    s.hp, s.yrden_turns, s.poison_turns, s.fate = st.hp, st.yrden, st.poison, st.fate
+    s.combat.hp = st.e_hp
+    for i, has in ((IT_POTION, st.potion), (IT_HERBS, st.herbs), (IT_MIRROR, st.mirror)):
+        (add_item if has else drop_item)(s, i)
 
 # === RENDER LOCATION ===
 async def show_location(chat_id: int, s: Session, loc_key: str):
+    node = GRAPH.get(loc_key)
+    if node is None:
+        # узел убрали при перезагрузке контента, а кнопка на него осталась в старом сообщении
+        await notify(chat_id, "Этой тропы больше нет — возвращаемся к началу пути.")
+        loc_key = "intro"
+        node = GRAPH[loc_key]
     s.location = loc_key
-    node = NODES[loc_key]
 
     # мгновенные эффекты (штраф hp)
-    if "hp_delta" in node:
-        s.hp += node["hp_delta"]
+    if node.hp_delta:
+        s.hp += node.hp_delta
         s.hp = max(0, s.hp)
         s.hp = min(s.hp, s.max_hp)
 
     # бой?
-    if "combat" in node and isinstance(node["combat"], Combat):
-        # старт боя
-        c = node["combat"]
-        # создаём новую копию, чтобы не шарить один Combat на всех
-        s.combat = Combat(**asdict(c))
-        # адаптив: если у героя мало жизней, ослабим врага на 20%
-        if s.hp <= 3:
-            s.combat.max_hp = int(s.combat.max_hp * 0.8)
-            s.combat.hp = s.combat.max_hp
+    if node.combat is not None:
+        # старт боя; создаём новую копию, чтобы не шарить один Combat на всех
+        s.combat = Combat(**asdict(node.combat))
+        s.combat.max_hp = s.combat.hp = adaptive_enemy_hp(s.hp, s.combat.max_hp)
         caption, markup, img = build_combat_message(s)
-        await send_photo(chat_id, img, caption, markup)
+        s.combat_msg = await send_photo(chat_id, img, caption, markup) or 0
         return
 
-    # обычная локация
-    text = node["text"]
-    buttons_rows = []
-    for row in node.get("buttons", []):
-        row_btns = []
-        for b in row:
-            if "to" in b:
-                row_btns.append({"text": b["text"], "data": f"go:{b['to']}"})
-            elif "data" in b:
-                row_btns.append({"text": b["text"], "data": b["data"]})
-            elif "hint" in b:
-                row_btns.append({"text": b["text"], "data": f"hint:{loc_key}"})
-        buttons_rows.append(row_btns)
+    # обычная локация: всё уже собрано при компиляции
+    await send_photo(chat_id, node.img, node.text, node.reply_markup)
+
+# === IMAGE PREWARM ===
+# Все картинки из паков контента скачиваются, ужимаются и складываются в IMG_STORE под sha256
+# содержимого; затем каждая один раз загружается в служебный чат, и её file_id попадает
+# в FILE_IDS — первый игрок после деплоя уже не ждёт, пока Telegram сходит на Unsplash.
+try:
+    from PIL import Image
+except ImportError:  # без Pillow храним оригиналы как есть
+    Image = None
+
+def all_image_urls() -> List[str]:
+    urls = dict.fromkeys(IMG.values())
+    for node in GRAPH.values():
+        if node.img:
+            urls[node.img] = None
+        if node.combat is not None:
+            urls[node.combat.img] = None
+    return list(urls)
+
+def resize_image(raw: bytes) -> bytes:
+    if Image is None:
+        return raw
+    im = Image.open(io.BytesIO(raw))
+    im = im.convert("RGB")
+    im.thumbnail((IMG_MAX_SIDE, IMG_MAX_SIDE))
+    out = io.BytesIO()
+    im.save(out, "JPEG", quality=85, optimize=True)
+    return out.getvalue()
+
+def _store_index_path() -> str:
+    return os.path.join(IMG_STORE, "index.json")
+
+def _load_store_index() -> Dict[str, str]:
+    try:
+        with open(_store_index_path(), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _store_image(data: bytes) -> str:
+    digest = hashlib.sha256(data).hexdigest()
+    path = os.path.join(IMG_STORE, f"{digest}.jpg")
+    if not os.path.exists(path):
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    return digest
+
+async def fetch_to_store(urls: List[str]) -> Dict[str, str]:
+    # url -> sha256; уже скачанные (по index.json) повторно не качаем
+    os.makedirs(IMG_STORE, exist_ok=True)
+    index = _load_store_index()
+    async with httpx.AsyncClient(timeout=60, follow_redirects=True) as cl:
+        for url in urls:
+            digest = index.get(url)
+            if digest and os.path.exists(os.path.join(IMG_STORE, f"{digest}.jpg")):
+                continue
+            try:
+                r = await cl.get(url)
+                r.raise_for_status()
+                data = await asyncio.to_thread(resize_image, r.content)
+            except Exception:
+                continue  # не скачалось — эта картинка останется по URL
+            index[url] = await asyncio.to_thread(_store_image, data)
+    tmp = _store_index_path() + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(index, f, ensure_ascii=False, indent=1)
+    os.replace(tmp, _store_index_path())
+    return index
+
+async def upload_photo(chat_id: str, data: bytes) -> dict:
+    return await _tg_call("sendPhoto", chat_id, lambda: tg_client().post(
+        f"{TG}/sendPhoto",
+        data={"chat_id": chat_id, "disable_notification": "true"},
+        files={"photo": ("image.jpg", data, "image/jpeg")},
+    ))
+
+async def prewarm_images(chat_id: str = PREWARM_CHAT_ID, upload: bool = True) -> dict:
+    urls = all_image_urls()
+    index = await fetch_to_store(urls)
+    uploaded = 0
+    by_digest: Dict[str, dict] = {}  # одинаковые картинки под разными URL грузим один раз
+    if upload and chat_id:
+        for url in urls:
+            digest = index.get(url)
+            if not digest or url in FILE_IDS:
+                continue
+            res = by_digest.get(digest)
+            if res is None:
+                with open(os.path.join(IMG_STORE, f"{digest}.jpg"), "rb") as f:
+                    data = f.read()
+                try:
+                    res = await upload_photo(chat_id, data)
+                except Exception:
+                    continue
+                by_digest[digest] = res
+                uploaded += 1
+                msg_id = (res.get("result") or {}).get("message_id")
+                if msg_id:
+                    try:
+                        await tg("deleteMessage", {"chat_id": chat_id, "message_id": msg_id})
+                    except Exception:
+                        pass
+            await remember_file_id(url, res)
+    return {"images": len(urls), "stored": len(index), "uploaded": uploaded, "file_ids": len(FILE_IDS)}
+
+# === UPDATE DECODING ===
+# Из апдейта берём только то, чем пользуется бот, в плоские структуры. Всё, что не похоже
+# на апдейт (не те типы, нет чата), отбрасывается с ValueError ещё до какой-либо работы.
+@dataclass(slots=True)
+class Message:
+    message_id: int
+    chat_id: int
+    text: str
+
+@dataclass(slots=True)
+class CallbackQuery:
+    id: str
+    chat_id: int
+    message_id: int
+    data: str
+
+@dataclass(slots=True)
+class Update:
+    update_id: Optional[int] = None
+    message: Optional[Message] = None  # только текстовые сообщения
+    callback_query: Optional[CallbackQuery] = None
+
+    @property
+    def chat_id(self) -> Optional[int]:
+        if self.message is not None:
+            return self.message.chat_id
+        if self.callback_query is not None:
+            return self.callback_query.chat_id
+        return None
+
+def _typed(v, t):
+    if not isinstance(v, t) or isinstance(v, bool):
+        raise ValueError("malformed update")
+    return v
+
+def update_from_dict(d: dict) -> Update:
+    try:
+        upd = Update()
+        if d.get("update_id") is not None:
+            upd.update_id = _typed(d["update_id"], int)
+        msg = d.get("message")
+        if msg is not None and msg.get("text") is not None:
+            upd.message = Message(
+                message_id=_typed(msg.get("message_id", 0), int),
+                chat_id=_typed(msg["chat"]["id"], int),
+                text=_typed(msg["text"], str),
+            )
+        cq = d.get("callback_query")
+        # без message — нажатие под inline-сообщением: таких бот не шлёт, апдейт просто пропускаем
+        cq_msg = cq.get("message") if cq is not None else None
+        if cq_msg is not None:
+            upd.callback_query = CallbackQuery(
+                id=_typed(cq["id"], str),
+                chat_id=_typed(cq_msg["chat"]["id"], int),
+                message_id=_typed(cq_msg.get("message_id", 0), int),
+                data=_typed(cq.get("data", ""), str),
+            )
+        return upd
+    except (KeyError, TypeError, AttributeError):
+        raise ValueError("malformed update")
+
+def decode_update(raw: bytes) -> Update:
+    try:
+        d = jloads(raw)
+    except ValueError:
+        raise ValueError("invalid json")
+    # JSON от Telegram, который бот не понимает, не ошибка запроса: на не-2xx Telegram
+    # повторяет апдейт снова и снова, поэтому такой апдейт становится пустым и отбрасывается
+    if isinstance(d, dict):
+        try:
+            return update_from_dict(d)
+        except ValueError:
+            pass
+    count("bot_update_errors_total", "malformed")
+    return Update()
+
+def json_response(obj) -> Response:
+    return Response(content=jdumps(obj), media_type="application/json")
 
-    await send_photo(chat_id, node["img"], text, kb(buttons_rows) if buttons_rows else None)
+_OK = jdumps({"ok": True})
 
 # === ENDPOINTS ===
 @app.get("/")
 def ok():
     return {"status": "ok"}
 
+@app.get("/stats")
+def stats():
+    return {
+        "sessions": {**SESS.stats(), "dirty": len(_dirty), "spilled": len(_spilled)},
+        "chat_locks": len(_chat_locks),
+        "updates": DEDUP.stats(),
+        "outbox": OUTBOX.stats(),
+        "webhook_queue": _update_queue.qsize() if _update_queue is not None else None,
+        "content": {"version": CONTENT_VERSION, "nodes": len(GRAPH), "packs": {p.name: p.version for p in _PACKS.values()},
+                    "unreachable": CONTENT_GRAPH.reachable.count(False), "warnings": len(CONTENT_GRAPH.warnings)},
+    }
+
+@app.get("/metrics")
+def metrics():
+    return Response(content=render_metrics({
+        "bot_sessions_active": ("gauge", "Сессии в кэше памяти", len(SESS)),
+        "bot_combats_active": ("gauge", "Сессии с идущим боем",
+                               sum(1 for s in SESS.values() if s.combat is not None)),
+        "bot_sessions_dirty": ("gauge", "Изменённые, ещё не записанные сессии", len(_dirty) + len(_spilled)),
+        "bot_chat_locks": ("gauge", "Чаты с апдейтом в работе или в очереди", len(_chat_locks)),
+        "bot_webhook_queue": ("gauge", "Апдейты в очереди на обработку (WEBHOOK_QUEUE)",
+                              _update_queue.qsize() if _update_queue is not None else 0),
+        "bot_outbox_waiting": ("gauge", "Исходящие вызовы, ждущие лимита отправки или повтора", OUTBOX.waiting),
+        "bot_session_cache_hits_total": ("counter", "Попадания в кэш сессий", SESS.hits),
+        "bot_session_cache_misses_total": ("counter", "Промахи кэша сессий", SESS.misses),
+        "bot_updates_duplicate_total": ("counter", "Отброшенные повторы update_id", DEDUP.duplicates),
+    }), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.on_event("startup")
+async def _open_tg_client():
+    tg_client()
+
+# Очередь апдейтов (WEBHOOK_QUEUE > 0): вебхук проверяет апдейт, кладёт его и сразу отвечает 200,
+# так что медленный Bot API не держит HTTP-обработчики и не вызывает повторов вебхука.
+# Порядок внутри чата сохраняется: обработчик берёт апдейт и, не отдавая управление, встаёт
+# в очередь chat_lock — замок достаётся апдейтам чата в порядке прихода.
+_update_queue: Optional[asyncio.Queue] = None
+_workers: List[asyncio.Task] = []
+BUSY_TEXT = "Сейчас очень много игроков — повтори через пару секунд."
+
+async def _update_worker(q: asyncio.Queue):
+    while True:
+        ts, upd = await q.get()
+        try:
+            if upd.callback_query is not None and time.monotonic() - ts > CALLBACK_MAX_AGE:
+                # игрок уже не ждёт, а ответить на такое нажатие Telegram всё равно не даст
+                count("bot_shed_total", "stale_callback")
+                continue
+            await handle_update(upd)
+        except Exception:
+            pass  # уже посчитано в bot_update_errors_total
+        finally:
+            q.task_done()
+
+def _shed(upd: Update) -> Response:
+    # очередь полна: отвечаем «занято» прямо в теле вебхука, без единого исходящего запроса
+    count("bot_shed_total", "queue_full")
+    if upd.callback_query is not None:
+        return json_response({"method": "answerCallbackQuery", "callback_query_id": upd.callback_query.id,
+                              "text": BUSY_TEXT})
+    if upd.message is not None:
+        return json_response({"method": "sendMessage", "chat_id": upd.message.chat_id, "text": BUSY_TEXT})
+    return Response(content=_OK, media_type="application/json")
+
+@app.on_event("startup")
+async def _start_update_workers():
+    global _update_queue
+    if WEBHOOK_QUEUE > 0:
+        _update_queue = asyncio.Queue(WEBHOOK_QUEUE)
+        _workers[:] = [asyncio.create_task(_update_worker(_update_queue)) for _ in range(WEBHOOK_WORKERS)]
+
+@app.on_event("shutdown")
+async def _stop_update_workers():
+    # принятое дорабатываем (до 10 с), пока клиент Bot API и хранилище сессий ещё открыты
+    global _update_queue
+    q, _update_queue = _update_queue, None
+    if q is not None:
+        try:
+            await asyncio.wait_for(q.join(), 10)
+        except asyncio.TimeoutError:
+            pass
+    for task in _workers:
+        task.cancel()
+    _workers.clear()
+
+@app.on_event("startup")
+async def _load_file_ids():
+    load_file_ids()
+
+_bg_tasks = set()
+
+def _spawn(coro):
+    # фоновая задача; держим ссылку, чтобы её не собрал сборщик мусора
+    task = asyncio.create_task(coro)
+    _bg_tasks.add(task)
+    task.add_done_callback(_bg_tasks.discard)
+
+@app.on_event("startup")
+async def _prewarm_images():
+    # прогрев идёт фоном: вебхук начинает принимать апдейты сразу
+    if PREWARM_CHAT_ID:
+        _spawn(prewarm_images())
+
+async def _reload_logged():
+    try:
+        print("content reloaded:", await reload_content())
+    except (OSError, ContentError) as e:
+        print("content reload failed:", e)
+
+@app.on_event("startup")
+async def _reload_on_sighup():
+    # kill -HUP <pid> — перечитать паки контента без перезапуска
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, lambda: _spawn(_reload_logged()))
+    except (AttributeError, NotImplementedError, RuntimeError):
+        pass  # Windows или цикл не в главном потоке
+
+@app.post(f"/admin/reload/{WEBHOOK_SECRET}")
+async def admin_reload():
+    try:
+        return await reload_content()
+    except (OSError, ContentError) as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+@app.on_event("shutdown")
+async def _close_tg_client():
+    await close_tg_client()
+
+_flusher: Optional[asyncio.Task] = None
+
+@app.on_event("startup")
+async def _start_session_flusher():
+    global _flusher
+    session_store()
+    _flusher = asyncio.create_task(_session_flusher())
+
+@app.on_event("shutdown")
+async def _stop_session_flusher():
+    global _store
+    if _flusher:
+        _flusher.cancel()
+    await flush_sessions()
+    session_store().close()
+    _store = None
+
 @app.on_event("startup")
 async def _set_webhook():
     # Автоустановка вебхука при старте
@@ -817,234 +2186,514 @@ async def _set_webhook():
 @app.post(f"/webhook/{WEBHOOK_SECRET}")
 async def webhook(request: Request):
     try:
-        upd = await request.json()
+        upd = decode_update(await request.body())
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if upd.chat_id is None:
+        return Response(content=_OK, media_type="application/json")
+
+    q = _update_queue
+    if q is not None:
+        try:
+            q.put_nowait((time.monotonic(), upd))
+        except asyncio.QueueFull:
+            return _shed(upd)
+        return Response(content=_OK, media_type="application/json")
+
+    if not WEBHOOK_REPLY:
+        await handle_update(upd)
+        return Response(content=_OK, media_type="application/json")
+
+    # режим ответа вебхуком: последний вызов апдейта уходит в теле ответа
+    token = _reply.set([])
+    try:
+        await handle_update(upd)
+        held = _reply.get()
+    finally:
+        _reply.reset(token)
+    if held:
+        method, payload = held[0]
+        return json_response({"method": method, **payload})
+    return Response(content=_OK, media_type="application/json")
+
+class UpdateDedup:
+    # Окно последних update_id: Telegram повторяет вебхук, если мы отвечаем медленно.
+    def __init__(self, window: float, max_size: int):
+        self.window = window
+        self.max_size = max_size
+        self._seen: "OrderedDict[int, float]" = OrderedDict()
+        self.total = 0
+        self.duplicates = 0
+
+    def seen(self, update_id: int) -> bool:
+        now = time.monotonic()
+        self.total += 1
+        deadline = now - self.window
+        while self._seen:
+            oldest, ts = next(iter(self._seen.items()))
+            if ts > deadline and len(self._seen) < self.max_size:
+                break
+            del self._seen[oldest]
+        if update_id in self._seen:
+            self.duplicates += 1
+            return True
+        self._seen[update_id] = now
+        return False
+
+    def forget(self, update_id: int):
+        # апдейт упал — пусть повтор от Telegram пройдёт
+        self._seen.pop(update_id, None)
+
+    def stats(self) -> dict:
+        rate = self.duplicates / self.total if self.total else 0.0
+        return {"total": self.total, "duplicates": self.duplicates, "duplicate_rate": round(rate, 4),
+                "window_size": len(self._seen)}
+
+DEDUP = UpdateDedup(DEDUP_WINDOW, DEDUP_MAX)
+
+# Апдейты одного чата обрабатываются строго по очереди (между await-ами сессия меняется),
+# разные чаты — параллельно. Замок живёт, пока на нём кто-то есть, потом удаляется.
+_chat_locks: Dict[int, list] = {}  # chat_id -> [Lock, сколько держат/ждут]
+SESS.busy = _chat_locks.__contains__
+
+@asynccontextmanager
+async def chat_lock(chat_id: int):
+    entry = _chat_locks.get(chat_id)
+    if entry is None:
+        entry = _chat_locks[chat_id] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del _chat_locks[chat_id]
+
+# вид апдейта — метка для метрик
+_CMD_KINDS = {"/жизни": "hp", "/hp": "hp", "/инвентарь": "inv", "/inv": "inv",
+              "/помощь": "help", "/help": "help", "/сброс": "reset", "/reset": "reset"}
+_OP_KINDS = {OP_GO: "go", OP_HINT: "hint", OP_TAKE: "take", OP_BREW: "brew"}
+
+def update_kind(upd: Update) -> str:
+    if upd.message is not None:
+        t = norm(upd.message.text)
+        if t.startswith("/start"):
+            return "cmd:start"
+        return "cmd:" + _CMD_KINDS[t] if t in _CMD_KINDS else "text"
+    parsed = decode_cb(upd.callback_query.data)
+    if parsed is None:
+        return "unknown"
+    op, args = parsed
+    if op == OP_FIGHT:
+        return "fight:" + FIGHT_ACTIONS[args[0]] if args and args[0] < len(FIGHT_ACTIONS) else "unknown"
+    return _OP_KINDS.get(op, "unknown")
+
+def _session_snapshot(s: Session) -> Tuple[Session, int, int]:
+    # состояние до апдейта: копия полей и длина журнала (он только дописывается)
+    snap = copy(s)
+    if s.combat is not None:
+        snap.combat = copy(s.combat)
+    return snap, len(s.actions), s.actions_n
+
+def _session_restore(chat_id: int, snapshot: Tuple[Session, int, int]):
+    snap, log_len, log_n = snapshot
+    del snap.actions[log_len:]  # буфер журнала общий с изменённой сессией
+    snap.actions_n = log_n
+    SESS[chat_id] = snap
+
+async def handle_update(upd: Update):
+    update_id = upd.update_id
+    if update_id is not None and DEDUP.seen(update_id):
+        return
+    chat_id = upd.chat_id
+    if chat_id is None:
+        return
+    kind = update_kind(upd)
+    t0 = time.perf_counter()
+    try:
+        async with chat_lock(chat_id):
+            t1 = time.perf_counter()
+            observe("bot_stage_seconds", "lock_wait", t1 - t0)
+            snapshot = _session_snapshot(await sload(chat_id))
+            observe("bot_stage_seconds", "session_load", time.perf_counter() - t1)
+            token = _notices.set([])
+            try:
+                await _handle_update(upd)
+                await flush_notices(chat_id)
+            except Exception:
+                # апдейт упал посреди обработки (например, Bot API ответил 5xx) — откатываем сессию,
+                # чтобы повтор от Telegram сыграл тот же ход с теми же бросками, а не второй ход
+                _session_restore(chat_id, snapshot)
+                raise
+            finally:
+                _notices.reset(token)
+                mark_dirty(chat_id)
     except Exception:
-        raise HTTPException(status_code=400, detail="invalid json")
+        count("bot_update_errors_total", kind)
+        if update_id is not None:
+            DEDUP.forget(update_id)
+        raise
+    finally:
+        observe("bot_update_seconds", kind, time.perf_counter() - t0)
 
+# сообщение, на кнопку которого нажали (для правки на месте); выставляется на время обработчика
+_cb_message_id: ContextVar[Optional[int]] = ContextVar("_cb_message_id", default=None)
+
+async def _handle_update(upd: Update):
     # messages
-    msg = upd.get("message")
-    if msg and "text" in msg:
-        chat_id = msg["chat"]["id"]
-        text = msg.get("text", "")
-        t = norm(text)
+    msg = upd.message
+    if msg is not None:
+        chat_id = msg.chat_id
+        t = norm(msg.text)
 
         # команды
         if t.startswith("/start"):
             SESS[chat_id] = Session()
+            log_action(SESS[chat_id], "/start")
             intro = (
                 "Коловрат — ведьмак Древней Руси. Его призвали в северный уезд: ночью в лесу шепчут огоньки, "
                 "в деревне пропадают люди, на болоте воет Волколак, а в каменных кругах стынет Морозница. "
                 "Коловоротный амулет обещает дорогу к алтарю, где скрыта причина беды. "
-                "Тебя ждут 20 локаций, бои и загадки. Управление *кнопками*. Удачи!\n"
+                "Тебя ждут 20 локаций, бои и загадки. Управление *кнопками*. Удачи!"
             )
-            await send_photo(chat_id, IMG["village"], intro)
+            await notify(chat_id, intro)
             await show_location(chat_id, SESS[chat_id], "intro")
-            return {"ok": True}
+            return
 
         if t in ("/жизни", "/hp"):
             s = sget(chat_id)
             await send_text(chat_id, f"❤ Твои жизни: {s.hp}/{s.max_hp}  [{hp_bar(s.hp, s.max_hp)}]")
-            return {"ok": True}
+            return
 
         if t in ("/инвентарь", "/inv"):
             s = sget(chat_id)
-            inv = ", ".join(s.inventory) if s.inventory else "пусто"
+            inv = ", ".join(s.inventory) or "пусто"
             markup = None
             if s.combat:
-                markup = kb([[{"text": "↩ Вернуться в бой", "data": "fight:status"}]])
+                markup = BACK_TO_COMBAT_MARKUP
             await send_text(chat_id, f"🎒 Инвентарь: {inv}", markup)
-            return {"ok": True}
+            return
 
         if t in ("/помощь", "/help"):
             await send_text(chat_id, "Игра кнопками. Подсказки скрыты и появляются по кнопке «Подсказка». "
                                      "Команды: /жизни /инвентарь /сброс /помощь.")
-            return {"ok": True}
+            return
 
         if t in ("/сброс", "/reset"):
             SESS[chat_id] = Session()
-            await send_text(chat_id, "Прогресс сброшен.")
+            log_action(SESS[chat_id], "/reset")
+            await notify(chat_id, "Прогресс сброшен.")
             await show_location(chat_id, SESS[chat_id], "intro")
-            return {"ok": True}
+            return
 
         await send_text(chat_id, "Используй *кнопки* ниже. Команды: /жизни /инвентарь /сброс /помощь.")
-        return {"ok": True}
+        return
 
     # callbacks (кнопки)
-    cq = upd.get("callback_query")
-    if cq:
-        data = cq.get("data", "")
-        chat_id = cq["message"]["chat"]["id"]
-        # acknowledge
+    cq = upd.callback_query
+    if cq is not None:
+        data = cq.data
+        chat_id = cq.chat_id
+        # подтверждение нажатия ни от чего не зависит — уходит параллельно с обработкой,
+        # и апдейт стоит одного обращения к Bot API по времени, а не двух
+        ack = asyncio.create_task(_answer_callback(cq.id))
         try:
-            await tg("answerCallbackQuery", {"callback_query_id": cq["id"]})
-        except Exception:
-            pass
+            s = sget(chat_id)
+            parsed = decode_cb(data)
+            handler = CALLBACKS.get(parsed[0]) if parsed else None
+            if handler is None:
+                # неизвестная кнопка
+                await send_text(chat_id, "Неизвестное действие.")
+                return
+            log_action(s, encode_cb(parsed[0], *parsed[1]))
+            token = _cb_message_id.set(cq.message_id)
+            try:
+                await handler(chat_id, s, parsed[1])
+            finally:
+                _cb_message_id.reset(token)
+        finally:
+            await ack
+
+async def _answer_callback(callback_query_id: str):
+    # Мимо tg(): сообщения чата идут строго по очереди, а отложенный вызов (WEBHOOK_REPLY)
+    # этот параллельный запрос отправлять раньше времени не должен.
+    try:
+        await _tg_post("answerCallbackQuery", {"callback_query_id": callback_query_id})
+    except Exception:
+        pass
 
-        s = sget(chat_id)
+# === CALLBACK HANDLERS ===
 
-        # hints
-        if data.startswith("hint:"):
-            _, key = data.split(":", 1)
-            if key == "combat" and s.combat:
-                await send_text(chat_id, f"💡 Подсказка (бой): {s.combat.hint}")
-            else:
-                node = NODES.get(key)
-                hint = None
-                if node:
-                    for row in node.get("buttons", []):
-                        for b in row:
-                            if "hint" in b:
-                                hint = b["hint"]
-                                break
-                    if hint:
-                        await send_text(chat_id, f"💡 Подсказка: {hint}")
-                    else:
-                        await send_text(chat_id, "Подсказка недоступна здесь.")
-            return {"ok": True}
-
-        # go:<loc>
-        if data.startswith("go:"):
-            _, to = data.split(":", 1)
-            await show_location(chat_id, s, to)
-            return {"ok": True}
-
-        # take:<item>:<next>
-        if data.startswith("take:"):
-            _, item, nxt = data.split(":", 2)
-            add_item(s, item)
-            await send_text(chat_id, f"Ты получил: *{item}*.")
-            await show_location(chat_id, s, nxt)
-            return {"ok": True}
-
-        # brew:<item>:<next>
-        if data.startswith("brew:"):
-            _, item, nxt = data.split(":", 2)
-            if item == "зелье":
-                if have(s, "травы"):
-                    add_item(s, "зелье")
-                    s.inventory = [x for x in s.inventory if norm(x) != "травы"]
-                    await send_text(chat_id, "Ты сварил *зелье*.")
-                else:
-                    await send_text(chat_id, "Нет трав — зелье не сварить.")
-            await show_location(chat_id, s, nxt)
-            return {"ok": True}
-
-        # fight:<action>
-        if data.startswith("fight:"):
-            if not s.combat:
-                await send_text(chat_id, "Сейчас не бой.")
-                return {"ok": True}
-
-            action = data.split(":", 1)[1]  # hit/igni/aard/potion/amulet/... 
-            c = s.combat
-            if action == "status":
-                caption, markup, img = build_combat_message(s)
-                await send_photo(chat_id, img, caption, markup)
-                return {"ok": True}
-
-            if action == "status":
-                caption, markup, img = build_combat_message(s)
-                await send_photo(chat_id, img, caption, markup)
-                return {"ok": True}
-
-            if action == "yrden":
-                s.yrden_turns = 2
-
-            # было ли зелье ДО расхода
-            potion_used = (action == "potion") and have(s, "зелье")
-
-            # урон игрока
-            pdmg = 0
-            if action in ("hit", "igni", "aard", "amulet"):
-                pdmg = calc_player_damage(action, s, c)
-                c.hp -= pdmg
-                c.hp = max(0, c.hp)
-
-            # победа до ответа врага
-            if c.hp <= 0:
-                await send_text(chat_id, f"🏆 {c.enemy} повержен!")
-                s.combat = None
-                await show_location(chat_id, s, c.win_to)
-                return {"ok": True}
-
-            # урон врага (с учётом, что зелье выпито именно в этот ход)
-            edmg = calc_enemy_damage(s, c, action, potion_used)
-            fate_saved = False
-            mirror_saved = False
-            # Если удар смертелен и у нас есть осколок зеркала — он спасает жизнь и сгорает
-            if s.hp - edmg <= 0 and have(s, "осколок зеркала"):
-                edmg = max(0, s.hp - 1)
-                # удалить осколок из инвентаря
-                s.inventory = [x for x in s.inventory if norm(x) != "осколок зеркала"]
-                mirror_saved = True
-            if s.hp - edmg <= 0 and s.fate > 0:
-                edmg = max(0, s.hp - 1)
-                s.fate -= 1
-                fate_saved = True
-                heal = max(1, edmg // 3)
-                c.hp = min(c.max_hp, c.hp + heal)
-
-            # теперь тратим зелье (после применения эффекта и корректного лога)
-            if potion_used:
-                s.inventory = [x for x in s.inventory if norm(x) != "зелье"]
-
-            # боевой лог и вывод
-            caption, markup, img = build_combat_message(s)
-            log = []
-            if action == "potion":
-                if potion_used:
-                    log.append("Ты *выпил зелье* — урон в этот ход снижен.")
-                else:
-                    log.append("Ты пытался выпить зелье, но его нет.")
-            elif action == "amulet":
-                log.append("Ты показал *амулет*.")
-            elif action == "hit":
-                log.append(f"Ты ударил: −{pdmg} HP у врага.")
-            elif action == "igni":
-                log.append(f"Применён *Игни*: −{pdmg} HP у врага.")
-            elif action == "aard":
-                log.append(f"Порыв *Аарда*: −{pdmg} HP у врага.")
-            elif action == "quen":
-                log.append("*Квен*: щит смягчит удар в этот ход.")
-            elif action == "yrden":
-                log.append("*Ирден*: враг ослаблен на 2 хода.")
-            elif action == "axii":
-                if hasattr(s, "_axii_last_success") and s._axii_last_success:
-                    log.append("*Аксий*: враг ошеломлён и пропускает ход!")
-                else:
-                    log.append("*Аксий*: не сработал.")
+@on_callback(OP_HINT)
+async def _cb_hint(chat_id: int, s: Session, args: List[int]):
+    if not args:
+        if s.combat:
+            await send_text(chat_id, f"💡 Подсказка (бой): {s.combat.hint}")
+        return
+    node = GRAPH.get(NODE_KEYS[args[0]])
+    if node:
+        if node.hint:
+            await send_text(chat_id, f"💡 Подсказка: {node.hint}")
+        else:
+            await send_text(chat_id, "Подсказка недоступна здесь.")
+
+@on_callback(OP_GO)
+async def _cb_go(chat_id: int, s: Session, args: List[int]):
+    await show_location(chat_id, s, NODE_KEYS[args[0]])
+
+@on_callback(OP_TAKE)
+async def _cb_take(chat_id: int, s: Session, args: List[int]):
+    item, nxt = args[0], NODE_KEYS[args[1]]
+    name = ITEMS[item]
+    add_item(s, item)
+    await notify(chat_id, f"Ты получил: *{name}*.")
+    await show_location(chat_id, s, nxt)
+
+@on_callback(OP_BREW)
+async def _cb_brew(chat_id: int, s: Session, args: List[int]):
+    item, nxt = args[0], NODE_KEYS[args[1]]
+    if item == IT_POTION:
+        if have(s, IT_HERBS):
+            add_item(s, IT_POTION)
+            drop_item(s, IT_HERBS)
+            await notify(chat_id, "Ты сварил *зелье*.")
+        else:
+            await notify(chat_id, "Нет трав — зелье не сварить.")
+    await show_location(chat_id, s, nxt)
+
+@on_callback(OP_FIGHT)
+async def _cb_fight(chat_id: int, s: Session, args: List[int]):
+    if not s.combat:
+        await send_text(chat_id, "Сейчас не бой.")
+        return
 
-            if edmg > 0:
-                log.append(f"{c.enemy} бьёт по тебе: −{edmg} HP.")
-            else:
-                log.append(f"{c.enemy} не смог причинить вреда в этот ход.")
-            if hasattr(s, "_burned_item_last") and s._burned_item_last:
-                log.append(f"Огонь врага сжёг *{s._burned_item_last}* из твоего инвентаря!")
-            if mirror_saved:
-                log.append("✨ Осколок зеркала вспыхнул и спас тебя от гибели!")
-            elif fate_saved:
-                log.append("⚖️ Судьба уберегла тебя от гибели (осталась 1 жизнь).")
-            if hasattr(s, "yrden_turns") and s.yrden_turns > 0 and action != "yrden":
-                s.yrden_turns -= 1
-
-            # тик яда в конце хода
-            if hasattr(s, "poison_turns") and s.poison_turns > 0:
-                s.hp = max(0, s.hp - 1)
-                s.poison_turns -= 1
-                log.append("☠️ Яд гложет тебя: −1 HP.")
-
-            await send_photo(chat_id, img, caption + "\n\n" + "\n".join(log), markup)
-
-            # поражение?
-            if s.hp <= 0:
-                s.finished = True
-                await send_text(chat_id, "💀 Жизни закончились. Нажми «Начать заново».")
-                s.combat = None
-                await show_location(chat_id, s, "finale")
-            return {"ok": True}
-
-        # неизвестная кнопка
-        await send_text(chat_id, "Неизвестное действие.")
-        return {"ok": True}
-
-    return {"ok": True}
+    action = FIGHT_ACTIONS[args[0]]
+    c = s.combat
+    if action == "status":
+        # кнопка «Вернуться в бой» стоит под текстом (/инвентарь) — править там нечего, шлём новое фото
+        caption, markup, img = build_combat_message(s)
+        s.combat_msg = await send_photo(chat_id, img, caption, markup) or 0
+        return
+
+    st = combat_state(s)
+    r = combat_turn(SCALAR, st, action, session_rolls(s, ROLLS_PER_TURN))
+    pdmg, edmg, potion_used = r.pdmg, r.edmg, r.potion_used
+    mirror_saved, fate_saved = r.mirror_saved, r.fate_saved
+    if not r.won:
+        s._axii_last_success = r.axii_ok
+        s._burned_item_last = ("", "зелье", "травы")[r.burned]
+    apply_combat_state(s, st)
+
+    # победа до ответа врага
+    if r.won:
+        await notify(chat_id, f"🏆 {c.enemy} повержен!")
+        s.combat = None
+        await show_location(chat_id, s, c.win_to)
+        return
+
+    # боевой лог и вывод; яд тикает в конце хода, подпись показывает жизни до него
+    caption, markup, img = build_combat_message(s, hp=r.hp_before_poison)
+    log = []
+    if action == "potion":
+        if potion_used:
+            log.append("Ты *выпил зелье* — урон в этот ход снижен.")
+        else:
+            log.append("Ты пытался выпить зелье, но его нет.")
+    elif action == "amulet":
+        log.append("Ты показал *амулет*.")
+    elif action == "hit":
+        log.append(f"Ты ударил: −{pdmg} HP у врага.")
+    elif action == "igni":
+        log.append(f"Применён *Игни*: −{pdmg} HP у врага.")
+    elif action == "aard":
+        log.append(f"Порыв *Аарда*: −{pdmg} HP у врага.")
+    elif action == "quen":
+        log.append("*Квен*: щит смягчит удар в этот ход.")
+    elif action == "yrden":
+        log.append("*Ирден*: враг ослаблен на 2 хода.")
+    elif action == "axii":
+        if s._axii_last_success:
+            log.append("*Аксий*: враг ошеломлён и пропускает ход!")
+        else:
+            log.append("*Аксий*: не сработал.")
+
+    if edmg > 0:
+        log.append(f"{c.enemy} бьёт по тебе: −{edmg} HP.")
+    else:
+        log.append(f"{c.enemy} не смог причинить вреда в этот ход.")
+    if s._burned_item_last:
+        log.append(f"Огонь врага сжёг *{s._burned_item_last}* из твоего инвентаря!")
+    if mirror_saved:
+        log.append("✨ Осколок зеркала вспыхнул и спас тебя от гибели!")
+    elif fate_saved:
+        log.append("⚖️ Судьба уберегла тебя от гибели (осталась 1 жизнь).")
+
+    if r.poison_tick:
+        log.append("☠️ Яд гложет тебя: −1 HP.")
+
+    # ход боя — правкой сообщения этого боя, а не новым фото; кнопка под старым сообщением
+    # (прошлый бой, прошлый статус) его не трогает — ход уходит новым фото
+    msg = _cb_message_id.get()
+    msg = msg if msg and msg == s.combat_msg else None
+    s.combat_msg = await edit_photo(chat_id, msg, img, caption + "\n\n" + "\n".join(log), markup) or 0
+
+    # поражение?
+    if s.hp <= 0:
+        s.finished = True
+        await notify(chat_id, "💀 Жизни закончились. Нажми «Начать заново».")
+        s.combat = None
+        await show_location(chat_id, s, "finale")
+
+
+# === LONG POLLING ===
+# Альтернатива вебхуку: тянем апдейты пачками через getUpdates и гоним через тот же handle_update.
+# Порядок внутри чата держит chat_lock, число одновременно обрабатываемых апдейтов — семафор.
+async def poll_updates(limit: int = POLL_LIMIT, timeout: int = POLL_TIMEOUT,
+                       concurrency: int = POLL_CONCURRENCY, stop: Optional[asyncio.Event] = None):
+    sem = asyncio.Semaphore(concurrency)
+    running = set()
+    offset = None
+
+    async def run(upd: Update):
+        try:
+            await handle_update(upd)
+        except Exception:
+            pass
+        finally:
+            sem.release()
+
+    # пока стоит вебхук, getUpdates не работает
+    await tg("deleteWebhook", {"drop_pending_updates": False})
+    while stop is None or not stop.is_set():
+        payload = {"timeout": timeout, "limit": limit, "allowed_updates": ["message", "callback_query"]}
+        if offset is not None:
+            payload["offset"] = offset
+        try:
+            res = await tg("getUpdates", payload, timeout=timeout + 10)
+        except Exception:
+            await asyncio.sleep(1)
+            continue
+        for raw in res.get("result", []):
+            offset = raw["update_id"] + 1
+            try:
+                upd = update_from_dict(raw)
+            except ValueError:
+                continue
+            await sem.acquire()
+            task = asyncio.create_task(run(upd))
+            running.add(task)
+            task.add_done_callback(running.discard)
+    if running:
+        await asyncio.gather(*running, return_exceptions=True)
+
+async def _poll_cli():
+    await _open_tg_client()
+    await _load_file_ids()
+    await _prewarm_images()
+    await _start_session_flusher()
+    try:
+        await poll_updates()
+    finally:
+        await _stop_session_flusher()
+        await _close_tg_client()
+
+# === REPLAY ===
+# Партия восстанавливается из seed и журнала нажатий: те же обработчики, что у живого бота,
+# но без сети (вызовы Bot API уходят в _sink). Для разбора жалоб и для проверки, что правка
+# движка не меняет исход записанных партий.
+def replay_update(uid: int, entry: str) -> Update:
+    if entry.startswith("/"):
+        return Update(message=Message(message_id=0, chat_id=uid, text=entry))
+    return Update(callback_query=CallbackQuery(id="replay", chat_id=uid, message_id=0, data=entry))
+
+async def replay_session(uid: int, seed: int, actions: List[str], calls: Optional[list] = None) -> Session:
+    # calls — куда сложить вызовы Bot API, если нужно посмотреть, что видел игрок
+    # живую сессию с тем же uid (если она в кэше) на время переигровки убираем и потом возвращаем
+    live = SESS.pop(uid) if uid in SESS else None
+    seed_token = _replay_seed.set(seed)
+    sink_token = _sink.set([] if calls is None else calls)
+    try:
+        SESS[uid] = Session(seed=seed)
+        for entry in actions:
+            await _handle_update(replay_update(uid, entry))
+        return SESS.pop(uid)
+    finally:
+        _sink.reset(sink_token)
+        _replay_seed.reset(seed_token)
+        if live is not None:
+            SESS[uid] = live
+
+async def replay_stored(uids: List[int]) -> dict:
+    # переиграть сохранённые сессии и сверить итог с записанным
+    store = session_store()
+    report = {"ok": 0, "mismatch": [], "skipped": 0}
+    for uid in uids or await asyncio.to_thread(store.uids):
+        data = await asyncio.to_thread(store.load, uid)
+        try:
+            saved = unpack_session(data) if data else None
+        except ValueError:
+            saved = None
+        if saved is None or saved.actions_cut:
+            report["skipped"] += 1
+            continue
+        got = await replay_session(uid, saved.seed, action_entries(saved))
+        if pack_session(got) == pack_session(saved):
+            report["ok"] += 1
+        else:
+            report["mismatch"].append(uid)
+    return report
+
+async def _replay_cli(uids: List[int]) -> int:
+    try:
+        report = await replay_stored(uids)
+    finally:
+        session_store().close()
+    print(report)
+    return 1 if report["mismatch"] else 0
+
+# === CLI ===
+async def _prewarm_cli():
+    load_file_ids()
+    try:
+        print(await prewarm_images())
+    finally:
+        await close_tg_client()
+
+def _check_cli() -> int:
+    # паки и граф проверяются заново, без артефакта; артефакт пишется, только если ошибок нет
+    packs, _ = read_packs(CONTENT_DIR)
+    try:
+        _, _, report = check_content(packs)
+    except ContentError as e:
+        print(e)
+        return 1
+    for w in report.warnings:
+        print("warning:", w)
+    print(f"{len(report.nodes)} nodes, {sum(report.reachable)} reachable, "
+          f"shortest run: {' -> '.join(report.path_to_finale('intro'))}")
+    write_graph_artifact(GRAPH_ARTIFACT, report)
+    write_ids()
+    print("graph:", GRAPH_ARTIFACT, "ids:", CONTENT_IDS)
+    return 0
+
+if __name__ == "__main__":
+    import sys
+    cmd = sys.argv[1] if len(sys.argv) > 1 else ""
+    if cmd == "prewarm":
+        # python main.py prewarm — скачать, ужать и загрузить все картинки заранее
+        asyncio.run(_prewarm_cli())
+    elif cmd == "replay":
+        # python main.py replay [uid ...] — переиграть сохранённые партии и сверить результат
+        sys.exit(asyncio.run(_replay_cli([int(a) for a in sys.argv[2:]])))
+    elif cmd == "check":
+        # python main.py check — проверить паки контента и собрать артефакт графа (код 1 при ошибках)
+        sys.exit(_check_cli())
+    elif cmd == "poll":
+        # python main.py poll — работать через getUpdates, без публичного URL
+        try:
+            asyncio.run(_poll_cli())
+        except KeyboardInterrupt:
+            pass
+    else:
+        print("usage: python main.py prewarm|poll|replay|check")
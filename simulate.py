@@ -0,0 +1,219 @@
+
+# Монте-Карло боёв для баланса: много боёв на врага и стратегию, пачками в массивах NumPy.
+# Правила не переписаны заново — это main.combat_turn, тот же код, что ведёт бой в боте,
+# только над массивами. Поэтому цифры симулятора не разъедутся с игрой.
+#   python simulate.py                                 — все враги, все стратегии
+#   python simulate.py --enemy werewolf --strategy hit --items silver,amulet --fights 1000000
+#   python simulate.py --selfcheck                     — сверить пачечный прогон с поштучным
+# Нужен numpy (в requirements бота его нет: pip install numpy).
+
+import os
+import sys
+import json
+import argparse
+
+import numpy as np
+
+os.environ.setdefault("BOT_TOKEN", "simulate")
+import main  # noqa: E402
+from main import SCALAR, CombatState, Session, combat_turn, adaptive_enemy_hp, ROLLS_PER_TURN  # noqa: E402
+
+
+class NP:
+    # те же операции, что main.SCALAR, но над массивами
+    where = staticmethod(np.where)
+    maximum = staticmethod(np.maximum)
+    minimum = staticmethod(np.minimum)
+    and_ = staticmethod(np.logical_and)
+    not_ = staticmethod(np.logical_not)
+
+    @staticmethod
+    def floor(x):
+        return np.floor(x).astype(np.int64)
+
+    @staticmethod
+    def round(x):
+        return np.round(x).astype(np.int64)
+
+
+ITEM_FLAGS = {
+    "silver": "серебряный клинок",
+    "amulet": "амулет",
+    "potion": "зелье",
+    "herbs": "травы",
+    "mirror": "осколок зеркала",
+}
+
+# стратегия: (номер хода, особенность врага) -> действие
+STRATEGIES = {
+    "hit": lambda t, trait: "hit",
+    "igni": lambda t, trait: "igni",
+    "aard": lambda t, trait: "aard",
+    "best": lambda t, trait: {"weak_to_igni": "igni", "weak_to_aard": "aard"}.get(trait, "hit"),
+    "quen-hit": lambda t, trait: "quen" if t % 2 == 0 else "hit",
+    "yrden-hit": lambda t, trait: "yrden" if t % 3 == 0 else "hit",
+    "axii-hit": lambda t, trait: "axii" if t % 2 == 0 else "hit",
+    "potion-hit": lambda t, trait: "potion" if t == 0 else "hit",
+}
+
+_ARRAY_FIELDS = ("hp", "e_hp", "yrden", "poison", "fate", "potion", "herbs", "mirror")
+
+
+def enemies(reachable_only: bool = False):
+    # недостижимые из intro бои (см. python main.py check) по умолчанию не считаем
+    g = main.CONTENT_GRAPH
+    live = {key for key, ok in zip(g.nodes, g.reachable) if ok}
+    return {key: node.combat for key, node in main.GRAPH.items()
+            if node.combat is not None and (key in live or not reachable_only)}
+
+
+def initial_state(tpl: main.Combat, n: int, hp: int, items: set) -> CombatState:
+    s = Session()
+    e_max = adaptive_enemy_hp(hp, tpl.max_hp)
+    flag = lambda name: np.full(n, name in items)  # noqa: E731
+    return CombatState(
+        hp=np.full(n, hp, dtype=np.int64), dmg_min=s.dmg_min, dmg_max=s.dmg_max,
+        enemy=tpl.enemy, trait=(tpl.trait or "").strip(),
+        e_hp=np.full(n, e_max, dtype=np.int64), e_max=e_max,
+        e_dmg_min=tpl.dmg_min, e_dmg_max=tpl.dmg_max,
+        yrden=np.zeros(n, dtype=np.int64), poison=np.zeros(n, dtype=np.int64),
+        fate=np.full(n, s.fate, dtype=np.int64),
+        silver=flag("silver"), amulet=flag("amulet"), potion=flag("potion"),
+        herbs=flag("herbs"), mirror=flag("mirror"),
+    )
+
+
+def run_batch(tpl: main.Combat, strategy, n: int, hp: int, items: set, rng, max_turns: int) -> dict:
+    st = initial_state(tpl, n, hp, items)
+    active = np.ones(n, dtype=bool)
+    won = np.zeros(n, dtype=bool)
+    lost = np.zeros(n, dtype=bool)
+    turns = np.zeros(n, dtype=np.int64)
+    taken = np.zeros(n, dtype=np.int64)
+    fate_used = np.zeros(n, dtype=bool)
+    for t in range(max_turns):
+        if not active.any():
+            break
+        before = {f: getattr(st, f) for f in _ARRAY_FIELDS}
+        r = combat_turn(NP, st, strategy(t, st.trait), rng.random((ROLLS_PER_TURN, n)))
+        # закончившиеся бои замораживаем
+        for f in _ARRAY_FIELDS:
+            setattr(st, f, np.where(active, getattr(st, f), before[f]))
+        taken += np.where(active, r.edmg, 0)
+        fate_used |= active & r.fate_saved
+        turns += active
+        won |= active & r.won
+        lost |= active & r.lost
+        active &= ~(r.won | r.lost)
+    return {"won": won, "lost": lost, "turns": turns, "hp_lost": hp - st.hp, "taken": taken,
+            "fate_used": fate_used}
+
+
+def simulate(tpl: main.Combat, strategy, fights: int, hp: int, items: set, seed: int,
+             batch: int = 200_000, max_turns: int = 200) -> dict:
+    rng = np.random.default_rng(seed)
+    parts = []
+    left = fights
+    while left > 0:
+        n = min(batch, left)
+        parts.append(run_batch(tpl, strategy, n, hp, items, rng, max_turns))
+        left -= n
+    res = {k: np.concatenate([p[k] for p in parts]) for k in parts[0]}
+    won = res["won"]
+    pct = lambda a, q: int(np.percentile(a, q)) if a.size else None  # noqa: E731
+    return {
+        "fights": fights,
+        "win_rate": float(won.mean()),
+        "loss_rate": float(res["lost"].mean()),
+        "timeout_rate": float((~won & ~res["lost"]).mean()),
+        "turns_to_kill": {"mean": float(res["turns"][won].mean()) if won.any() else None,
+                          "p50": pct(res["turns"][won], 50), "p90": pct(res["turns"][won], 90)},
+        "hp_lost": {"mean": float(res["hp_lost"].mean()), "p50": pct(res["hp_lost"], 50),
+                    "p90": pct(res["hp_lost"], 90), "max": int(res["hp_lost"].max())},
+        "damage_taken": {"mean": float(res["taken"].mean()), "p50": pct(res["taken"], 50),
+                         "p90": pct(res["taken"], 90)},
+        "fate_used_rate": float(res["fate_used"].mean()),
+    }
+
+
+def selfcheck(n: int = 1000, seed: int = 1) -> int:
+    # пачечный прогон combat_turn должен совпасть с поштучным на тех же случайных числах
+    rng = np.random.default_rng(seed)
+    bad = 0
+    for key, tpl in enemies().items():
+        for action in main.FIGHT_ACTIONS:
+            if action == "status":
+                continue
+            st = initial_state(tpl, n, 50, set())
+            st.hp = rng.integers(1, 51, n)
+            st.e_hp = rng.integers(1, st.e_max + 1, n)
+            st.yrden = rng.integers(0, 3, n)
+            st.poison = rng.integers(0, 4, n)
+            st.fate = rng.integers(0, 2, n)
+            for f in ("silver", "amulet", "potion", "herbs", "mirror"):
+                setattr(st, f, rng.random(n) < 0.5)
+            u = rng.random((ROLLS_PER_TURN, n))
+            scalars = [CombatState(**{f: (getattr(st, f)[i].item() if isinstance(getattr(st, f), np.ndarray)
+                                          else getattr(st, f)) for f in CombatState.__slots__})
+                       for i in range(n)]
+            r = combat_turn(NP, st, action, u)
+            for i, sc in enumerate(scalars):
+                rs = combat_turn(SCALAR, sc, action, [float(x) for x in u[:, i]])
+                pairs = [(f, getattr(rs, f), np.broadcast_to(getattr(r, f), n)[i])
+                         for f in main.TurnResult.__slots__]
+                pairs += [("state." + f, getattr(sc, f), getattr(st, f)[i]) for f in _ARRAY_FIELDS]
+                diff = [(f, a, b) for f, a, b in pairs if a != b]
+                if diff:
+                    bad += 1
+                    f, a, b = diff[0]
+                    print(f"mismatch {key} {action} #{i} {f}: {a} != {b}")
+    print("selfcheck:", "ok" if not bad else f"{bad} mismatches")
+    return 1 if bad else 0
+
+
+def main_cli(argv=None) -> int:
+    p = argparse.ArgumentParser(description="Монте-Карло боёв Коловрата")
+    p.add_argument("--enemy", action="append", help="ключ узла с боем (можно несколько); по умолчанию все достижимые")
+    p.add_argument("--strategy", action="append", choices=sorted(STRATEGIES), help="по умолчанию все")
+    p.add_argument("--items", default="", help="предметы на старте: " + ",".join(ITEM_FLAGS))
+    p.add_argument("--hp", type=int, default=Session().hp)
+    p.add_argument("--fights", type=int, default=100_000)
+    p.add_argument("--batch", type=int, default=200_000)
+    p.add_argument("--max-turns", type=int, default=200)
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--json", action="store_true", help="вывод в JSON")
+    p.add_argument("--selfcheck", action="store_true")
+    args = p.parse_args(argv)
+
+    if args.selfcheck:
+        return selfcheck()
+
+    items = {x.strip() for x in args.items.split(",") if x.strip()}
+    unknown = items - set(ITEM_FLAGS)
+    if unknown:
+        p.error(f"неизвестные предметы: {', '.join(sorted(unknown))}")
+    all_enemies = enemies()
+    keys = args.enemy or list(enemies(reachable_only=True))
+    for key in keys:
+        if key not in all_enemies:
+            p.error(f"нет боя в узле {key}")
+    strategies = args.strategy or list(STRATEGIES)
+
+    results = []
+    for key in keys:
+        for name in strategies:
+            res = simulate(all_enemies[key], STRATEGIES[name], args.fights, args.hp, items, args.seed,
+                           args.batch, args.max_turns)
+            results.append({"enemy": key, "strategy": name, **res})
+            if not args.json:
+                t, h, d = res["turns_to_kill"], res["hp_lost"], res["damage_taken"]
+                print(f"{key:18} {name:10} win {res['win_rate']:6.1%}  loss {res['loss_rate']:6.1%}  "
+                      f"turns p50/p90 {t['p50']}/{t['p90']}  hp lost p50/p90 {h['p50']}/{h['p90']}  "
+                      f"dmg taken p50/p90 {d['p50']}/{d['p90']}  fate {res['fate_used_rate']:5.1%}")
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=1))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,15 @@
+import os
+import sys
+import tempfile
+
+# main читает окружение при импорте: без токена не стартует, а сессии и кэш file_id
+# в тестах держим в памяти и во временной папке
+_tmp = tempfile.mkdtemp(prefix="questbot-tests-")
+os.environ.setdefault("BOT_TOKEN", "test")
+os.environ["SESSION_BACKEND"] = "memory"
+os.environ["FILE_ID_CACHE"] = os.path.join(_tmp, "file_ids.json")
+os.environ["WEBHOOK_REPLY"] = "0"
+os.environ["TG_CHAT_RATE"] = "0"
+os.environ["TG_GLOBAL_RATE"] = "0"
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
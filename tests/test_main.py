@@ -0,0 +1,962 @@
+import asyncio
+import json
+import shutil
+import threading
+import time
+from dataclasses import asdict
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from main import (
+    OP_FIGHT, OP_GO, OP_HINT, OP_TAKE, CallbackQuery, Combat, Message, Session, Update,
+)
+
+# === УПАКОВКА СЕССИЙ ===
+
+def _fight_node() -> str:
+    return next(k for k, n in main.GRAPH.items() if n.combat is not None)
+
+def _same(a: Session, b: Session):
+    for f in ("max_hp", "hp", "level", "xp", "dmg_min", "dmg_max", "yrden_turns", "poison_turns",
+              "_axii_last_success", "_burned_item_last", "location", "inv", "finished", "fate",
+              "seed", "rolls", "actions", "actions_n", "actions_cut"):
+        assert getattr(a, f) == getattr(b, f), f
+    assert (a.combat is None) == (b.combat is None)
+    if a.combat is not None:
+        assert asdict(a.combat) == asdict(b.combat)
+
+def test_pack_roundtrip():
+    s = Session(hp=17, level=3, xp=240, yrden_turns=2, fate=0, _axii_last_success=True,
+                _burned_item_last=main.ITEMS[1], location="trail", rolls=41)
+    main.add_item(s, main.ITEMS[0])
+    main.add_item(s, main.ITEMS[-1])
+    for entry in ("/start", main.encode_cb(OP_GO, 3), main.encode_cb(OP_FIGHT, 0)):
+        main.log_action(s, entry)
+    got = main.unpack_session(main.pack_session(s))
+    _same(got, s)
+    assert main.action_entries(got) == ["/start", "g3", "f0"]
+
+def test_pack_roundtrip_in_combat():
+    loc = _fight_node()
+    s = Session(location=loc, combat=Combat(**asdict(main.GRAPH[loc].combat)))
+    s.combat.hp -= 5
+    got = main.unpack_session(main.pack_session(s))
+    _same(got, s)
+    assert got.combat.hp == s.combat.hp
+
+def test_pack_inventory_past_64_bits():
+    # маска переменной длины: бит 70 не должен ни переполнять упаковку, ни теряться
+    s = Session(inv=(1 << 70) | 1)
+    assert main.unpack_session(main.pack_session(s)).inv == s.inv
+
+def test_pack_action_log_is_stored_as_is():
+    s = Session()
+    main.log_action(s, "/start")
+    main.log_action(s, "g1")
+    assert main.pack_session(s).endswith(main._PACK_LOG.pack(9) + b"/start\ng1")
+
+def test_unpack_v1_record():
+    loc = b"trail"
+    data = main._PACK_HEAD_V1.pack(1, 50, 30, 2, 100, 6, 12, 0, 1, 1, main._F_FINISHED,
+                                  0b101, 1, len(loc)) + loc
+    s = main.unpack_session(data)
+    assert (s.hp, s.level, s.xp, s.poison_turns, s.location) == (30, 2, 100, 1, "trail")
+    assert s.inv == 0b101 and s.finished and s._burned_item_last == main.ITEMS[1]
+    # журнала у первой версии нет — переигрывать нечего
+    assert s.actions_cut and not s.actions
+
+def test_unpack_v2_record():
+    loc, log = b"intro", b"/start\ng2"
+    data = main._PACK_HEAD_V2.pack(2, 50, 50, 1, 0, 6, 12, 0, 0, 1, 0, 1 << 63, -1, len(loc),
+                                  1234, 7) + loc + main._PACK_LOG.pack(len(log)) + log
+    s = main.unpack_session(data)
+    assert (s.seed, s.rolls, s.inv, s.location) == (1234, 7, 1 << 63, "intro")
+    assert main.action_entries(s) == ["/start", "g2"] and s.actions_n == 2
+
+def test_unpack_unknown_version():
+    with pytest.raises(ValueError):
+        main.unpack_session(b"\xff" + bytes(64))
+
+def test_log_action_cut(monkeypatch):
+    monkeypatch.setattr(main, "ACTION_LOG_MAX", 2)
+    s = Session()
+    for entry in ("/start", "g1", "g2"):
+        main.log_action(s, entry)
+    assert s.actions_cut and main.action_entries(s) == ["/start", "g1"]
+
+def test_unreadable_record_is_kept():
+    # запись, которую эта версия не читает, не должна затираться новой сессией
+    uid, bad = 770001, b"\xff" + bytes(40)
+    store = main.session_store()
+    store.save_many([(uid, bad)])
+    errors = main.COUNTERS["bot_session_load_errors_total"].get((), 0)
+
+    async def go():
+        s = await main.sload(uid)
+        s.hp -= 1
+        main.mark_dirty(uid)
+        await main.flush_sessions()
+        return s
+
+    s = asyncio.run(go())
+    main.SESS.pop(uid)
+    assert s.location == "intro"
+    assert store.load(uid) == bad
+    assert main.COUNTERS["bot_session_load_errors_total"][()] == errors + 1
+
+# === КЭШ СЕССИЙ ===
+
+def test_session_cache_lru_and_spill():
+    evicted = []
+    c = main.SessionCache(2, 3600, on_evict=lambda uid, s: evicted.append(uid))
+    for uid in (1, 2):
+        c[uid] = Session()
+    c.get(1)  # 1 стал свежее 2
+    c[3] = Session()
+    assert evicted == [2] and 1 in c and 3 in c
+    assert c.stats() == {"size": 2, "hits": 1, "misses": 0, "evictions": 1}
+
+def test_session_cache_sweeps_idle(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(main.time, "monotonic", clock)
+    c = main.SessionCache(10, 60)
+    c[1] = Session()
+    clock.now += 30
+    c[2] = Session()
+    clock.now += 40
+    assert c.sweep() == 1 and 1 not in c and 2 in c
+
+def test_session_cache_keeps_busy_sessions(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(main.time, "monotonic", clock)
+    busy = {1}
+    c = main.SessionCache(2, 60, busy=busy.__contains__)
+    for uid in (1, 2, 3):
+        c[uid] = Session()
+    assert 1 in c and 2 not in c
+    c[4] = Session()
+    assert 1 in c and 3 not in c
+    clock.now += 100
+    assert c.sweep() == 1 and list(c._d) == [1]
+
+def test_evicted_dirty_session_is_spilled_and_flushed(monkeypatch):
+    monkeypatch.setattr(main, "SESS", main.SessionCache(1, 3600, main._spill))
+    store = main.session_store()
+
+    async def go():
+        s = await main.sload(771001)
+        s.xp = 321
+        main.mark_dirty(771001)
+        await main.sload(771002)  # вытесняет 771001 из кэша
+        assert 771001 not in main.SESS and 771001 in main._spilled
+        assert store.load(771001) is None
+        # снова нужна до сброса — поднимается из вытесненных, а не из хранилища
+        assert (await main.sload(771001)).xp == 321
+        await main.flush_sessions()
+
+    asyncio.run(go())
+    assert not main._spilled
+    assert main.unpack_session(store.load(771001)).xp == 321
+
+def test_evicted_clean_session_is_not_written(monkeypatch):
+    monkeypatch.setattr(main, "SESS", main.SessionCache(1, 3600, main._spill))
+
+    async def go():
+        await main.flush_sessions()  # хвосты прошлых тестов
+        await main.sload(771101)
+        await main.sload(771102)
+        return await main.flush_sessions()
+
+    assert asyncio.run(go()) == 0
+    assert main.session_store().load(771101) is None
+
+def test_eviction_does_not_lose_update_in_flight(monkeypatch):
+    # апдейт чата 1 ждёт Bot API, пока остальные чаты вытесняют сессии из кэша
+    monkeypatch.setattr(main, "SESS", main.SessionCache(2, 3600, main._spill, main._chat_locks.__contains__))
+
+    async def go():
+        async with main.chat_lock(1):
+            s = await main.sload(1)
+            for uid in (2, 3, 4):
+                async with main.chat_lock(uid):
+                    await main.sload(uid)
+            main.add_item(s, main.ITEMS[0])
+            main.mark_dirty(1)
+        await main.flush_sessions()
+
+    asyncio.run(go())
+    assert main.unpack_session(main.session_store().load(1)).inv == 1
+
+# === ЗАМКИ ЧАТОВ ===
+
+def test_chat_lock_serializes_one_chat_and_cleans_up():
+    events = []
+
+    async def work(chat: int, name: str):
+        async with main.chat_lock(chat):
+            events.append(("in", name))
+            await asyncio.sleep(0.01)
+            events.append(("out", name))
+
+    async def go():
+        await asyncio.gather(work(1, "a"), work(1, "b"), work(2, "c"))
+
+    asyncio.run(go())
+    mine = [e for e in events if e[1] in "ab"]
+    assert mine == [("in", "a"), ("out", "a"), ("in", "b"), ("out", "b")]
+    # разные чаты друг друга не ждут
+    assert events.index(("in", "c")) < events.index(("out", "a"))
+    assert 1 not in main._chat_locks and 2 not in main._chat_locks
+
+def test_chat_lock_is_released_on_error():
+    async def go():
+        with pytest.raises(RuntimeError):
+            async with main.chat_lock(3):
+                raise RuntimeError("boom")
+        assert 3 not in main._chat_locks
+        async with main.chat_lock(3):  # и снова берётся
+            pass
+
+    asyncio.run(go())
+    assert 3 not in main._chat_locks
+
+# === CALLBACK DATA ===
+
+def test_decode_cb_compact():
+    assert main.decode_cb(main.encode_cb(OP_GO, 3)) == (OP_GO, [3])
+    assert main.decode_cb(main.encode_cb(OP_TAKE, 1, 4)) == (OP_TAKE, [1, 4])
+    assert main.decode_cb(OP_HINT) == (OP_HINT, [])
+    assert main.decode_cb(main.encode_cb(OP_FIGHT, 8)) == (OP_FIGHT, [8])
+
+def test_decode_cb_legacy():
+    assert main.decode_cb("go:trail") == (OP_GO, [main.NODE_IDS["trail"]])
+    assert main.decode_cb("hint:combat") == (OP_HINT, [])
+    assert main.decode_cb("fight:igni") == (OP_FIGHT, [main.FIGHT_ACTIONS.index("igni")])
+    assert main.decode_cb(f"take:{main.ITEMS[0]}:trail") == (OP_TAKE, [0, main.NODE_IDS["trail"]])
+
+@pytest.mark.parametrize("data", [
+    "", "g", "g-1", "g 1", "g1_0", "gzz", "g1.2", "g.", "gA",
+    main.encode_cb(OP_GO, len(main.NODE_KEYS)),
+    "t0", "t0.1.2", main.encode_cb(OP_TAKE, len(main.ITEMS), 0),
+    main.encode_cb(OP_FIGHT, len(main.FIGHT_ACTIONS)), "x1", "h1.1",
+    "take:junk:trail", "take:junk", "go:nowhere", "fight:dance", "hint:", "what:ever",
+])
+def test_decode_cb_rejects(data):
+    items = list(main.ITEMS)
+    assert main.decode_cb(data) is None
+    # мусор из кнопки не пополняет реестр предметов
+    assert main.ITEMS == items
+
+# === ВЫЗОВЫ BOT API ===
+
+def _requests(*outcomes):
+    # по очереди: исключение — бросить, иначе (код, тело) — ответ Bot API
+    sent = []
+
+    async def request():
+        sent.append(1)
+        o = outcomes[len(sent) - 1]
+        if isinstance(o, Exception):
+            raise o
+        code, body = o
+        return httpx.Response(code, content=json.dumps(body).encode())
+
+    return request, sent
+
+_OK_BODY = (200, {"ok": True, "result": True})
+
+@pytest.fixture
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(main, "_backoff", lambda attempt: 0.0)
+
+def test_tg_call_retries_5xx_and_429(no_backoff):
+    request, sent = _requests(
+        (502, {"ok": False, "error_code": 502, "description": "Bad Gateway"}),
+        (429, {"ok": False, "error_code": 429, "description": "Too Many Requests",
+               "parameters": {"retry_after": 0.01}}),
+        _OK_BODY,
+    )
+    assert asyncio.run(main._tg_call("sendMessage", 1, request)) == {"ok": True, "result": True}
+    assert len(sent) == 3
+
+def test_tg_call_gives_up_after_retries(no_backoff):
+    request, sent = _requests(*[(500, {"ok": False, "error_code": 500, "description": "x"})] * 10)
+    with pytest.raises(main.TelegramError):
+        asyncio.run(main._tg_call("getUpdates", None, request))
+    assert len(sent) == main.TG_RETRIES + 1
+
+def test_tg_call_does_not_retry_4xx(no_backoff):
+    request, sent = _requests((400, {"ok": False, "error_code": 400, "description": "Bad Request"}), _OK_BODY)
+    with pytest.raises(main.TelegramError):
+        asyncio.run(main._tg_call("sendMessage", 1, request))
+    assert len(sent) == 1
+
+@pytest.mark.parametrize("error", [httpx.ConnectError("refused"), httpx.ConnectTimeout("t"), httpx.PoolTimeout("t")])
+def test_send_is_retried_when_request_never_left(no_backoff, error):
+    request, sent = _requests(error, _OK_BODY)
+    asyncio.run(main._tg_call("sendPhoto", 1, request))
+    assert len(sent) == 2
+
+@pytest.mark.parametrize("method", ["sendMessage", "sendPhoto", "editMessageCaption"])
+@pytest.mark.parametrize("error", [httpx.ReadTimeout("t"), httpx.RemoteProtocolError("closed")])
+def test_send_is_not_resent_after_request_left(no_backoff, method, error):
+    # ответ потерян, но сообщение могло уйти: повтор дал бы игроку дубль
+    request, sent = _requests(error, _OK_BODY)
+    with pytest.raises(httpx.TransportError):
+        asyncio.run(main._tg_call(method, 1, request))
+    assert len(sent) == 1
+
+@pytest.mark.parametrize("method", ["getUpdates", "answerCallbackQuery"])
+def test_idempotent_calls_retry_any_network_error(no_backoff, method):
+    request, sent = _requests(httpx.ReadTimeout("t"), httpx.RemoteProtocolError("closed"), _OK_BODY)
+    asyncio.run(main._tg_call(method, None, request))
+    assert len(sent) == 3
+
+# === ЛИМИТЫ ОТПРАВКИ ===
+
+def test_token_bucket_burst_then_rate(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(main.time, "monotonic", clock)
+    b = main.TokenBucket(rate=2, burst=3)
+    assert [b.reserve() for _ in range(3)] == [0.0, 0.0, 0.0]
+    # дальше — в долг, по порядку: 0.5 с, 1 с
+    assert b.reserve() == pytest.approx(0.5)
+    assert b.reserve() == pytest.approx(1.0)
+    clock.now += 10
+    assert b.idle() and b.reserve() == 0.0
+
+def test_token_bucket_pause(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(main.time, "monotonic", clock)
+    b = main.TokenBucket(rate=1, burst=3)
+    b.pause(5)  # 429 с retry_after=5
+    assert b.reserve() == pytest.approx(5.0)
+
+def test_outbox_waits_for_slower_bucket(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(main.time, "monotonic", clock)
+    slept = []
+
+    async def sleep(delay):
+        slept.append(delay)
+
+    monkeypatch.setattr(main.asyncio, "sleep", sleep)
+    ob = main.OutboundScheduler(global_rate=10, chat_rate=1, chat_burst=1)
+
+    async def go():
+        await ob.acquire(1)
+        await ob.acquire(2)  # другой чат — без ожидания
+        await ob.acquire(1)  # второй в чат 1 ждёт его токена (1 с), а не общего (0.1 с)
+
+    asyncio.run(go())
+    assert slept == [pytest.approx(1.0)]
+    assert ob.stats() == {"waiting": 0, "chat_buckets": 2}
+
+def test_outbox_disabled_without_limits():
+    ob = main.OutboundScheduler(0, 0, 3)
+    assert not ob.enabled and not ob.pause(1, 5.0)
+
+def test_outbox_prunes_idle_chat_buckets(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(main.time, "monotonic", clock)
+    ob = main.OutboundScheduler(0, 1, 1)
+    ob._prune_at = 3
+    for chat in range(3):
+        ob._chat(chat).reserve()
+    clock.now += 10  # все корзины снова полные
+    ob._chat(99)
+    assert set(ob._chats) == {99}
+
+def test_429_pause_lands_on_chat_bucket(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(main.time, "monotonic", clock)
+    slept = []
+
+    async def sleep(delay):
+        slept.append(delay)
+
+    monkeypatch.setattr(main.asyncio, "sleep", sleep)
+    monkeypatch.setattr(main, "OUTBOX", main.OutboundScheduler(0, 1, 3))
+    request, sent = _requests(
+        (429, {"ok": False, "error_code": 429, "description": "Too Many Requests", "parameters": {"retry_after": 7}}),
+        _OK_BODY,
+    )
+    asyncio.run(main._tg_call("sendMessage", 5, request))
+    assert len(sent) == 2 and slept == [pytest.approx(7.0)]
+
+# === ВЕБХУК ===
+
+def _webhook():
+    client = TestClient(main.app)  # без with: хуки старта (setWebhook, прогрев) не нужны
+    return lambda body: client.post(f"/webhook/{main.WEBHOOK_SECRET}", content=body)
+
+@pytest.mark.parametrize("update", [
+    # нажатие под inline-сообщением: message нет
+    {"update_id": 1, "callback_query": {"id": "1", "inline_message_id": "AAA", "data": "g1"}},
+    {"update_id": 2, "edited_message": {"message_id": 1, "chat": {"id": 5}, "text": "hi"}},
+    {"update_id": 3, "message": {"message_id": 1, "chat": {"id": 5}, "photo": []}},
+    {"update_id": "4", "message": {"message_id": 1, "chat": {"id": 5}, "text": "hi"}},
+    {"update_id": 5, "message": {"message_id": 1, "text": "no chat"}},
+    [1, 2, 3],
+])
+def test_webhook_drops_unsupported_updates_with_200(update):
+    post = _webhook()
+    r = post(json.dumps(update))
+    assert r.status_code == 200 and r.json() == {"ok": True}
+
+def test_webhook_rejects_non_json():
+    post = _webhook()
+    assert post(b"not json {").status_code == 400
+
+def _recording_post(monkeypatch) -> list:
+    calls = []
+
+    async def post(method, payload, timeout=None):
+        calls.append((method, payload))
+        return {"ok": True, "result": {"message_id": 1}}
+
+    monkeypatch.setattr(main, "_tg_post", post)
+    return calls
+
+def test_tg_last_holds_only_the_last_call(monkeypatch):
+    calls = _recording_post(monkeypatch)
+
+    async def go():
+        token = main._reply.set([])
+        try:
+            await main.tg_last("sendMessage", {"text": "1"})
+            await main.tg("sendPhoto", {"caption": "2"})  # отложенное уходит раньше, порядок тот же
+            await main.tg_last("sendMessage", {"text": "3"})
+            await main.tg_last("sendMessage", {"text": "4"})
+            return main._reply.get()
+        finally:
+            main._reply.reset(token)
+
+    held = asyncio.run(go())
+    assert [p for _, p in calls] == [{"text": "1"}, {"caption": "2"}, {"text": "3"}]
+    assert held == [("sendMessage", {"text": "4"})]
+
+def test_webhook_reply_returns_last_text_in_response(monkeypatch):
+    calls = _recording_post(monkeypatch)
+    monkeypatch.setattr(main, "WEBHOOK_REPLY", True)
+    post = _webhook()
+    r = post(json.dumps({"update_id": 660001, "message": {"message_id": 1, "chat": {"id": 660001}, "text": "/hp"}}))
+    body = r.json()
+    assert r.status_code == 200 and body["method"] == "sendMessage" and body["chat_id"] == 660001
+    assert "sendMessage" not in [m for m, _ in calls]
+
+def test_webhook_reply_sends_photos_directly(monkeypatch):
+    # у фото есть запасной путь, поэтому оно уходит отдельным запросом, а ответ вебхука пуст
+    calls = _recording_post(monkeypatch)
+    monkeypatch.setattr(main, "WEBHOOK_REPLY", True)
+    post = _webhook()
+    r = post(json.dumps({"update_id": 660002, "message": {"message_id": 1, "chat": {"id": 660002}, "text": "/start"}}))
+    assert r.json() == {"ok": True}
+    assert [m for m, _ in calls] == ["sendPhoto"]
+
+def test_webhook_queue_acks_at_once(monkeypatch):
+    q = asyncio.Queue(5)
+    monkeypatch.setattr(main, "_update_queue", q)
+    post = _webhook()
+    r = post(json.dumps({"update_id": 670001, "message": {"message_id": 1, "chat": {"id": 670001}, "text": "/hp"}}))
+    assert r.json() == {"ok": True} and q.qsize() == 1
+    assert q.get_nowait()[1].message.text == "/hp"
+
+def test_webhook_queue_full_sheds_inline(monkeypatch):
+    q = asyncio.Queue(1)
+    q.put_nowait((0.0, Update()))
+    monkeypatch.setattr(main, "_update_queue", q)
+    shed = main.COUNTERS["bot_shed_total"].get(("queue_full",), 0)
+    post = _webhook()
+    r = post(json.dumps({"update_id": 670002, "callback_query": {
+        "id": "cq1", "data": "g1", "message": {"message_id": 3, "chat": {"id": 670002}}}}))
+    assert r.json() == {"method": "answerCallbackQuery", "callback_query_id": "cq1", "text": main.BUSY_TEXT}
+    r = post(json.dumps({"update_id": 670003, "message": {"message_id": 1, "chat": {"id": 670002}, "text": "/hp"}}))
+    assert r.json() == {"method": "sendMessage", "chat_id": 670002, "text": main.BUSY_TEXT}
+    assert main.COUNTERS["bot_shed_total"][("queue_full",)] == shed + 2
+    assert q.qsize() == 1
+
+def test_update_worker_drops_stale_callbacks(monkeypatch):
+    calls = _recording_post(monkeypatch)
+    stale = main.COUNTERS["bot_shed_total"].get(("stale_callback",), 0)
+
+    async def go():
+        q = asyncio.Queue()
+        worker = asyncio.create_task(main._update_worker(q))
+        now = time.monotonic()
+        cq = CallbackQuery(id="old", chat_id=670010, message_id=1, data=main.encode_cb(OP_HINT))
+        q.put_nowait((now - main.CALLBACK_MAX_AGE - 1, Update(update_id=670010, callback_query=cq)))
+        q.put_nowait((now, Update(update_id=670011, message=Message(message_id=1, chat_id=670011, text="/hp"))))
+        await q.join()
+        worker.cancel()
+
+    asyncio.run(go())
+    assert main.COUNTERS["bot_shed_total"][("stale_callback",)] == stale + 1
+    assert [p["chat_id"] for _, p in calls] == [670011]
+
+# === ДЕДУПЛИКАЦИЯ АПДЕЙТОВ ===
+
+class _Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+def test_dedup_window(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(main.time, "monotonic", clock)
+    d = main.UpdateDedup(window=5, max_size=100)
+    assert not d.seen(1)
+    clock.now += 4
+    assert d.seen(1)
+    clock.now += 2  # запись от первого прихода старше окна
+    assert not d.seen(1)
+    assert d.stats() == {"total": 3, "duplicates": 1, "duplicate_rate": 0.3333, "window_size": 1}
+
+def test_dedup_max_size(monkeypatch):
+    monkeypatch.setattr(main.time, "monotonic", _Clock())
+    d = main.UpdateDedup(window=60, max_size=3)
+    for uid in range(5):
+        assert not d.seen(uid)
+    assert d.stats()["window_size"] == 3
+    # самые старые вытеснены, свежие ещё помнятся
+    assert not d.seen(0)
+    assert d.seen(4)
+
+def test_dedup_forget(monkeypatch):
+    monkeypatch.setattr(main.time, "monotonic", _Clock())
+    d = main.UpdateDedup(window=60, max_size=10)
+    d.seen(7)
+    d.forget(7)
+    assert not d.seen(7)
+
+def _fight_session(uid: int) -> Session:
+    loc = _fight_node()
+    s = main.SESS[uid] = Session(location=loc, combat=Combat(**asdict(main.GRAPH[loc].combat)), seed=99)
+    return s
+
+def test_failed_update_is_rolled_back_for_redelivery(monkeypatch):
+    # ход боя, на котором Bot API ответил 5xx: повтор того же update_id играет тот же ход,
+    # а не второй поверх первого
+    fail = [True]
+
+    async def flaky_post(method, payload, timeout=None):
+        if method != "answerCallbackQuery" and fail[0]:
+            fail[0] = False
+            raise main.TelegramError(method, 502, "Bad Gateway")
+        return {"ok": True, "result": {}}
+
+    monkeypatch.setattr(main, "_tg_post", flaky_post)
+    fight = main.encode_cb(OP_FIGHT, 0)
+
+    async def go():
+        fail[0] = False
+        ref = _fight_session(880001)
+        await main.handle_update(Update(update_id=990001, callback_query=CallbackQuery(
+            id="a", chat_id=880001, message_id=5, data=fight)))
+        fail[0] = True
+        _fight_session(880002)
+        upd = Update(update_id=990002, callback_query=CallbackQuery(id="b", chat_id=880002, message_id=5, data=fight))
+        with pytest.raises(main.TelegramError):
+            await main.handle_update(upd)
+        rolled_back = main.SESS[880002]
+        assert rolled_back.rolls == 0 and rolled_back.combat.hp == rolled_back.combat.max_hp
+        assert not rolled_back.actions
+        await main.handle_update(upd)
+        return ref, main.SESS[880002]
+
+    ref, got = asyncio.run(go())
+    assert got.rolls == ref.rolls > 0
+    assert got.combat.hp == ref.combat.hp < got.combat.max_hp
+    assert main.action_entries(got) == [fight]
+
+def test_fight_edits_only_the_current_fight_message(monkeypatch):
+    calls, ids = [], iter(range(100, 1000))
+
+    async def post(method, payload, timeout=None):
+        calls.append((method, payload))
+        return {"ok": True, "result": {"message_id": next(ids)}}
+
+    monkeypatch.setattr(main, "_tg_post", post)
+    uid, fight = 880010, main.encode_cb(OP_FIGHT, main.FIGHT_ACTIONS.index("quen"))
+
+    async def press(message_id: int) -> list:
+        del calls[:]
+        cq = CallbackQuery(id="x", chat_id=uid, message_id=message_id, data=fight)
+        await main.handle_update(Update(callback_query=cq))
+        return [m for m, _ in calls if m != "answerCallbackQuery"]
+
+    async def go():
+        s = main.SESS[uid] = Session(hp=500, max_hp=500)
+        await main.show_location(uid, s, _fight_node())
+        current = s.combat_msg
+        assert current
+        assert await press(current) == ["editMessageCaption"]
+        # кнопка под сообщением прошлого боя: его подпись не трогаем
+        assert await press(7) == ["sendPhoto"]
+        assert s.combat_msg != current
+        assert await press(s.combat_msg) == ["editMessageCaption"]
+
+    asyncio.run(go())
+
+# === ПЕРЕИГРОВКА ===
+
+def _buttons(calls) -> list:
+    for _, payload in reversed(calls):
+        markup = payload.get("reply_markup")
+        if markup:
+            markup = json.loads(markup) if isinstance(markup, str) else markup
+            return [b["callback_data"] for row in markup["inline_keyboard"] for b in row]
+    return []
+
+async def _play(uid: int, steps: int) -> Session:
+    # живая партия без сети: вызовы Bot API складываются в список
+    calls = []
+    token = main._sink.set(calls)
+    try:
+        if uid in main.SESS:
+            main.SESS.pop(uid)
+        await main._handle_update(Update(message=Message(message_id=1, chat_id=uid, text="/start")))
+        for step in range(steps):
+            buttons = _buttons(calls)
+            assert buttons
+            cq = CallbackQuery(id=str(step), chat_id=uid, message_id=1, data=buttons[step % len(buttons)])
+            await main._handle_update(Update(callback_query=cq))
+        return main.SESS.pop(uid)
+    finally:
+        main._sink.reset(token)
+
+def test_replay_reproduces_session():
+    async def go():
+        played = await _play(uid=424242, steps=40)
+        got = await main.replay_session(424242, played.seed, main.action_entries(played))
+        return played, got
+
+    played, got = asyncio.run(go())
+    assert played.actions_n == 41 and played.rolls > 0
+    assert main.pack_session(got) == main.pack_session(played)
+
+# === УВЕДОМЛЕНИЯ ===
+
+def _collect(coro_fn, notices=True) -> list:
+    # вызовы Bot API внутри одного «апдейта» со сборщиком уведомлений
+    async def go():
+        calls = []
+        sink = main._sink.set(calls)
+        token = main._notices.set([]) if notices else None
+        try:
+            await coro_fn()
+            if notices:
+                await main.flush_notices(1)
+        finally:
+            if token is not None:
+                main._notices.reset(token)
+            main._sink.reset(sink)
+        return [(m, p.get("caption", p.get("text"))) for m, p in calls]
+
+    return asyncio.run(go())
+
+def test_notify_without_collector_sends_at_once():
+    async def body():
+        await main.notify(1, "Ты получил травы.")
+
+    assert _collect(body, notices=False) == [("sendMessage", "Ты получил травы.")]
+
+def test_notices_fold_into_next_caption():
+    async def body():
+        await main.notify(1, "Ты получил травы.")
+        await main.notify(1, "Леший повержен!")
+        await main.send_photo(1, "https://img/x", "Поляна.")
+
+    assert _collect(body) == [("sendPhoto", "Ты получил травы.\n\nЛеший повержен!\n\nПоляна.")]
+
+def test_notices_that_do_not_fit_go_first_as_text():
+    caption = "к" * (main.CAPTION_MAX - 5)
+
+    async def body():
+        await main.notify(1, "Ты получил травы.")
+        await main.send_photo(1, "https://img/x", caption)
+
+    assert _collect(body) == [("sendMessage", "Ты получил травы."), ("sendPhoto", caption)]
+
+def test_text_limit_is_larger_than_caption_limit():
+    text = "т" * (main.CAPTION_MAX + 100)
+
+    async def body():
+        await main.notify(1, "Ты получил травы.")
+        await main.send_text(1, text)
+
+    assert _collect(body) == [("sendMessage", "Ты получил травы.\n\n" + text)]
+
+def test_leftover_notices_are_sent_at_end_of_update():
+    async def body():
+        await main.notify(1, "Нет трав — зелье не сварить.")
+        await main.notify(1, "Ещё одно.")
+
+    assert _collect(body) == [("sendMessage", "Нет трав — зелье не сварить.\n\nЕщё одно.")]
+
+# === КЭШ FILE_ID ===
+
+def test_file_id_writes_do_not_overlap(monkeypatch, tmp_path):
+    path = tmp_path / "file_ids.json"
+    monkeypatch.setattr(main, "FILE_ID_CACHE", str(path))
+    monkeypatch.setattr(main, "FILE_IDS", {})
+    active, overlaps, writes = [0], [0], [0]
+    guard = threading.Lock()
+    real_write = main._write_file_ids
+
+    def slow_write(snapshot):
+        with guard:
+            active[0] += 1
+            overlaps[0] = max(overlaps[0], active[0])
+        time.sleep(0.01)
+        real_write(snapshot)
+        with guard:
+            active[0] -= 1
+            writes[0] += 1
+
+    monkeypatch.setattr(main, "_write_file_ids", slow_write)
+
+    async def go():
+        await asyncio.gather(*(
+            main.remember_file_id(f"https://img/{i}", {"result": {"photo": [{"file_id": f"id{i}"}]}})
+            for i in range(20)
+        ))
+
+    asyncio.run(go())
+    assert overlaps[0] == 1
+    assert writes[0] < 20  # пачка новых id ложится меньшим числом записей
+    assert json.loads(path.read_text(encoding="utf-8")) == {f"https://img/{i}": f"id{i}" for i in range(20)}
+
+# === ПАКИ КОНТЕНТА ===
+
+def _pack(name: str, doc: dict):
+    raw = json.dumps({"format": main.CONTENT_FORMAT, **doc}, ensure_ascii=False).encode()
+    return main.parse_pack(name, raw, name)
+
+def _node(text: str, *rows, **extra) -> dict:
+    return {"text": text, "buttons": [list(r) for r in rows], **extra}
+
+def _go(to: str) -> dict:
+    return {"text": to, "to": to}
+
+_MINI = {
+    "images": {"a": "https://img/a"},
+    "nodes": {
+        "intro": _node("Начало", [_go("finale")], img="a"),
+        "finale": _node("Конец", [_go("intro")]),
+    },
+}
+
+@pytest.fixture
+def registries(monkeypatch):
+    # реестры номеров только дописываются — после теста возвращаем их как были
+    saved = [(r, r.copy()) for r in (main.NODE_KEYS, main.NODE_IDS, main.ITEMS, main.ITEM_IDS, main._ITEM_LOOKUP)]
+    for name in ("IMG", "GRAPH", "CONTENT_VERSION", "CONTENT_GRAPH", "_PACKS"):
+        monkeypatch.setattr(main, name, getattr(main, name))
+    yield
+    for r, copy in saved:
+        r.clear()
+        if isinstance(r, list):
+            r.extend(copy)
+        else:
+            r.update(copy)
+
+@pytest.mark.parametrize("raw, error", [
+    (b"{not json", "не JSON"),
+    (b'{"format": 99}', "format 99"),
+    (b'{"format": 1, "extra": 1}', "лишние поля"),
+    (b'{"format": 1, "version": "2"}', "version"),
+    (b'{"format": 1, "nodes": {"x": {"img": "a"}}}', "нет text"),
+    (b'{"format": 1, "nodes": {"x": {"text": "", "buttons": [[{"text": "b", "to": "y", "data": "go:y"}]]}}}',
+     "ровно одно"),
+    (b'{"format": 1, "nodes": {"x": {"text": "", "buttons": [[{"text": "b", "data": "fight:dance"}]]}}}',
+     "непонятное data"),
+    (b'{"format": 1, "nodes": {"x": {"text": "", "combat": {"enemy": "e", "img": "a", "dmg_min": 1, '
+     b'"dmg_max": 2, "hint": "", "win_to": "y"}}}}', "нет max_hp"),
+    (b'{"format": 1, "nodes": {"x": {"text": "", "combat": {"enemy": "e", "max_hp": 5, "img": "a", '
+     b'"dmg_min": 3, "dmg_max": 2, "hint": "", "win_to": "y"}}}}', "dmg_min <= dmg_max"),
+])
+def test_parse_pack_rejects(raw, error):
+    with pytest.raises(main.ContentError, match=error) as e:
+        main.parse_pack("bad.json", raw, "x")
+    assert str(e.value).startswith("bad.json")
+
+def test_build_content_layers_packs():
+    later = _pack("10.json", {
+        "images": {"b": "https://img/b"},
+        "nodes": {"intro": _node("Новое начало", [_go("finale")], img="a"),
+                  "side": _node("Тропа", [_go("intro")], img="b")},
+        "append_buttons": {"finale": [[_go("side")]]},
+    })
+    images, nodes = main.build_content([_pack("00.json", _MINI), later])
+    assert images == {"a": "https://img/a", "b": "https://img/b"}
+    assert nodes["intro"]["text"] == "Новое начало" and nodes["intro"]["img"] == "https://img/a"
+    assert nodes["finale"]["buttons"] == [[_go("intro")], [_go("side")]]
+
+@pytest.mark.parametrize("doc, error", [
+    ({"nodes": {"x": _node("", img="nope")}}, "нет картинки 'nope'"),
+    ({"append_buttons": {"ghost": [[_go("intro")]]}}, "нет узла 'ghost'"),
+])
+def test_build_content_rejects_bad_references(doc, error):
+    with pytest.raises(main.ContentError, match=error):
+        main.build_content([_pack("00.json", _MINI), _pack("10.json", doc)])
+
+def test_build_content_requires_intro_and_finale():
+    with pytest.raises(main.ContentError, match="'finale'"):
+        main.build_content([_pack("00.json", {"nodes": {"intro": _node("Начало")}})])
+
+def test_check_content_rejects_dangling_links():
+    broken = _pack("10.json", {"nodes": {"intro": _node("Начало", [_go("nowhere")])}})
+    with pytest.raises(main.ContentError, match="nowhere"):
+        main.check_content([_pack("00.json", _MINI), broken])
+
+def test_apply_ids_keeps_recorded_numbers(registries):
+    ids = {"nodes": list(main.NODE_KEYS) + ["brand_new"], "items": list(main.ITEMS)}
+    main.apply_ids(ids)
+    assert main.NODE_IDS["brand_new"] == len(ids["nodes"]) - 1
+    assert not main.ids_changed(ids)
+
+@pytest.mark.parametrize("what", ["nodes", "items"])
+def test_apply_ids_rejects_renumbering(registries, what):
+    ids = {"nodes": list(main.NODE_KEYS), "items": list(main.ITEMS)}
+    ids[what][0], ids[what][1] = ids[what][1], ids[what][0]
+    with pytest.raises(main.ContentError, match="только дописывается"):
+        main.apply_ids(ids)
+
+def test_read_and_write_ids(registries, tmp_path):
+    path = str(tmp_path / "_ids.json")
+    assert main.read_ids(path) == {"nodes": [], "items": []}
+    main.write_ids(path)
+    assert main.read_ids(path) == {"nodes": main.NODE_KEYS, "items": main.ITEMS}
+    (tmp_path / "_ids.json").write_text("[]", encoding="utf-8")
+    with pytest.raises(main.ContentError):
+        main.read_ids(path)
+
+@pytest.fixture
+def content_copy(registries, monkeypatch, tmp_path):
+    # копия паков, которую тест может править; артефакт и номера — рядом, а не в репозитории
+    directory = tmp_path / "content"
+    shutil.copytree(main.CONTENT_DIR, directory)
+    ids_path = str(directory / "_ids.json")
+    monkeypatch.setattr(main, "CONTENT_DIR", str(directory))
+    monkeypatch.setattr(main, "GRAPH_ARTIFACT", str(directory / "_graph.json"))
+    read_ids, write_ids = main.read_ids, main.write_ids
+    monkeypatch.setattr(main, "read_ids", lambda path=ids_path: read_ids(path))
+    monkeypatch.setattr(main, "write_ids", lambda path=ids_path: write_ids(path))
+    return directory
+
+def _edit_pack(path, edit):
+    doc = json.loads(path.read_text(encoding="utf-8"))
+    edit(doc)
+    path.write_text(json.dumps(doc, ensure_ascii=False), encoding="utf-8")
+
+def test_reload_swaps_content_and_appends_ids(content_copy):
+    ids_before = dict(main.NODE_IDS)
+    _edit_pack(content_copy / "00_base.json", lambda d: d["nodes"].update({
+        "intro": {**d["nodes"]["intro"], "text": "Другое начало."},
+        "aaa_new": {"text": "Новая поляна.", "buttons": [[{"text": "Назад", "to": "intro"}]]},
+    }))
+    info = asyncio.run(main.reload_content())
+    assert info["parsed"] == 1  # остальные паки не изменились — не разбираются заново
+    assert main.GRAPH["intro"].text == "Другое начало." and "aaa_new" in main.GRAPH
+    # новый узел — в конец, старые номера на месте
+    assert main.NODE_IDS["aaa_new"] == len(ids_before)
+    assert all(main.NODE_IDS[k] == i for k, i in ids_before.items())
+    assert main.read_ids()["nodes"][-1] == "aaa_new"
+
+def test_broken_reload_keeps_old_content(content_copy):
+    graph, version = main.GRAPH, main.CONTENT_VERSION
+    _edit_pack(content_copy / "20_mirror.json", lambda d: d["nodes"]["mirror_hall"].update(
+        {"buttons": [[{"text": "В никуда", "to": "nowhere"}]]}))
+    with pytest.raises(main.ContentError, match="nowhere"):
+        asyncio.run(main.reload_content())
+    assert main.GRAPH is graph and main.CONTENT_VERSION == version
+
+def test_admin_reload_endpoint(content_copy):
+    client = TestClient(main.app)
+    url = f"/admin/reload/{main.WEBHOOK_SECRET}"
+    assert client.post(url).status_code == 200
+    (content_copy / "30_bad.json").write_text("{", encoding="utf-8")
+    r = client.post(url)
+    assert r.status_code == 422 and "30_bad.json" in r.text
+
+# === ГРАФ КОНТЕНТА ===
+
+def _data(text: str, data: str) -> dict:
+    return {"text": text, "data": data}
+
+def _fight(win_to: str, trait: str) -> dict:
+    return {"enemy": "Волк", "max_hp": 10, "img": "a", "dmg_min": 1, "dmg_max": 2, "hint": "",
+            "win_to": win_to, "trait": trait}
+
+def _graph():
+    _, nodes = main.build_content([_pack("00.json", {
+        "images": {"a": "https://img/a"},
+        "nodes": {
+            "intro": _node("", [_go("trail")], [_data("травы", "take:травы:hut")], [_go("dry")]),
+            "hut": _node("", [_data("варить", "brew:зелье:trail")]),
+            "dry": _node("", [_data("варить", "brew:зелье:trail")]),
+            "trail": _node("", [_go("finale")], [_go("dead_end")], [_go("wolf")]),
+            "dead_end": _node(""),
+            "wolf": _node("", combat=_fight("finale", "needs_silver")),
+            "bat": _node("", [_go("intro")], combat=_fight("finale", "wings")),
+            "finale": _node(""),
+        },
+    })])
+    errors, report = main.analyze_graph(nodes, "test")
+    assert errors == []
+    return report
+
+def test_graph_reachability_and_path_to_finale():
+    r = _graph()
+    at = dict(zip(r.nodes, zip(r.reachable, r.to_finale)))
+    assert at["intro"] == (True, 2) and at["hut"] == (True, 2) and at["finale"] == (True, 0)
+    assert at["bat"] == (False, 1) and at["dead_end"] == (True, -1)
+    assert r.path_to_finale("intro") == ["intro", "trail", "finale"]
+    assert r.path_to_finale("dead_end") == []
+
+def test_graph_item_masks():
+    r = _graph()
+    herbs, potion = (1 << r.items.index("травы")), (1 << r.items.index("зелье"))
+    may = dict(zip(r.nodes, r.may_have))
+    always = dict(zip(r.nodes, r.always_have))
+    assert may["intro"] == 0 and always["intro"] == 0
+    assert always["hut"] & herbs  # в избу только с травами
+    assert may["trail"] & potion and not always["trail"] & potion  # на тропу можно и без зелья
+    assert not may["dry"] & herbs
+
+def test_graph_warnings():
+    warnings = _graph().warnings
+    for expected in ("bat: недостижим из intro", "dead_end: отсюда не дойти до finale",
+                     "dry: кнопка «варить» — трав здесь быть не может", "bat: особенность 'wings'",
+                     "wolf: needs_silver, но серебряный клинок к этому бою не добыть"):
+        assert any(w.startswith(expected) for w in warnings), expected
+
+def test_graph_errors_on_dangling_win_to():
+    _, nodes = main.build_content([_pack("00.json", {
+        "images": {"a": "https://img/a"},
+        "nodes": {"intro": _node("", [_go("finale")]), "finale": _node("", combat=_fight("nowhere", ""))},
+    })])
+    errors, _ = main.analyze_graph(nodes, "test")
+    assert errors == ["finale: победа в бою ведёт в несуществующий узел 'nowhere'"]
+
+def test_graph_artifact_roundtrip(tmp_path):
+    path = str(tmp_path / "_graph.json")
+    report = _graph()
+    main.write_graph_artifact(path, report)
+    assert main.read_graph_artifact(path, "test") == report
+    # собран для других паков — не берём
+    assert main.read_graph_artifact(path, "other") is None
+    assert main.read_graph_artifact(str(tmp_path / "missing.json"), "test") is None
+
+def test_shipped_content_is_consistent():
+    # паки из репозитория: без ошибок, финал достижим, артефакт собран для них же
+    assert main.CONTENT_GRAPH.to_finale[main.CONTENT_GRAPH.nodes.index("intro")] > 0
+    artifact = main.read_graph_artifact(main.GRAPH_ARTIFACT, main.CONTENT_VERSION)
+    assert artifact is not None, "content/_graph.json устарел: python main.py check"
+    assert main.read_ids() == {"nodes": main.NODE_KEYS, "items": main.ITEMS}